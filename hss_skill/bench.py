@@ -0,0 +1,518 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# bench.py
+# -----------------------------------------------------------------------------
+# Load-testing benchmark for skills, running entirely offline:
+#
+#   python -m hss_skill.bench --skill-dir=~/myskill --skill-class=myskill.MoodSkill \
+#       --intent=s710:howAreYou --requests=2000 --concurrency=16
+#
+# The skill is run in-process against a stand-in hss-server (FakeServer),
+# while the Driver fires synthetic 'handle' requests at it and reports
+# throughput as well as latency percentiles per processing stage.
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+from hss_skill import rpc
+
+# -----------------------------------------------------------------------------
+# stages as reported, in processing order
+# -----------------------------------------------------------------------------
+
+STAGES = ["read", "decode", "queue", "slots", "handle", "encode", "total"]
+
+# -----------------------------------------------------------------------------
+# class Recorder
+# -----------------------------------------------------------------------------
+
+
+class Recorder:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self):
+        self.samples = { stage: [] for stage in STAGES }
+
+    # --------------------------------------------------------------------------
+    # record (installed as BaseSkill.tracer)
+    # --------------------------------------------------------------------------
+
+    def __call__(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    # --------------------------------------------------------------------------
+    # percentile
+    # --------------------------------------------------------------------------
+
+    def percentile(self, stage, p):
+        values = sorted(self.samples[stage])
+
+        if not values:
+            return None
+
+        return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+    # --------------------------------------------------------------------------
+    # report
+    # --------------------------------------------------------------------------
+
+    def report(self, duration):
+        res = { "duration": duration, "stages": {} }
+
+        for stage, values in self.samples.items():
+            if not values:
+                continue
+
+            res["stages"][stage] = {
+                "count": len(values),
+                "mean": sum(values) / len(values),
+                "p50": self.percentile(stage, 50),
+                "p95": self.percentile(stage, 95),
+                "p99": self.percentile(stage, 99),
+                "max": max(values)
+            }
+
+        total = res["stages"].get("total")
+        res["throughput"] = total["count"] / duration if total and duration else 0.0
+
+        return res
+
+# -----------------------------------------------------------------------------
+# class FakeServer
+# -----------------------------------------------------------------------------
+
+
+class FakeServer:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, port = None, path = None, delay = 0.0):
+        self.log = logging.getLogger(__name__)
+        self.port = port
+        self.path = path
+        self.delay = delay
+        self.server = None
+        self.channels = set()
+        self.commands = {}
+
+    # --------------------------------------------------------------------------
+    # start (async)
+    # --------------------------------------------------------------------------
+
+    async def start(self):
+        if self.path:
+            rpc.remove_stale_socket(self.path)
+            self.server = await asyncio.start_unix_server(self.on_connected, self.path)
+        else:
+            self.server = await asyncio.start_server(self.on_connected, '127.0.0.1', self.port)
+
+    # --------------------------------------------------------------------------
+    # stop (async)
+    # --------------------------------------------------------------------------
+
+    async def stop(self):
+        if self.server:
+            self.server.close()
+
+            for channel in list(self.channels):
+                channel.writer.close()
+
+            await self.server.wait_closed()
+
+        if self.path:
+            rpc.remove_stale_socket(self.path)
+
+    # --------------------------------------------------------------------------
+    # on_connected (async)
+    # --------------------------------------------------------------------------
+
+    async def on_connected(self, reader, writer):
+        # speaks the skill -> server protocol: accepts every negotiation offer
+        # (including features) and answers each command (say, ask, ...) with 'true'
+
+        channel = rpc.Channel(reader, writer)
+        self.channels.add(channel)
+
+        async def respond(request_obj):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+
+            await channel.write({"seq": request_obj["seq"], "command": "response", "payload": True})
+
+        while True:
+            try:
+                frame = await channel.read_frame()
+            except Exception:
+                break
+
+            if not frame:
+                break
+
+            request_obj = channel.decode(frame)
+            command = request_obj.get("command")
+
+            self.commands[command] = self.commands.get(command, 0) + 1
+
+            if command == "negotiate":
+                framing, codec = rpc.select_protocol(request_obj["payload"])
+
+                await channel.write({"seq": request_obj["seq"], "command": "response",
+                                     "payload": { "framing": framing, "codec": codec,
+                                                  "features": rpc.select_features(request_obj["payload"]) }})
+                channel.switch(framing, codec)
+                continue
+
+            if command == "batch":
+                for batched_obj in request_obj["payload"]:
+                    self.commands[batched_obj.get("command")] = self.commands.get(batched_obj.get("command"), 0) + 1
+                    asyncio.ensure_future(respond(batched_obj))
+                continue
+
+            asyncio.ensure_future(respond(request_obj))
+
+        self.channels.discard(channel)
+
+# -----------------------------------------------------------------------------
+# class Driver
+# -----------------------------------------------------------------------------
+
+
+class Driver:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, recorder, intents, slots = None, requests = 1000, concurrency = 1, rate = 0.0,
+                 port = None, path = None, framing = rpc.FRAMING_LINE, codec = rpc.JsonCodec.name, timeout = 30.0):
+        self.log = logging.getLogger(__name__)
+        self.recorder = recorder
+        self.intents = intents
+        self.slots = slots or []
+        self.requests = requests
+        self.concurrency = max(1, concurrency)
+        self.rate = rate
+        self.port = port
+        self.path = path
+        self.framing = framing
+        self.codec = codec
+        self.timeout = timeout
+        self.pending = {}
+        self.errors = 0
+        self.done = False
+
+    # --------------------------------------------------------------------------
+    # connect (async)
+    # --------------------------------------------------------------------------
+
+    async def connect(self, timeout = 10.0):
+        self.channel = await connect_channel(self.port, self.path, timeout)
+
+        if self.framing != rpc.FRAMING_LINE:
+            await self.channel.write({"seq": -1, "command": "negotiate",
+                                      "payload": { "framing": [self.framing], "codecs": [self.codec, rpc.JsonCodec.name] }})
+
+            accepted = self.channel.decode(await self.channel.read_frame())["payload"]
+            self.channel.switch(accepted["framing"], accepted["codec"])
+
+    # --------------------------------------------------------------------------
+    # request
+    # --------------------------------------------------------------------------
+
+    def request(self, seq):
+        return {
+            "seq": seq,
+            "command": "handle",
+            "payload": {
+                "intent": { "intentName": random.choice(self.intents), "confidenceScore": 1.0 },
+                "sessionId": "bench-{}".format(seq),
+                "siteId": "bench",
+                "slots": self.slots
+            }
+        }
+
+    # --------------------------------------------------------------------------
+    # read_loop (async)
+    # --------------------------------------------------------------------------
+
+    async def read_loop(self):
+        # requests which got no response within 'timeout' count as errors
+
+        answered = 0
+
+        while answered + self.errors < self.requests:
+            try:
+                frame = await asyncio.wait_for(self.channel.read_frame(), self.timeout)
+            except asyncio.TimeoutError:
+                self.log.error("No response within %s seconds, giving up", self.timeout)
+                break
+
+            if not frame:
+                break
+
+            response_obj = self.channel.decode(frame)
+            entry = self.pending.pop(response_obj.get("seq"), None)
+
+            if not entry:
+                continue
+
+            started, slot = entry
+            self.recorder("total", time.perf_counter() - started)
+            answered += 1
+            slot.release()
+
+        self.errors += self.requests - answered
+        self.done = True
+
+        for started, slot in self.pending.values():
+            slot.release()
+
+    # --------------------------------------------------------------------------
+    # run (async)
+    # --------------------------------------------------------------------------
+
+    async def run(self):
+        # closed loop (as fast as possible, 'concurrency' requests in flight) or,
+        # with a rate given, open loop with requests sent at fixed intervals
+
+        slot = asyncio.Semaphore(self.concurrency)
+        reader = None
+        interval = 1.0 / self.rate if self.rate else 0.0
+        started = time.perf_counter()
+
+        for seq in range(self.requests):
+            await slot.acquire()
+
+            if self.done:
+                break
+
+            if interval:
+                delay = started + seq * interval - time.perf_counter()
+
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            self.pending[seq] = (time.perf_counter(), slot)
+            await self.channel.write(self.request(seq))
+
+            if not reader:
+                reader = asyncio.ensure_future(self.read_loop())
+
+        if reader:
+            await reader
+
+        duration = time.perf_counter() - started
+
+        await self.channel.close()
+
+        return duration
+
+# -----------------------------------------------------------------------------
+# connect_channel (async)
+# -----------------------------------------------------------------------------
+
+
+async def connect_channel(port = None, path = None, timeout = 10.0):
+    # the skill starts listening only after it connected to the fake server
+
+    deadline = time.monotonic() + timeout
+
+    while True:
+        try:
+            if path:
+                reader, writer = await asyncio.open_unix_connection(path)
+            else:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+
+            return rpc.Channel(reader, writer)
+        except (ConnectionError, FileNotFoundError):
+            if time.monotonic() > deadline:
+                raise
+
+            await asyncio.sleep(0.05)
+
+# -----------------------------------------------------------------------------
+# load_skill_class
+# -----------------------------------------------------------------------------
+
+
+def load_skill_class(skill_dir, skill_class):
+    module_name, class_name = skill_class.rsplit(".", 1)
+
+    sys.path.insert(0, os.path.abspath(os.path.expanduser(skill_dir)))
+
+    return getattr(importlib.import_module(module_name), class_name)
+
+# -----------------------------------------------------------------------------
+# free_port
+# -----------------------------------------------------------------------------
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# -----------------------------------------------------------------------------
+# parse_slot
+# -----------------------------------------------------------------------------
+
+
+def parse_slot(spec):
+    # name[:entity]=value
+
+    name, value = spec.split("=", 1)
+    name, entity = name.split(":", 1) if ":" in name else (name, name)
+
+    return { "slotName": name, "entity": entity, "value": { "kind": "Unknown", "value": value }, "rawValue": value }
+
+# -----------------------------------------------------------------------------
+# format_report
+# -----------------------------------------------------------------------------
+
+
+def format_report(report, errors, commands):
+    lines = ["{:<8} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "stage", "count", "mean ms", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+
+    for stage in STAGES:
+        values = report["stages"].get(stage)
+
+        if not values:
+            continue
+
+        lines.append("{:<8} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            stage, values["count"], values["mean"] * 1000, values["p50"] * 1000, values["p95"] * 1000,
+            values["p99"] * 1000, values["max"] * 1000))
+
+    lines.append("")
+    lines.append("duration {:.3f} s, throughput {:.1f} requests/s, {} errors".format(
+        report["duration"], report["throughput"], errors))
+
+    if commands:
+        lines.append("skill -> server calls: {}".format(", ".join("{} {}".format(k, v) for k, v in sorted(commands.items()))))
+
+    return "\n".join(lines)
+
+# -----------------------------------------------------------------------------
+# bench (async)
+# -----------------------------------------------------------------------------
+
+
+async def bench(args):
+    skill_dir = os.path.abspath(os.path.expanduser(args.skill_dir))
+    skill_class = load_skill_class(skill_dir, args.skill_class)
+
+    tmp_dir = tempfile.mkdtemp(prefix="hss-bench-")
+    socket_path = os.path.join(tmp_dir, "skill.sock") if args.unix else None
+    parent_socket_path = os.path.join(tmp_dir, "server.sock") if args.unix else None
+    port = free_port()
+    parent_port = free_port()
+
+    # BaseSkill reads its settings from the command line
+
+    sys.argv = [sys.argv[0], "--skill-name=bench", "--skill-dir={}".format(skill_dir),
+                "--port={}".format(port), "--parent-port={}".format(parent_port),
+                "--concurrency={}".format(args.skill_concurrency),
+                "--framing={}".format(args.framing), "--codec={}".format(args.codec)]
+
+    if args.unix:
+        sys.argv += ["--socket={}".format(socket_path), "--parent-socket={}".format(parent_socket_path)]
+
+    recorder = Recorder()
+    server = FakeServer(port = parent_port, path = parent_socket_path, delay = args.server_delay)
+    await server.start()
+
+    skill = skill_class()
+    skill.tracer = recorder
+    serving = asyncio.ensure_future(skill.serve())
+
+    driver = Driver(recorder, args.intent, slots = [parse_slot(s) for s in args.slot],
+                    requests = args.requests, concurrency = args.concurrency, rate = args.rate,
+                    port = port, path = socket_path, framing = args.framing, codec = args.codec,
+                    timeout = args.timeout)
+
+    try:
+        await driver.connect()
+        duration = await driver.run()
+    finally:
+        if skill.rpc:
+            await skill.rpc.stop()
+
+        serving.cancel()
+
+        try:
+            await serving
+        except (asyncio.CancelledError, Exception):
+            pass
+
+        await skill.shutdown()
+        await server.stop()
+
+        try:
+            os.rmdir(tmp_dir)
+        except OSError:
+            pass
+
+    return recorder.report(duration), driver.errors, server.commands
+
+# -----------------------------------------------------------------------------
+# main
+# -----------------------------------------------------------------------------
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = "python -m hss_skill.bench",
+                                     description = "Offline load test of a hss skill against a stand-in hss-server")
+
+    parser.add_argument("--skill-dir", required = True, help = "directory containing skill.json and the skill module")
+    parser.add_argument("--skill-class", required = True, help = "skill class, e.g. myskill.MoodSkill")
+    parser.add_argument("--intent", action = "append", required = True, help = "intent name to request (repeatable)")
+    parser.add_argument("--slot", action = "append", default = [], help = "slot as name[:entity]=value (repeatable)")
+    parser.add_argument("--requests", type = int, default = 1000, help = "number of requests (default: 1000)")
+    parser.add_argument("--concurrency", type = int, default = 1, help = "requests in flight (default: 1)")
+    parser.add_argument("--rate", type = float, default = 0.0, help = "requests per second, 0 for maximum (default: 0)")
+    parser.add_argument("--skill-concurrency", type = int, default = 1, help = "skill's 'concurrency' option (default: 1)")
+    parser.add_argument("--server-delay", type = float, default = 0.0, help = "seconds the fake server takes to answer say/ask")
+    parser.add_argument("--timeout", type = float, default = 30.0, help = "seconds to wait for a response (default: 30)")
+    parser.add_argument("--unix", action = "store_true", help = "use unix domain sockets instead of TCP")
+    parser.add_argument("--framing", default = rpc.FRAMING_LINE, choices = rpc.FRAMINGS)
+    parser.add_argument("--codec", default = rpc.JsonCodec.name, choices = list(rpc.CODECS))
+    parser.add_argument("--json", action = "store_true", help = "print the report as JSON")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.WARNING, format = '%(levelname)s:%(name)s: %(message)s')
+
+    report, errors, commands = asyncio.get_event_loop().run_until_complete(bench(args))
+
+    if args.json:
+        report["errors"] = errors
+        report["commands"] = commands
+        print(json.dumps(report, indent = 2))
+    else:
+        print(format_report(report, errors, commands))
+
+
+if __name__ == "__main__":
+    main()
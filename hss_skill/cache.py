@@ -0,0 +1,196 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# cache.py
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import asyncio
+import functools
+import logging
+import time
+
+from collections import OrderedDict
+
+# -----------------------------------------------------------------------------
+# default_key
+# -----------------------------------------------------------------------------
+
+
+def default_key(skill, request, intent_name, slots, mapped_slots):
+    # (intent, mapped slots, language). list values become tuples to be hashable
+
+    items = tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                         for name, value in (mapped_slots or {}).items()))
+
+    return (intent_name, items, skill.request_language(request))
+
+# -----------------------------------------------------------------------------
+# class ResultCache
+# -----------------------------------------------------------------------------
+
+
+class ResultCache:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, ttl = 60.0, maxsize = 256, ttls = None, key = None):
+        self.log = logging.getLogger(__name__)
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.maxsize = maxsize
+        self.key = key or default_key
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # --------------------------------------------------------------------------
+    # lookup
+    # --------------------------------------------------------------------------
+
+    def lookup(self, key):
+        entry = self.entries.get(key)
+
+        if not entry:
+            return None
+
+        if entry[0] <= time.monotonic():
+            del self.entries[key]
+            return None
+
+        self.entries.move_to_end(key)
+
+        return entry[1]
+
+    # --------------------------------------------------------------------------
+    # store
+    # --------------------------------------------------------------------------
+
+    def store(self, key, ttl, result):
+        self.entries[key] = (time.monotonic() + ttl, result)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
+
+    # --------------------------------------------------------------------------
+    # invalidate
+    # --------------------------------------------------------------------------
+
+    def invalidate(self, intent_name = None):
+        # with the default key, entries of a single intent can be dropped
+
+        if intent_name is None:
+            self.entries.clear()
+            return
+
+        for key in [k for k in self.entries if isinstance(k, tuple) and k and k[0] == intent_name]:
+            del self.entries[key]
+
+    # --------------------------------------------------------------------------
+    # call (async)
+    # --------------------------------------------------------------------------
+
+    async def call(self, key, ttl, fn):
+        # returns (result, shared). concurrent calls with the same key wait for
+        # the first one instead of calling upstream again
+
+        result = self.lookup(key)
+
+        if result is not None:
+            self.hits += 1
+            return result, True
+
+        task = self.inflight.get(key)
+
+        if task:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+
+        # upstream runs as a task of its own, so a cancelled caller (e.g. by an
+        # intent timeout) does not fail the callers waiting for it
+
+        self.misses += 1
+        task = asyncio.ensure_future(fn())
+        self.inflight[key] = task
+        task.add_done_callback(functools.partial(self.finished, key, ttl))
+
+        return await asyncio.shield(task), False
+
+    # --------------------------------------------------------------------------
+    # finished
+    # --------------------------------------------------------------------------
+
+    def finished(self, key, ttl, task):
+        if self.inflight.get(key) is task:
+            del self.inflight[key]
+
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        result = task.result()
+
+        if isinstance(result, dict):
+            self.store(key, ttl, dict(result))
+
+# -----------------------------------------------------------------------------
+# cached (decorator for BaseSkill.handle)
+# -----------------------------------------------------------------------------
+
+
+def cached(ttl = 60.0, maxsize = 256, ttls = None, key = None):
+    # key(skill, request, intent_name, slots, mapped_slots) -> hashable, or None
+    # to bypass the cache. ttls maps intent names to TTLs, a TTL of 0 disables
+    # caching for that intent
+
+    def decorator(handle):
+        cache = ResultCache(ttl, maxsize, ttls, key)
+
+        # plain functions are run on the skill's thread pool
+
+        if not asyncio.iscoroutinefunction(handle):
+            sync_handle = handle
+
+            async def handle(self, *args):
+                return await self.run_in_thread(sync_handle, self, *args)
+
+        @functools.wraps(handle)
+        async def wrapper(self, request, session_id, site_id, intent_name, slots, mapped_slots):
+            intent_ttl = cache.ttls.get(intent_name, cache.ttl)
+            cache_key = cache.key(self, request, intent_name, slots, mapped_slots) if intent_ttl else None
+
+            if cache_key is None:
+                return await handle(self, request, session_id, site_id, intent_name, slots, mapped_slots)
+
+            result, shared = await cache.call(cache_key, intent_ttl,
+                lambda: handle(self, request, session_id, site_id, intent_name, slots, mapped_slots))
+
+            if self.stats:
+                self.stats.count("cacheHits" if shared else "cacheMisses")
+
+            if not shared or not isinstance(result, dict):
+                return result
+
+            # answer/followup of another session, re-stamp for this one
+
+            result = dict(result)
+            result["sessionId"] = session_id
+            result["siteId"] = site_id
+
+            return result
+
+        wrapper.cache = cache
+
+        return wrapper
+
+    return decorator
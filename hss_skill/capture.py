@@ -0,0 +1,582 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# capture.py
+# -----------------------------------------------------------------------------
+# Recording of RPC traffic (option 'capture_file'), and replay of recorded
+# traffic against a skill, running entirely offline:
+#
+#   python -m hss_skill.capture dump capture.bin
+#   python -m hss_skill.capture replay capture.bin --skill-dir=~/myskill \
+#       --skill-class=myskill.MoodSkill --speed=2
+#
+# A capture file starts with a header (magic, wall clock and monotonic time
+# of its creation), followed by records of a fixed size header and the frame
+# as sent or received (without length prefix). Each process appending to the
+# file first writes a segment record with a random run id, since connections
+# and seqs start over in every run.
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+from hss_skill import bench
+from hss_skill import rpc
+
+# -----------------------------------------------------------------------------
+# file format
+# -----------------------------------------------------------------------------
+
+MAGIC = b"HSSCAP1\n"
+FILE_HEADER = struct.Struct(">dd")                  # wall clock, monotonic
+RECORD_HEADER = struct.Struct(">dBIqBI")            # monotonic, direction, connection, seq, format, length
+
+# directions (rpc.CAPTURE_*), and segment records starting a run (frame:
+# run id, wall clock and monotonic time)
+
+DIRECTIONS = ["server-in", "server-out", "client-out", "client-in"]
+DIRECTION_SEGMENT = 255
+SEGMENT = struct.Struct(">Qdd")
+
+# frame formats (framing, codec)
+
+FORMATS = [(rpc.FRAMING_LINE, "json"), (rpc.FRAMING_LENGTH, "json"), (rpc.FRAMING_LENGTH, "msgpack")]
+
+NO_SEQ = -1
+
+# -----------------------------------------------------------------------------
+# class Capture (records are written by a background thread)
+# -----------------------------------------------------------------------------
+
+
+class Capture:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, path, max_bytes = 64 * 1024 * 1024, backups = 3):
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.records = queue.SimpleQueue()
+        self.connections = itertools.count(1)
+        self.run_id = struct.unpack(">Q", os.urandom(8))[0]
+        self.thread = None
+        self.file = None
+        self.size = 0
+
+    # --------------------------------------------------------------------------
+    # next_connection
+    # --------------------------------------------------------------------------
+
+    def next_connection(self):
+        return next(self.connections)
+
+    # --------------------------------------------------------------------------
+    # record (called on the event loop, only queues the record)
+    # --------------------------------------------------------------------------
+
+    def record(self, direction, connection, seq, framing, codec, frame):
+        if self.thread is None:
+            self.thread = threading.Thread(target = self.run, name = "hss-capture", daemon = True)
+            self.thread.start()
+
+        try:
+            fmt = FORMATS.index((framing, codec if framing == rpc.FRAMING_LENGTH else "json"))
+        except ValueError:
+            fmt = 0
+
+        if not isinstance(seq, int) or isinstance(seq, bool) or abs(seq) >= 2 ** 63:
+            seq = NO_SEQ
+
+        self.records.put(RECORD_HEADER.pack(time.monotonic(), direction, connection, seq, fmt, len(frame)) + frame)
+
+    # --------------------------------------------------------------------------
+    # close
+    # --------------------------------------------------------------------------
+
+    def close(self):
+        # writes records still queued
+
+        if self.thread is not None:
+            self.records.put(None)
+            self.thread.join(5.0)
+            self.thread = None
+
+    # --------------------------------------------------------------------------
+    # open
+    # --------------------------------------------------------------------------
+
+    def open(self):
+        self.file = open(self.path, "ab")
+        self.size = self.file.tell()
+
+        if not self.size:
+            self.file.write(MAGIC + FILE_HEADER.pack(time.time(), time.monotonic()))
+            self.size = len(MAGIC) + FILE_HEADER.size
+
+        segment = SEGMENT.pack(self.run_id, time.time(), time.monotonic())
+        segment = RECORD_HEADER.pack(time.monotonic(), DIRECTION_SEGMENT, 0, NO_SEQ, 0, len(segment)) + segment
+
+        self.file.write(segment)
+        self.size += len(segment)
+
+    # --------------------------------------------------------------------------
+    # rotate
+    # --------------------------------------------------------------------------
+
+    def rotate(self):
+        # capture -> capture.1 -> capture.2 ..., like logging's RotatingFileHandler
+
+        self.file.close()
+
+        for i in range(self.backups - 1, 0, -1):
+            source = "{}.{}".format(self.path, i)
+
+            if os.path.exists(source):
+                os.replace(source, "{}.{}".format(self.path, i + 1))
+
+        if self.backups:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+        self.open()
+
+    # --------------------------------------------------------------------------
+    # run (writer thread)
+    # --------------------------------------------------------------------------
+
+    def run(self):
+        try:
+            self.open()
+        except OSError as e:
+            self.log.error("Failed to open capture file '%s' (%s)", self.path, e)
+            return
+
+        running = True
+
+        while running:
+            record = self.records.get()
+
+            # write everything queued meanwhile in one go, flush when idle
+
+            while record is not None:
+                try:
+                    if self.max_bytes and self.size + len(record) > self.max_bytes:
+                        self.rotate()
+
+                    self.file.write(record)
+                    self.size += len(record)
+                except OSError as e:
+                    self.log.error("Failed to write capture file '%s' (%s)", self.path, e)
+
+                try:
+                    record = self.records.get_nowait()
+                except queue.Empty:
+                    break
+
+            if record is None:
+                running = False
+
+            try:
+                self.file.flush()
+            except OSError:
+                pass
+
+        self.file.close()
+
+# -----------------------------------------------------------------------------
+# read_capture
+# -----------------------------------------------------------------------------
+
+
+def read_capture(path):
+    # yields (monotonic, run, direction, connection, seq, object) of a capture
+    # file. frames which cannot be decoded are yielded as bytes, segment records
+    # with the wall clock time the run started. records before the first segment
+    # record (older captures) belong to run 0
+
+    with open(path, "rb") as capture_file:
+        if capture_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("'{}' is not a capture file".format(path))
+
+        capture_file.read(FILE_HEADER.size)
+        run = 0
+
+        while True:
+            header = capture_file.read(RECORD_HEADER.size)
+
+            if len(header) < RECORD_HEADER.size:
+                return
+
+            timestamp, direction, connection, seq, fmt, length = RECORD_HEADER.unpack(header)
+            frame = capture_file.read(length)
+
+            if len(frame) < length:
+                return
+
+            if direction == DIRECTION_SEGMENT and length == SEGMENT.size:
+                run, started, monotonic = SEGMENT.unpack(frame)
+                yield timestamp, run, direction, connection, seq, started
+                continue
+
+            yield timestamp, run, direction, connection, seq, decode_frame(fmt, frame)
+
+# -----------------------------------------------------------------------------
+# decode_frame
+# -----------------------------------------------------------------------------
+
+
+def decode_frame(fmt, frame):
+    framing, codec = FORMATS[fmt] if fmt < len(FORMATS) else FORMATS[0]
+
+    try:
+        if framing == rpc.FRAMING_LINE:
+            return json.loads(frame.decode("utf-8").replace('\\n', '\n'))
+
+        return rpc.CODECS[codec].decode(frame)
+    except Exception:
+        return frame
+
+# -----------------------------------------------------------------------------
+# class Replay
+# -----------------------------------------------------------------------------
+
+
+class Replay:
+    # plays the recorded server -> skill requests back, one connection per
+    # recorded connection, and compares the responses with the recorded ones.
+    # connections are identified by (run, connection), runs are replayed back
+    # to back
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, records, speed = 1.0, port = None, path = None, timeout = 30.0):
+        self.log = logging.getLogger(__name__)
+        self.speed = speed
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.requests = []
+        self.recorded = {}
+        self.responses = {}
+        self.channels = {}
+        self.lateness = []
+
+        # negotiation is not replayed, requests are always sent as newline JSON
+
+        runs = []
+
+        for timestamp, run, direction, connection, seq, obj in records:
+            if run not in runs:
+                runs.append(run)
+
+            if not isinstance(obj, dict):
+                continue
+
+            if direction == rpc.CAPTURE_SERVER_IN and obj.get("command") not in (None, "negotiate"):
+                self.requests.append((timestamp, run, (run, connection), obj))
+            elif direction == rpc.CAPTURE_SERVER_OUT and seq != NO_SEQ:
+                self.recorded[((run, connection), seq)] = (timestamp, obj.get("payload"))
+
+        # monotonic clocks of different runs are unrelated, so each run is
+        # scheduled right after the previous one (as 'due', relative to the start)
+
+        self.requests.sort(key = lambda request: (runs.index(request[1]), request[0]))
+        scheduled = []
+        current = None
+        offset = 0.0
+
+        for timestamp, run, connection, request_obj in self.requests:
+            if run != current:
+                current = run
+                offset = (scheduled[-1][0] if scheduled else 0.0) - timestamp
+
+            scheduled.append((timestamp + offset, timestamp, connection, request_obj))
+
+        self.requests = scheduled
+
+    # --------------------------------------------------------------------------
+    # open_channel (async)
+    # --------------------------------------------------------------------------
+
+    async def open_channel(self, connection):
+        channel = self.channels[connection] = await bench.connect_channel(self.port, self.path)
+        asyncio.ensure_future(self.read_loop(connection, channel))
+
+    # --------------------------------------------------------------------------
+    # read_loop (async)
+    # --------------------------------------------------------------------------
+
+    async def read_loop(self, connection, channel):
+        while True:
+            try:
+                frame = await channel.read_frame()
+            except Exception:
+                break
+
+            if not frame:
+                break
+
+            response_obj = channel.decode(frame)
+            entry = self.responses.get((connection, response_obj.get("seq")))
+
+            if entry and entry[1] is None:
+                entry[1] = time.perf_counter()
+                entry[2] = response_obj.get("payload")
+
+    # --------------------------------------------------------------------------
+    # run (async)
+    # --------------------------------------------------------------------------
+
+    async def run(self):
+        # speed 0 sends all requests right away
+
+        if not self.requests:
+            return 0.0
+
+        for due, timestamp, connection, request_obj in self.requests:
+            if connection not in self.channels:
+                await self.open_channel(connection)
+
+        started = time.perf_counter()
+
+        for due, timestamp, connection, request_obj in self.requests:
+            if self.speed:
+                due = started + due / self.speed
+                delay = due - time.perf_counter()
+
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+                self.lateness.append(max(0.0, time.perf_counter() - due))
+
+            self.responses[(connection, request_obj["seq"])] = [time.perf_counter(), None, None]
+            await self.channels[connection].write(request_obj)
+
+        # wait for the responses which were recorded
+
+        deadline = time.perf_counter() + self.timeout
+
+        while time.perf_counter() < deadline:
+            if all(self.responses[key][1] is not None for key in self.recorded if key in self.responses):
+                break
+
+            await asyncio.sleep(0.01)
+
+        duration = time.perf_counter() - started
+
+        for channel in self.channels.values():
+            try:
+                await channel.close()
+            except Exception:
+                pass
+
+        return duration
+
+    # --------------------------------------------------------------------------
+    # report
+    # --------------------------------------------------------------------------
+
+    def report(self, duration):
+        matched = 0
+        mismatched = []
+        missing = 0
+        unexpected = 0
+        drift = []
+
+        requests = { (connection, request_obj["seq"]): (timestamp, request_obj)
+                     for due, timestamp, connection, request_obj in self.requests }
+
+        for key, (sent, received, payload) in self.responses.items():
+            timestamp, request_obj = requests[key]
+            recorded = self.recorded.get(key)
+
+            if recorded is None:
+                if received is not None:
+                    unexpected += 1
+                continue
+
+            if received is None:
+                missing += 1
+                continue
+
+            drift.append((received - sent) - (recorded[0] - timestamp))
+
+            # statistics differ by nature
+
+            if request_obj.get("command") == "get_stats" or payload == recorded[1]:
+                matched += 1
+            else:
+                mismatched.append({ "run": "{:016x}".format(key[0][0]), "connection": key[0][1], "seq": key[1],
+                                    "recorded": recorded[1], "replayed": payload })
+
+        drift.sort()
+        self.lateness.sort()
+
+        def summary(values):
+            if not values:
+                return None
+
+            return { "mean": sum(values) / len(values), "p50": values[len(values) // 2],
+                     "p95": values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))], "max": values[-1] }
+
+        return {
+            "duration": duration,
+            "requests": len(self.requests),
+            "matched": matched,
+            "mismatched": len(mismatched),
+            "missing": missing,
+            "unexpected": unexpected,
+            "drift": summary(drift),
+            "lateness": summary(self.lateness),
+            "mismatches": mismatched[:10]
+        }
+
+# -----------------------------------------------------------------------------
+# format_report
+# -----------------------------------------------------------------------------
+
+
+def format_report(report):
+    lines = ["replayed {} requests in {:.3f} s: {} matched, {} mismatched, {} missing, {} unexpected".format(
+        report["requests"], report["duration"], report["matched"], report["mismatched"], report["missing"],
+        report["unexpected"])]
+
+    for name, title in (("drift", "latency drift (replayed - recorded)"), ("lateness", "send lateness")):
+        values = report[name]
+
+        if values:
+            lines.append("{}: mean {:.3f} ms, p50 {:.3f} ms, p95 {:.3f} ms, max {:.3f} ms".format(
+                title, values["mean"] * 1000, values["p50"] * 1000, values["p95"] * 1000, values["max"] * 1000))
+
+    for mismatch in report["mismatches"]:
+        lines.append("mismatch (run {}, connection {}, seq {}):\n  recorded: {}\n  replayed: {}".format(
+            mismatch["run"], mismatch["connection"], mismatch["seq"], json.dumps(mismatch["recorded"]), json.dumps(mismatch["replayed"])))
+
+    return "\n".join(lines)
+
+# -----------------------------------------------------------------------------
+# replay (async)
+# -----------------------------------------------------------------------------
+
+
+async def replay(args):
+    records = itertools.chain.from_iterable(read_capture(path) for path in args.files)
+    port = bench.free_port()
+    parent_port = bench.free_port()
+
+    skill_class = bench.load_skill_class(args.skill_dir, args.skill_class)
+
+    sys.argv = [sys.argv[0], "--skill-name=replay", "--skill-dir={}".format(os.path.abspath(os.path.expanduser(args.skill_dir))),
+                "--port={}".format(port), "--parent-port={}".format(parent_port),
+                "--concurrency={}".format(args.skill_concurrency)]
+
+    server = bench.FakeServer(port = parent_port)
+    await server.start()
+
+    skill = skill_class()
+    serving = asyncio.ensure_future(skill.serve())
+    player = Replay(records, speed = args.speed, port = port, timeout = args.timeout)
+
+    try:
+        duration = await player.run()
+    finally:
+        if skill.rpc:
+            await skill.rpc.stop()
+
+        serving.cancel()
+
+        try:
+            await serving
+        except (asyncio.CancelledError, Exception):
+            pass
+
+        await skill.shutdown()
+        await server.stop()
+
+    return player.report(duration)
+
+# -----------------------------------------------------------------------------
+# dump
+# -----------------------------------------------------------------------------
+
+
+def dump(args):
+    first = None
+
+    for path in args.files:
+        for timestamp, run, direction, connection, seq, obj in read_capture(path):
+            if direction == DIRECTION_SEGMENT:
+                print("run {:016x} (started {})".format(run, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(obj))))
+                first = None
+                continue
+
+            first = timestamp if first is None else first
+
+            print("{:>12.6f} {:<10} conn {:<4} seq {:<8} {}".format(
+                timestamp - first, DIRECTIONS[direction] if direction < len(DIRECTIONS) else direction,
+                connection, seq, json.dumps(obj) if isinstance(obj, dict) else repr(obj)))
+
+# -----------------------------------------------------------------------------
+# main
+# -----------------------------------------------------------------------------
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = "python -m hss_skill.capture",
+                                     description = "Inspect and replay captured RPC traffic of a hss skill")
+    commands = parser.add_subparsers(dest = "command")
+
+    dump_parser = commands.add_parser("dump", help = "print the records of capture files")
+    dump_parser.add_argument("files", nargs = "+", help = "capture files, oldest first")
+
+    replay_parser = commands.add_parser("replay", help = "replay captured requests against a skill")
+    replay_parser.add_argument("files", nargs = "+", help = "capture files, oldest first")
+    replay_parser.add_argument("--skill-dir", required = True, help = "directory containing skill.json and the skill module")
+    replay_parser.add_argument("--skill-class", required = True, help = "skill class, e.g. myskill.MoodSkill")
+    replay_parser.add_argument("--speed", type = float, default = 1.0, help = "replay speed factor, 0 for maximum (default: 1)")
+    replay_parser.add_argument("--skill-concurrency", type = int, default = 1, help = "skill's 'concurrency' option (default: 1)")
+    replay_parser.add_argument("--timeout", type = float, default = 30.0, help = "seconds to wait for responses (default: 30)")
+    replay_parser.add_argument("--json", action = "store_true", help = "print the report as JSON")
+
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        dump(args)
+    elif args.command == "replay":
+        logging.basicConfig(level = logging.WARNING, format = '%(levelname)s:%(name)s: %(message)s')
+
+        report = asyncio.get_event_loop().run_until_complete(replay(args))
+
+        if args.json:
+            print(json.dumps(report, indent = 2))
+        else:
+            print(format_report(report))
+
+        if report["mismatched"] or report["missing"]:
+            sys.exit(1)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
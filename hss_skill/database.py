@@ -0,0 +1,133 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# database.py
+# -----------------------------------------------------------------------------
+# sqlite database (WAL) used by the timer and session stores. All statements
+# run on one thread per database, in the order they were issued, so a
+# database locked by another worker process never stalls the event loop.
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import asyncio
+import concurrent.futures
+import logging
+import sqlite3
+
+# -----------------------------------------------------------------------------
+# class Database
+# -----------------------------------------------------------------------------
+
+
+class Database:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, path, schema, busy_timeout = 10.0, wait = 0.2):
+        # busy_timeout: seconds a statement waits for a lock (on the database
+        # thread). wait: seconds the event loop waits for the result of query()
+
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.schema = schema
+        self.busy_timeout = busy_timeout
+        self.wait = wait
+        self.db = None
+        self.executor = None
+
+    # --------------------------------------------------------------------------
+    # connection
+    # --------------------------------------------------------------------------
+
+    def connection(self):
+        # opened on first use, connections must not be inherited by forked workers
+
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, isolation_level = None, timeout = self.busy_timeout,
+                                      check_same_thread = False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+
+            for statement in self.schema:
+                self.db.execute(statement)
+
+        return self.db
+
+    # --------------------------------------------------------------------------
+    # submit
+    # --------------------------------------------------------------------------
+
+    def submit(self, fn, *args):
+        # runs fn(connection, *args) on the database thread, returns a future
+
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "hss-sqlite")
+
+        return self.executor.submit(self.execute, fn, args)
+
+    def execute(self, fn, args):
+        return fn(self.connection(), *args)
+
+    # --------------------------------------------------------------------------
+    # post
+    # --------------------------------------------------------------------------
+
+    def post(self, fn, *args):
+        # like submit, failures are logged (the result need not be waited for)
+
+        future = self.submit(fn, *args)
+        future.add_done_callback(self.check)
+
+        return future
+
+    def check(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.log.error("Database '%s' failed (%s)", self.path, future.exception())
+
+    # --------------------------------------------------------------------------
+    # run (async)
+    # --------------------------------------------------------------------------
+
+    async def run(self, fn, *args):
+        return await asyncio.wrap_future(self.submit(fn, *args))
+
+    # --------------------------------------------------------------------------
+    # call / query
+    # --------------------------------------------------------------------------
+
+    def call(self, fn, *args):
+        # waits for the result (startup and shutdown only)
+
+        return self.submit(fn, *args).result()
+
+    def query(self, fn, *args, default = None):
+        # for sync callers on the event loop: waits only 'wait' seconds, then
+        # returns 'default'. fn still runs later, in order with the others
+
+        future = self.submit(fn, *args)
+
+        try:
+            return future.result(self.wait)
+        except concurrent.futures.TimeoutError:
+            self.log.warning("Database '%s' busy, not waiting for the result", self.path)
+            future.add_done_callback(self.check)
+            return default
+
+    # --------------------------------------------------------------------------
+    # close
+    # --------------------------------------------------------------------------
+
+    def close(self):
+        # statements issued so far are completed
+
+        if self.executor is not None:
+            self.executor.shutdown(wait = True)
+            self.executor = None
+
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -10,15 +10,48 @@
 
 import logging
 import configparser
+import contextlib
 import os
 import sys
 import json
 import asyncio
+import contextvars
+import signal
+import socket
+import time
 
-from abc import ABCMeta, abstractmethod
+from abc import ABCMeta
 
+from hss_skill import capture
 from hss_skill import logger
+from hss_skill import httpclient
+from hss_skill import offload
+from hss_skill import profiler
+from hss_skill import routing
 from hss_skill import rpc
+from hss_skill import session
+from hss_skill import slots
+from hss_skill import stats
+from hss_skill import timers
+from hss_skill import watcher
+
+from hss_skill.request import Request
+
+# name of the timer used by BaseSkill.timer/cancel_timer
+
+DEFAULT_TIMER = "default"
+
+# name of the timer writing the stats file
+
+STATS_TIMER = "hss:stats"
+
+# marks lazily loaded attributes which were not loaded yet
+
+NOT_LOADED = object()
+
+# language of the request being handled (answers default to it)
+
+current_language = contextvars.ContextVar("hss_current_language", default = None)
 
 # -----------------------------------------------------------------------------
 # class Skill (wrapper for loaded skills)
@@ -27,25 +60,46 @@ from hss_skill import rpc
 
 class BaseSkill(metaclass=ABCMeta):
 
+    # intent name -> routes registered with @routing.intent (built per subclass)
+
+    routes = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.routes = routing.build_routes(cls)
+
     # --------------------------------------------------------------------------
     # ctor
     # --------------------------------------------------------------------------
 
     def __init__(self):
-        logger.Logger.static_init(None)
+        init_started = time.perf_counter()
 
         # variables
 
         self.args = self.parse_args()
-        self.config = None
         self.debug = True if "debug" in self.args else False
         self.develop = True if "develop" in self.args else False
-        self.timer_task = None
-        self.default_language = None
-        self.slot_dictionary = None
+        self.startup_timings = {}
+        self.intent_list = None
+        self.rpc = None
+        self.rpc_client = None
+        self.tracer = None
+        self.stats = None
+        self.watchdog = None
+        self.watcher = None
+        self._http = None
+        self.capture = None
+        self.reload_lock = None
+        self.worker = None
+        self.shared_socket = None
+        self.draining = False
+        self.active_intents = {}
         self.name = self.args["skill-name"]
-        self.port = int(self.args["port"])
+        self.port = int(self.args["port"]) if "port" in self.args else None
         self.parent_port = int(self.args["parent-port"]) if "parent-port" in self.args else None
+        self.socket_path = self.args["socket"] if "socket" in self.args else None
+        self.parent_socket_path = self.args["parent-socket"] if "parent-socket" in self.args else None
 
         # setup logger
 
@@ -54,58 +108,245 @@ class BaseSkill(metaclass=ABCMeta):
         # determine absolute file paths for config.ini and skill.json
 
         try:
-            root_path = os.path.abspath(sys.modules['__main__'].__file__).replace("main.py", "")
+            if "skill-dir" in self.args:
+                root_path = os.path.abspath(self.args["skill-dir"])
+            else:
+                root_path = os.path.abspath(sys.modules['__main__'].__file__).replace("main.py", "")
+            self.root_path = root_path
             self.config_path = os.path.join(root_path, "config.ini")
             self.skill_json_path = os.path.join(root_path, "skill.json")
         except Exception as e:
-            self.log.error("Setting config path failed ({})".format(e))
+            self.log.error("Setting config path failed (%s)", e)
 
-        # open config.ini, if present
+        # config.ini, skill.json and the default language are loaded once, on
+        # first access: config.ini right below by the runtime options, skill.json
+        # by serve(). slot dictionaries are loaded off the event loop (see
+        # load_slot_dictionary)
 
-        if os.path.exists(self.config_path) and os.path.isfile(self.config_path):
-            self.config = configparser.ConfigParser()
-            self.config.read(self.config_path)
+        self._config = NOT_LOADED
+        self._skill_json = NOT_LOADED
+        self._default_language = NOT_LOADED
 
-            # get language from config.ini
+        # logging (written by a background thread unless disabled)
 
-            if "skill" in self.config and "language" in self.config["skill"]:
-                self.default_language = self.config["skill"]["language"]
+        log_file = self.get_option("log_file", "")
 
-        # open skill.json (must be present)
+        logger.Logger.static_init(os.path.join(root_path, log_file) if log_file else None,
+                                  level = logging.DEBUG if self.debug else logging.INFO,
+                                  queued = self.get_option("log_queue", True),
+                                  max_bytes = self.get_option("log_max_bytes", 0),
+                                  backup_count = self.get_option("log_backups", 3),
+                                  json_lines = self.get_option("log_json", False))
 
-        with open(self.skill_json_path) as json_file:
-            self.skill_json = json.load(json_file)
+        # slot dictionaries of all languages, each loaded on first use
 
-        # get default language from skill.json (if not configured in config.ini)
+        self.slot_index = slots.SlotIndex(root_path,
+                                          use_cache = self.get_option("slot_cache", True),
+                                          normalized = self.get_option("slot_normalize", False))
 
-        if "language" in self.skill_json and not self.default_language:
-            self.default_language = self.skill_json["language"]
+        # languages of sites (site:lang, ...), for requests without language
 
-            if isinstance(self.default_language, list):
-                self.default_language = self.default_language[0]
+        self.site_languages = {}
 
-        # fall back to english if no language at all available
+        for entry in self.get_option("site_languages", "").split(","):
+            if ":" in entry:
+                site_id, lang = entry.split(":", 1)
+                self.site_languages[site_id.strip()] = lang.strip()
 
-        if not self.default_language:
-            self.default_language = "en_GB"
+        # server -> skill commands
 
-        # build slot dictionary for current language, if present
-        # (map slotText -> slotIdent)
+        self.commands = {
+            "get_intentlist": self.get_intentlist,
+            "handle": self.on_request,
+            "get_stats": self.get_stats,
+            "session_ended": self.end_session,
+            "profile_start": self.profile_start,
+            "profile_stop": self.profile_stop,
+            "profile_slow": self.profile_slow
+        }
 
-        slot_dict_filename = "slotsdict.{}.json".format(self.default_language).lower()
-        slot_dict_filepath = os.path.join(root_path, slot_dict_filename)
+        # number of worker processes (see supervise)
 
-        if os.path.exists(slot_dict_filepath) and os.path.isfile(slot_dict_filepath):
-            slotdict_json = None
+        self.workers = max(1, self.get_option("workers", 1))
 
-            with open(slot_dict_filepath) as json_file:
-                try:
-                    slotdict_json = json.load(json_file)
+        # timer scheduler, optionally persisting timers across restarts. worker
+        # processes share timers and sessions through a sqlite database
 
-                    self.slot_dictionary = { k: {v: key for key, values in sub_dict.items() for v in values}
-                                                for k, sub_dict in slotdict_json.items() }
-                except Exception as e:
-                    self.log.warning("Failed to open '{}' ({})".format(slot_dict_filepath, e))
+        timer_store = self.get_option("timer_store", "")
+        session_store = self.get_option("session_store", "")
+        shared = self.workers > 1
+
+        if shared:
+            shared_store = os.path.join(root_path, self.get_option("shared_store", "shared.sqlite"))
+
+            if timer_store:
+                self.log.warning("Option 'timer_store' is ignored with multiple workers, using '%s'", shared_store)
+
+            self.timers = timers.Scheduler(self, timers.SqliteTimerStore(shared_store))
+            session_path = os.path.join(root_path, session_store) if session_store else shared_store
+        else:
+            self.timers = timers.Scheduler(self, timers.JsonTimerStore(os.path.join(root_path, timer_store)) if timer_store else None)
+            session_path = os.path.join(root_path, session_store) if session_store else None
+
+        # per-session state, evicted when idle (optionally stored in sqlite)
+
+        self.sessions = session.SessionStore(ttl = self.get_option("session_ttl", 300.0),
+                                             max_entries = self.get_option("session_max", 1000),
+                                             backend = session.SqliteBackend(session_path) if session_path else None,
+                                             scheduler = self.timers,
+                                             sweep_interval = self.get_option("session_sweep_interval", 60.0),
+                                             shared = shared)
+
+        # pools for blocking (thread) and CPU-heavy (process) code, sync
+        # handlers are run on the thread pool
+
+        self.offload = offload.Offloader(threads = self.get_option("threads", 0),
+                                         processes = self.get_option("processes", 0))
+
+        self.handle_is_async = asyncio.iscoroutinefunction(self.handle)
+
+        # on-demand profiling of intent handling (see profile_start)
+
+        self.profiler = profiler.Profiler(os.path.join(root_path, self.get_option("profile_dir", "profiles")),
+                                          interval = self.get_option("profile_interval_ms", 5) / 1000,
+                                          slow_ms = self.get_option("profile_slow_ms", 0))
+
+        # runtime metrics (disabled by default, costs nothing when disabled)
+
+        if self.get_option("stats", False):
+            self.stats = stats.Stats()
+
+        self.startup_timings["init"] = time.perf_counter() - init_started
+
+    # --------------------------------------------------------------------------
+    # config (lazy, None if there is no config.ini)
+    # --------------------------------------------------------------------------
+
+    @property
+    def config(self):
+        if self._config is NOT_LOADED:
+            started = time.perf_counter()
+            self._config = self.read_config()
+            self.startup_timings["config"] = time.perf_counter() - started
+
+        return self._config
+
+    @config.setter
+    def config(self, value):
+        self._config = value
+
+    # --------------------------------------------------------------------------
+    # read_config
+    # --------------------------------------------------------------------------
+
+    def read_config(self):
+        if not os.path.exists(self.config_path) or not os.path.isfile(self.config_path):
+            return None
+
+        config = configparser.ConfigParser()
+        config.read(self.config_path)
+
+        return config
+
+    # --------------------------------------------------------------------------
+    # skill_json (lazy, must be present)
+    # --------------------------------------------------------------------------
+
+    @property
+    def skill_json(self):
+        if self._skill_json is NOT_LOADED:
+            started = time.perf_counter()
+
+            with open(self.skill_json_path) as json_file:
+                self._skill_json = json.load(json_file)
+
+            self.startup_timings["skill.json"] = time.perf_counter() - started
+
+        return self._skill_json
+
+    @skill_json.setter
+    def skill_json(self, value):
+        self._skill_json = value
+
+    # --------------------------------------------------------------------------
+    # default_language (lazy)
+    # --------------------------------------------------------------------------
+
+    @property
+    def default_language(self):
+        if self._default_language is NOT_LOADED:
+            language = None
+
+            # config.ini first, then skill.json, then english
+
+            if self.config and "skill" in self.config and "language" in self.config["skill"]:
+                language = self.config["skill"]["language"]
+
+            if not language and "language" in self.skill_json:
+                language = self.skill_json["language"]
+
+                if isinstance(language, list):
+                    language = language[0]
+
+            self._default_language = language or "en_GB"
+
+        return self._default_language
+
+    @default_language.setter
+    def default_language(self, value):
+        self._default_language = value
+
+    # --------------------------------------------------------------------------
+    # slot_dictionary (map slotText -> slotIdent for the default language)
+    # --------------------------------------------------------------------------
+
+    @property
+    def slot_dictionary(self):
+        return self.slot_index.get(self.default_language)
+
+    @slot_dictionary.setter
+    def slot_dictionary(self, value):
+        self.slot_index.set(self.default_language, value)
+
+    # --------------------------------------------------------------------------
+    # http (pooled outbound HTTP client, created on first use)
+    # --------------------------------------------------------------------------
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = httpclient.HttpClient(timeout = self.get_option("http_timeout", 10.0),
+                                               connect_timeout = self.get_option("http_connect_timeout", 5.0),
+                                               max_per_host = self.get_option("http_max_per_host", 4),
+                                               idle_timeout = self.get_option("http_idle_timeout", 30.0),
+                                               retries = self.get_option("http_retries", 2),
+                                               dns_ttl = self.get_option("http_dns_ttl", 300.0),
+                                               stats = self.stats)
+
+        return self._http
+
+    # --------------------------------------------------------------------------
+    # request_language
+    # --------------------------------------------------------------------------
+
+    def request_language(self, request):
+        # language of the request, the site's language or the default language
+
+        lang = request.get("lang")
+
+        if not lang and self.site_languages:
+            lang = self.site_languages.get(request.get("siteId"))
+
+        return lang or self.default_language
+
+    # --------------------------------------------------------------------------
+    # get_language
+    # --------------------------------------------------------------------------
+
+    def get_language(self):
+        # language of the request being handled, the default language otherwise
+
+        return current_language.get() or self.default_language
 
     # --------------------------------------------------------------------------
     # parse_args
@@ -126,6 +367,39 @@ class BaseSkill(metaclass=ABCMeta):
 
         return {kv[0]: kv[1] for kv in list(map(_getArg, sys.argv)) if kv != None}
 
+    # --------------------------------------------------------------------------
+    # get_option
+    # --------------------------------------------------------------------------
+
+    def get_option(self, name, default = None):
+        # command line (--name=value) first, then config.ini section 'hss'
+
+        value = None
+
+        if name in self.args:
+            value = self.args[name]
+
+            if value is None and isinstance(default, bool):
+                return True
+        elif self.config and "hss" in self.config and name in self.config["hss"]:
+            value = self.config["hss"][name]
+
+        if value is None:
+            return default
+
+        try:
+            if isinstance(default, bool):
+                return value.lower() in ("1", "true", "yes", "on")
+            if isinstance(default, int):
+                return int(value)
+            if isinstance(default, float):
+                return float(value)
+        except ValueError as e:
+            self.log.error("Invalid value '%s' for option '%s', using default (%s)", value, name, e)
+            return default
+
+        return value
+
     # --------------------------------------------------------------------------
     # run
     # --------------------------------------------------------------------------
@@ -135,163 +409,791 @@ class BaseSkill(metaclass=ABCMeta):
             print("WARNING: Not starting develop mode (--develop was given)")
             return
 
-        self.rpc = rpc.RpcServer(self.port, self)
-        self.rpc_client = rpc.RpcClient(self.parent_port)
+        if self.workers > 1:
+            return self.supervise()
+
+        self.run_loop()
 
+    # --------------------------------------------------------------------------
+    # run_loop
+    # --------------------------------------------------------------------------
+
+    def run_loop(self):
         try:
             loop = asyncio.get_event_loop()
-            loop.run_until_complete(self.rpc_client.connect())
-            loop.run_until_complete(self.rpc.start())
-        except KeyboardInterrupt:
+            loop.run_until_complete(self.serve())
+        except (KeyboardInterrupt, asyncio.CancelledError):
             pass
         except Exception as e:
             if e and len(str(e)):
-                self.log.error("Got exception: {}".format(e))
+                self.log.error("Got exception: %s", e)
         finally:
+            loop.run_until_complete(self.shutdown())
+
             self.log.info("Bye.")
 
     # --------------------------------------------------------------------------
-    # timer
+    # serve (async)
     # --------------------------------------------------------------------------
 
-    async def timer(self, timeout, callback, user = None, reschedule = False):
-        if self.timer_task and not reschedule:
-            self.log.error("Cannot schedule timer, timer already active!")
+    async def serve(self):
+        started = time.perf_counter()
+        reconnect = self.get_option("reconnect", False)
+
+        # check the routing table against skill.json
+
+        routing.check_routes(self.routes, self.skill_json.get("intents") or [],
+                             type(self).handle is not BaseSkill.handle, self.log)
+
+        # recording of all RPC frames (for python -m hss_skill.capture replay)
+
+        capture_file = self.get_option("capture_file", "")
+
+        if capture_file:
+            if self.worker is not None:
+                capture_file = "{}.{}".format(capture_file, self.worker)
+
+            self.capture = capture.Capture(os.path.join(self.root_path, capture_file),
+                                           max_bytes = self.get_option("capture_max_bytes", 64 * 1024 * 1024),
+                                           backups = self.get_option("capture_backups", 3))
+
+        self.rpc = rpc.RpcServer(self.port, self,
+                                 concurrency = self.get_option("concurrency", 1),
+                                 path = self.socket_path,
+                                 stop_on_disconnect = not reconnect and self.worker is None,
+                                 queue_size = self.get_option("inbound_queue_size", 100),
+                                 max_age = self.get_option("request_max_age", 0.0),
+                                 sock = self.shared_socket,
+                                 reuse_port = self.worker is not None and self.shared_socket is None)
+
+        # SIGTERM finishes requests in progress before exiting
+
+        try:
+            asyncio.get_event_loop().add_signal_handler(signal.SIGTERM, self.drain)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+        self.rpc_client = rpc.RpcClient(self.parent_port,
+                                        timeout = self.get_option("rpc_timeout", 10.0),
+                                        path = self.parent_socket_path,
+                                        framing = self.get_option("framing", rpc.FRAMING_LINE),
+                                        codec = self.get_option("codec", rpc.JsonCodec.name),
+                                        reconnect = reconnect,
+                                        reconnect_delay = self.get_option("reconnect_delay", 0.5),
+                                        reconnect_max_delay = self.get_option("reconnect_max_delay", 30.0),
+                                        queue_size = self.get_option("queue_size", 100),
+                                        queue_policy = self.get_option("queue_policy", rpc.QUEUE_DROP_OLDEST),
+                                        queue_max_age = self.get_option("queue_max_age", 30.0),
+                                        state_callback = self.on_connection_changed,
+                                        features = self.get_option("rpc_batch", False),
+                                        batch_window = self.get_option("rpc_batch_window_ms", 0) / 1000,
+                                        negotiate_timeout = self.get_option("negotiate_timeout", 1.0))
+
+        self.rpc_client.stats = self.stats
+        self.rpc_client.capture = self.capture
+
+        # run_in_executor(None, ...) shall use the configured pool as well
+
+        asyncio.get_event_loop().set_default_executor(self.offload.get_thread_pool())
+
+        watchdog_ms = self.get_option("watchdog_ms", 0)
+
+        if watchdog_ms > 0:
+            self.watchdog = offload.Watchdog(watchdog_ms, self.describe_active_intents)
+            self.watchdog.start()
+
+        await self.rpc_client.connect()
+        await self.restore_timers()
+        self.sessions.start()
+        self.schedule_stats_dump()
+
+        if self.get_option("hot_reload", False):
+            self.watcher = watcher.Watcher(self.root_path, self.is_reloadable, self.reload_files,
+                                           interval = self.get_option("hot_reload_interval", 2.0))
+            self.watcher.start()
+
+        # parsing the slot dictionary would otherwise delay the first request
+
+        await self.load_slot_dictionary(self.default_language)
+
+        self.startup_timings["serve"] = time.perf_counter() - started
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Startup timings: %s", ", ".join("{} {:.1f}ms".format(name, seconds * 1000)
+                                                          for name, seconds in self.startup_timings.items()))
+
+        await self.rpc.start()
+
+    # --------------------------------------------------------------------------
+    # shutdown (async)
+    # --------------------------------------------------------------------------
+
+    async def shutdown(self):
+        # every step is run, even if an earlier one failed
+
+        steps = []
+
+        if self.draining and self.rpc:
+            steps.append(("drain requests", lambda: self.rpc.drain(self.get_option("drain_timeout", 10.0))))
+
+        steps += [("close timers", self.timers.close), ("close sessions", self.sessions.close)]
+
+        if self.watchdog:
+            steps.append(("stop watchdog", self.watchdog.stop))
+
+        if self.watcher:
+            steps.append(("stop watcher", self.watcher.stop))
+
+        steps += [("close pools", self.offload.close), ("close profiler", self.profiler.close)]
+
+        if self._http:
+            steps.append(("close HTTP client", self._http.close))
+
+        if self.rpc_client:
+            steps.append(("disconnect", self.rpc_client.disconnect))
+
+        if self.capture:
+            steps.append(("close capture", self.capture.close))
+
+        for name, step in steps:
+            try:
+                res = step()
+
+                if asyncio.iscoroutine(res):
+                    await res
+            except Exception as e:
+                self.log.error("Failed to %s on shutdown (%s)", name, e)
+
+    # --------------------------------------------------------------------------
+    # drain
+    # --------------------------------------------------------------------------
+
+    def drain(self):
+        # stop accepting requests, shutdown() waits for those in progress
+
+        if self.draining:
             return
 
-        if self.timer_task:
-            await self.cancel_timer(strict = False)
+        self.log.info("Received SIGTERM, stopping ...")
+        self.draining = True
+
+        if self.rpc:
+            self.rpc.close()
+
+    # --------------------------------------------------------------------------
+    # listen_socket
+    # --------------------------------------------------------------------------
+
+    def listen_socket(self):
+        # listening socket shared by all workers, None if every worker binds
+        # the port itself (SO_REUSEPORT, the kernel spreads the connections)
+
+        if self.socket_path and rpc.unix_sockets_supported():
+            rpc.remove_stale_socket(self.socket_path)
 
-        self.log.debug("Timer scheduled with delay of {} seconds".format(timeout))
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(self.socket_path)
+        elif hasattr(socket, "SO_REUSEPORT"):
+            return None
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("127.0.0.1", self.port))
 
-        loop = asyncio.get_event_loop()
+        sock.listen(100)
 
-        self.timer_task = loop.create_task(self.timer_executor(timeout, callback, user))
+        return sock
 
     # --------------------------------------------------------------------------
-    # cancel timer (async)
+    # supervise
     # --------------------------------------------------------------------------
 
-    async def cancel_timer(self, strict = True):
-        if not self.timer_task:
-            if strict:
-                self.log.error("Can't cancel timer, no timer is active!")
+    def supervise(self):
+        # forks the workers and restarts them when they exit. SIGTERM/SIGINT
+        # are passed on to the workers, which finish their requests and exit
+
+        try:
+            self.shared_socket = self.listen_socket()
+        except OSError as e:
+            self.log.error("Failed to listen for RPC connections (%s)", e)
             return
 
-        self.timer_task.cancel()
+        drain_timeout = self.get_option("drain_timeout", 10.0)
+        reconnect = self.get_option("reconnect", False)
+        parent = os.getppid()
+        children = {}
+        restarts = []
+        failures = [0] * self.workers
+        stopping = False
+        kill_deadline = None
+
+        def on_signal(signum, frame):
+            nonlocal stopping
+
+            if not stopping:
+                self.log.info("Stopping %s worker(s) ...", len(children))
+                stopping = True
+
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+
+        signal.signal(signal.SIGTERM, on_signal)
+        signal.signal(signal.SIGINT, on_signal)
+
+        for i in range(self.workers):
+            children[self.spawn_worker(i)] = (i, time.monotonic())
+
+        self.log.info("Started %s workers", self.workers)
+
+        while children or (restarts and not stopping):
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid, status = 0, 0
+
+            now = time.monotonic()
+
+            if pid in children:
+                index, started = children.pop(pid)
+
+                if not stopping:
+                    # back off when a worker keeps crashing right after its start
+
+                    failures[index] = failures[index] + 1 if now - started < 5.0 else 0
+                    delay = min(30.0, 0.5 * 2 ** (failures[index] - 1)) if failures[index] else 0.0
+
+                    self.log.warning("Worker %s exited with status %s, restarting in %.1fs", index,
+                                     os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status), delay)
+                    restarts.append((now + delay, index))
+
+                continue
+
+            # workers serve several connections, so instead of stopping on a
+            # disconnect, everything stops when the skill server (parent) exits
+
+            if not stopping and not reconnect and os.getppid() != parent:
+                self.log.info("Skill server exited")
+                on_signal(signal.SIGTERM, None)
+
+            if stopping:
+                if kill_deadline is None:
+                    kill_deadline = now + drain_timeout + 5.0
+                elif now > kill_deadline:
+                    self.log.warning("Killing %s worker(s) which did not stop in time", len(children))
+
+                    for pid in children:
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except OSError:
+                            pass
+
+                    kill_deadline = float("inf")
+            else:
+                for entry in [entry for entry in restarts if entry[0] <= now]:
+                    restarts.remove(entry)
+                    children[self.spawn_worker(entry[1])] = (entry[1], now)
+
+            time.sleep(0.1)
+
+        if self.shared_socket is not None:
+            self.shared_socket.close()
+
+            if self.socket_path and self.shared_socket.family == socket.AF_UNIX:
+                rpc.remove_stale_socket(self.socket_path)
+
+        self.log.info("Bye.")
+
+    # --------------------------------------------------------------------------
+    # spawn_worker
+    # --------------------------------------------------------------------------
+
+    def spawn_worker(self, index):
+        # signals are blocked around fork(), so the child never runs the
+        # supervisor's handlers
+
+        signals = {signal.SIGTERM, signal.SIGINT}
+        signal.pthread_sigmask(signal.SIG_BLOCK, signals)
 
         try:
-            await self.timer_task
-        except asyncio.CancelledError as e:
-            pass
+            pid = os.fork()
+        except OSError as e:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+            self.log.error("Failed to start worker %s (%s)", index, e)
+            raise
+
+        if pid:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
+            return pid
+
+        code = 0
+
+        try:
+            # the supervisor stops the workers with SIGTERM, Ctrl-C is handled there
+
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, signals)
 
-        self.timer_task = None
+            logger.Logger.after_fork(index)
+            asyncio.set_event_loop(asyncio.new_event_loop())
 
-        self.log.debug("Timer cancelled")
+            self.worker = index
+            self.log = logging.getLogger("skill:{}:{}".format(self.name, index))
+            self.run_loop()
+        except BaseException:
+            code = 1
+        finally:
+            logger.Logger.static_stop()
+            os._exit(code)
 
     # --------------------------------------------------------------------------
-    # timer_fn (async)
+    # run_in_thread / run_in_process (async)
     # --------------------------------------------------------------------------
 
-    async def timer_executor(self, timeout, callback, user):
-        await asyncio.sleep(timeout)
+    async def run_in_thread(self, fn, *args, **kwargs):
+        if self.profiler.active:
+            fn = self.profiler.wrap_thread(fn)
 
-        self.timer_task = None
+        return await self.offload.run_in_thread(fn, *args, **kwargs)
 
-        if user:
-            await callback(user)
-        else:
-            await callback()
+    async def run_in_process(self, fn, *args, **kwargs):
+        return await self.offload.run_in_process(fn, *args, **kwargs)
+
+    # --------------------------------------------------------------------------
+    # describe_active_intents (called from the watchdog thread)
+    # --------------------------------------------------------------------------
+
+    def describe_active_intents(self):
+        return ", ".join("{} x{}".format(name, n) for name, n in list(self.active_intents.items()))
+
+    # --------------------------------------------------------------------------
+    # is_reloadable
+    # --------------------------------------------------------------------------
+
+    def is_reloadable(self, name):
+        return name == "config.ini" or (name.startswith("slotsdict.") and name.endswith(".json"))
+
+    # --------------------------------------------------------------------------
+    # reload_files (async)
+    # --------------------------------------------------------------------------
+
+    async def reload_files(self, names):
+        # files are parsed on the thread pool and swapped in when complete, so
+        # requests see either the previous or the new version. broken files
+        # keep the previous version
+
+        if self.reload_lock is None:
+            self.reload_lock = asyncio.Lock()
+
+        async with self.reload_lock:
+            reloaded = []
+
+            for name in sorted(names):
+                try:
+                    if name == "config.ini":
+                        await self.reload_config()
+                    elif not await self.reload_slot_dictionary(name):
+                        continue
+                except Exception as e:
+                    self.log.warning("Failed to reload '%s', keeping the previous version (%s)", name, e)
+                    continue
+
+                self.log.info("Reloaded '%s'", name)
+                reloaded.append(name)
+
+            if reloaded:
+                await self.on_config_reloaded(reloaded)
+
+    # --------------------------------------------------------------------------
+    # reload_config (async)
+    # --------------------------------------------------------------------------
+
+    async def reload_config(self):
+        previous = self._config if self._config is not NOT_LOADED else None
+        config = await self.run_in_thread(self.read_config)
+
+        def language(cfg):
+            return cfg["skill"].get("language") if cfg and "skill" in cfg else None
+
+        self._config = config
+
+        if language(config) != language(previous):
+            self._default_language = NOT_LOADED
+
+    # --------------------------------------------------------------------------
+    # load_slot_dictionary (async)
+    # --------------------------------------------------------------------------
+
+    async def load_slot_dictionary(self, language):
+        # loads the slot dictionary of a language on the thread pool, unless
+        # already loaded
+
+        if language.lower() in self.slot_index.languages:
+            return
+
+        started = time.perf_counter()
+        index = await self.run_in_thread(self.slot_index.build, language)
+
+        if language.lower() not in self.slot_index.languages:
+            self.slot_index.set(language, index)
+            self.startup_timings["slots:" + language] = time.perf_counter() - started
+
+    # --------------------------------------------------------------------------
+    # reload_slot_dictionary (async)
+    # --------------------------------------------------------------------------
+
+    async def reload_slot_dictionary(self, name):
+        # only languages in use are reloaded, others are loaded on first use
+
+        language = name[len("slotsdict."):-len(".json")]
+
+        if language not in self.slot_index.languages:
+            return False
+
+        path = os.path.join(self.root_path, name)
+        index = await self.run_in_thread(self.slot_index.build, language)
+
+        if index is None and os.path.exists(path):
+            raise ValueError("invalid slot dictionary")
+
+        self.slot_index.set(language, index)
+
+        return True
+
+    # --------------------------------------------------------------------------
+    # on_config_reloaded (async)
+    # --------------------------------------------------------------------------
+
+    async def on_config_reloaded(self, names):
+        # may be overridden by skills, names of the reloaded files
+
+        pass
+
+    # --------------------------------------------------------------------------
+    # on_connection_changed (async)
+    # --------------------------------------------------------------------------
+
+    async def on_connection_changed(self, connected):
+        # may be overridden by skills to react on (re-)connects to the server
+
+        pass
+
+    # --------------------------------------------------------------------------
+    # schedule_stats_dump
+    # --------------------------------------------------------------------------
+
+    def schedule_stats_dump(self):
+        stats_file = self.get_option("stats_file", "")
+
+        if not self.stats or not stats_file:
+            return
+
+        # one file per worker
+
+        if self.worker is not None:
+            stats_file = "{}.{}".format(stats_file, self.worker)
+
+        async def dump():
+            self.stats.dump(os.path.join(self.root_path, stats_file))
+            self.schedule_stats_dump()
+
+        self.timers.schedule(STATS_TIMER, self.get_option("stats_interval", 60.0), dump, replace = True, persist = False)
+
+    # --------------------------------------------------------------------------
+    # restore_timers (async)
+    # --------------------------------------------------------------------------
+
+    async def restore_timers(self):
+        self.timers.restore()
+
+    # --------------------------------------------------------------------------
+    # timer (async)
+    # --------------------------------------------------------------------------
+
+    async def timer(self, timeout, callback, user = None, reschedule = False):
+        if DEFAULT_TIMER in self.timers and not reschedule:
+            self.log.error("Cannot schedule timer, timer already active!")
+            return
+
+        self.timers.schedule(DEFAULT_TIMER, timeout, callback, user = user, replace = True)
+
+    # --------------------------------------------------------------------------
+    # cancel timer (async)
+    # --------------------------------------------------------------------------
+
+    async def cancel_timer(self, strict = True):
+        if not self.timers.cancel(DEFAULT_TIMER) and strict:
+            self.log.error("Can't cancel timer, no timer is active!")
+
+    # --------------------------------------------------------------------------
+    # session
+    # --------------------------------------------------------------------------
+
+    def session(self, session_id):
+        return self.sessions.get(session_id)
+
+    # --------------------------------------------------------------------------
+    # on_session_ended (async)
+    # --------------------------------------------------------------------------
+
+    async def on_session_ended(self, session_id):
+        # may be overridden by skills, the session's state is already gone
+
+        pass
 
     # --------------------------------------------------------------------------
     # dispatch_rpc_request
     # --------------------------------------------------------------------------
 
     async def dispatch_rpc_request(self, command, payload):
-        if command == 'get_intentlist':
-            return await self.get_intentlist()
+        handler = self.commands.get(command)
+
+        if not handler:
+            self.log.error("Received unknown command '%s', must skip", command)
+            return None
+
+        return await handler(payload)
+
+    # --------------------------------------------------------------------------
+    # get_intentlist (async)
+    # --------------------------------------------------------------------------
+
+    async def get_intentlist(self, payload = None):
+        # sent as is, so it is only built once
+
+        if self.intent_list is None:
+            intents = self.skill_json.get("intents") or []
+            self.intent_list = list(intents) + [name for name in self.routes if name not in intents]
 
-        elif command == 'handle':
-            return await self.on_request(payload)
+        return self.intent_list
+
+    # --------------------------------------------------------------------------
+    # get_stats (async)
+    # --------------------------------------------------------------------------
+
+    async def get_stats(self, payload = None):
+        return self.stats.snapshot() if self.stats else { "enabled": False }
+
+    # --------------------------------------------------------------------------
+    # profile_start / profile_stop / profile_slow (async)
+    # --------------------------------------------------------------------------
+
+    async def profile_start(self, payload = None):
+        # payload: mode ('sample' or 'cprofile'), requests, seconds
+
+        payload = payload or {}
+
+        return self.profiler.start(mode = payload.get("mode", profiler.MODE_SAMPLE),
+                                   requests = payload.get("requests", 0),
+                                   seconds = payload.get("seconds", 0.0))
+
+    async def profile_stop(self, payload = None):
+        profile_session = self.profiler.stop()
+
+        if profile_session is None:
+            return { "error": "profiling not active" }
+
+        files = await self.run_in_thread(self.profiler.write, profile_session)
+
+        return { "directory": self.profiler.directory, "files": files,
+                 "requests": profile_session.requests, "skipped": profile_session.skipped }
+
+    async def profile_slow(self, payload = None):
+        # payload: threshold_ms (0 disables)
+
+        self.profiler.slow_ms = (payload or {}).get("threshold_ms", 0)
+
+        return { "threshold_ms": self.profiler.slow_ms }
+
+    # --------------------------------------------------------------------------
+    # end_session (async)
+    # --------------------------------------------------------------------------
+
+    async def end_session(self, payload):
+        session_id = payload.get("sessionId") if payload else None
+
+        if session_id:
+            self.sessions.end(session_id)
+            await self.on_session_ended(session_id)
+
+        return True
 
     # --------------------------------------------------------------------------
     # on_request
     # --------------------------------------------------------------------------
 
     async def on_request(self, request):
-        def slot_value(name, rawvalue):
-            if not self.slot_dictionary:
-                return rawvalue
+        # answers default to the request's language while it is handled
 
-            if not name in self.slot_dictionary:
-                return rawvalue
+        language = self.request_language(request)
+        token = current_language.set(language)
+        session_token = logger.request_session.set(request.get("sessionId"))
+        try:
+            await self.sessions.acquire(request.get("sessionId"))
 
-            if not rawvalue in self.slot_dictionary[name]:
-                return rawvalue
+            return await self.process_request(request, language)
+        finally:
+            await self.sessions.release(request.get("sessionId"))
+            logger.request_session.reset(session_token)
+            current_language.reset(token)
 
-            return self.slot_dictionary[name][rawvalue]
+    # --------------------------------------------------------------------------
+    # process_request
+    # --------------------------------------------------------------------------
 
+    async def process_request(self, request, language):
         if not "intent" in request or not "intentName" in request["intent"]:
             self.log.error("Received message without 'intentName', must skip")
             return False
 
-        # extract common attributes
+        # dictionaries of other languages than the default one are loaded with
+        # their first request
 
-        intent_name = request["intent"]["intentName"]
-        session_id = request["sessionId"] if "sessionId" in request else None
-        site_id = request["siteId"] if "siteId" in request else None
-        slots = request["slots"] if "slots" in request else None
-        slots_dict = {}
-        mapped_slots = {}
+        if language and language.lower() not in self.slot_index.languages:
+            await self.load_slot_dictionary(language)
 
-        # some convenience preparation for slots
+        request = Request(request, language, self.slot_index)
 
-        if slots and len(slots):
-            try:
-                for slot in slots:
-                    if slot["slotName"] in slots_dict:
-                        slots_dict[slot["slotName"]].append(
-                            slot["value"]["value"])
-                    else:
-                        slots_dict[slot["slotName"]] = [slot["value"]["value"]]
+        # runtime metrics (only when enabled)
 
-                    # mapped slots is an additional map which holds the slotIdentifier instead of the raw language specific slot text
-                    # the slotIdentifier is meant to be equal in all languages supported by the skill
+        stats = self.stats
 
-                    if slot["slotName"] in mapped_slots:
-                        mapped_slots[slot["slotName"]].append(
-                            slot_value(slot["entity"], slot["value"]["value"]))
-                    else:
-                        mapped_slots[slot["slotName"]] = [slot_value(slot["entity"], slot["value"]["value"])]
+        if not stats:
+            return await self.dispatch_intent(request)
 
-                # recode single-value slots to literal. keep other slots as list-value
+        started = time.perf_counter()
+        error = True
 
-                for slot in slots_dict:
-                    if len(slots_dict[slot]) == 1:
-                        slots_dict[slot] = slots_dict[slot][0]
+        try:
+            res = await self.dispatch_intent(request)
+            error = False
+            return res
+        finally:
+            stats.record_intent(request.intent_name, time.perf_counter() - started, error)
 
-                for slot in mapped_slots:
-                    if len(mapped_slots[slot]) == 1:
-                        mapped_slots[slot] = mapped_slots[slot][0]
+    # --------------------------------------------------------------------------
+    # handle_request (async)
+    # --------------------------------------------------------------------------
+
+    async def handle_request(self, request):
+        # compatibility adapter, builds the slot dicts and calls the intent's
+        # route or handle(). may be overridden by skills working on the Request
+        # object directly, whose slots are only built when accessed
+
+        tracer = self.tracer
+
+        if tracer:
+            started = time.perf_counter()
+
+        try:
+            slots = request.slots
+            mapped_slots = request.mapped_slots
+        except Exception as e:
+            self.log.error(
+                "Failed to parse slots in JSON request, must skip request (%s)", e)
+            return False
+
+        if not tracer:
+            return await self.call_intent(request.raw, request.session_id, request.site_id, request.intent_name,
+                                          slots, mapped_slots)
+
+        # stage timings (e.g. for hss_skill.bench): slot mapping and the intent's
+        # handler are separate stages
+
+        tracer("slots", time.perf_counter() - started)
+        started = time.perf_counter()
+
+        try:
+            return await self.call_intent(request.raw, request.session_id, request.site_id, request.intent_name,
+                                          slots, mapped_slots)
+        finally:
+            tracer("handle", time.perf_counter() - started)
+
+    # --------------------------------------------------------------------------
+    # busy_response
+    # --------------------------------------------------------------------------
+
+    def busy_response(self, request):
+        # answer for requests shed under load (must be cheap). may be overridden
+        # by skills, returning None sends no response at all. without busy_text,
+        # nothing is sent, so the skill server's own timeout handling applies
+        # (an empty answer would end the session without any feedback)
+
+        text = self.get_option("busy_text", "")
+
+        if not text:
+            return None
+
+        return self.answer(request.get("sessionId"), request.get("siteId"), text, self.request_language(request))
+
+    # --------------------------------------------------------------------------
+    # dispatch_intent (async)
+    # --------------------------------------------------------------------------
+
+    async def dispatch_intent(self, request):
+        if self.profiler.active:
+            call = self.profiler.run(request.intent_name, self.handle_request, request)
+        else:
+            call = self.handle_request(request)
+
+        if not self.watchdog:
+            return await call
+
+        # remember what is being handled, so the watchdog can report it
+
+        intent_name = request.intent_name
+        self.active_intents[intent_name] = self.active_intents.get(intent_name, 0) + 1
+
+        try:
+            return await call
+        finally:
+            if self.active_intents[intent_name] == 1:
+                del self.active_intents[intent_name]
+            else:
+                self.active_intents[intent_name] -= 1
+
+    # --------------------------------------------------------------------------
+    # call_intent (async)
+    # --------------------------------------------------------------------------
+
+    async def call_intent(self, request, session_id, site_id, intent_name, slots, mapped_slots):
+        # first matching route registered with @intent, handle() otherwise
+
+        for route in self.routes.get(intent_name, ()):
+            if not route.matches(slots):
+                continue
+
+            try:
+                return await route.call(self, request, session_id, site_id, intent_name, slots, mapped_slots)
+            except asyncio.TimeoutError:
+                self.log.error("Handling intent '%s' timed out after %ss", intent_name, route.timeout)
+
+                if self.stats:
+                    self.stats.count("timeouts")
 
-            except Exception as e:
-                self.log.error(
-                    "Failed to parse slots in JSON request, must skip request ({})".format(e))
                 return False
 
-        return await self.handle(request, session_id, site_id, intent_name, slots_dict, mapped_slots)
+        if not self.handle_is_async:
+            return await self.run_in_thread(self.handle, request, session_id, site_id, intent_name, slots, mapped_slots)
+
+        return await self.handle(request, session_id, site_id, intent_name, slots, mapped_slots)
 
     # -------------------------------------------------------------------------
     # server -> skill RPC
     # -------------------------------------------------------------------------
 
     # --------------------------------------------------------------------------
-    # handle (abstract)
+    # handle (async)
     # --------------------------------------------------------------------------
 
-    @abstractmethod
     async def handle(self, request, session_id, site_id, intent_name, slots, mapped_slots):
-        pass
+        # implemented by skills not (only) using @intent routes
+
+        self.log.error("No handler for intent '%s'", intent_name)
+
+        return False
 
     # -------------------------------------------------------------------------
     # handle response helpers
@@ -306,7 +1208,7 @@ class BaseSkill(metaclass=ABCMeta):
                 "sessionId": session_id,
                 "siteId": site_id,
                 "text": response_message,
-                "lang": lang if lang else self.default_language
+                "lang": lang if lang else self.get_language()
             }
 
     # -------------------------------------------------------------------------
@@ -318,7 +1220,7 @@ class BaseSkill(metaclass=ABCMeta):
                 "sessionId": session_id,
                 "siteId": site_id,
                 "question": question,
-                "lang": lang if lang else self.default_language,
+                "lang": lang if lang else self.get_language(),
                 "intentFilter": intent_filter if intent_filter else None
             }
 
@@ -326,28 +1228,37 @@ class BaseSkill(metaclass=ABCMeta):
     # skill -> server RPC
     # -------------------------------------------------------------------------
 
+    # -------------------------------------------------------------------------
+    # batch
+    # -------------------------------------------------------------------------
+
+    def batch(self):
+        # say/ask calls made together within the context are sent as one batch
+
+        return self.rpc_client.batch() if self.rpc_client else contextlib.nullcontext()
+
     # -------------------------------------------------------------------------
     # say
     # -------------------------------------------------------------------------
 
-    async def say(self, text, siteId = None, lang = None):
-        await self.rpc_client.execute("say",
+    async def say(self, text, siteId = None, lang = None, timeout = None):
+        return await self.rpc_client.execute("say",
                                     {
                                         "text": text,
-                                        "lang": lang if lang else self.default_language,
+                                        "lang": lang if lang else self.get_language(),
                                         "siteId": siteId if siteId else None
-                                    })
+                                    }, timeout = timeout)
 
     # -------------------------------------------------------------------------
     # ask
     # -------------------------------------------------------------------------
 
-    async def ask(self, text, siteId = None, lang = None, intent_filter = None):
-        await self.rpc_client.execute("ask",
+    async def ask(self, text, siteId = None, lang = None, intent_filter = None, timeout = None):
+        return await self.rpc_client.execute("ask",
                                     {
                                         "text": text,
-                                        "lang": lang if lang else self.default_language,
+                                        "lang": lang if lang else self.get_language(),
                                         "siteId": siteId if siteId else None,
                                         "intentFilter": intent_filter if intent_filter else None
-                                    })
+                                    }, timeout = timeout)
 
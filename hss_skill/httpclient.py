@@ -0,0 +1,491 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# httpclient.py
+# -----------------------------------------------------------------------------
+# Minimal asyncio HTTP/1.1 client with keep-alive connection pools per host,
+# a per host concurrency limit, a DNS cache, timeouts and retries of
+# idempotent requests. Standard library only.
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import asyncio
+import collections
+import json
+import logging
+import random
+import socket
+import ssl
+import time
+
+from urllib.parse import urlsplit, urlencode
+
+# -----------------------------------------------------------------------------
+# methods which may be retried (RFC 7231, 4.2.2) and statuses worth a retry
+# -----------------------------------------------------------------------------
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE")
+RETRY_STATUSES = (502, 503, 504)
+
+USER_AGENT = "hss-skill"
+MAX_HEADERS = 100
+
+# -----------------------------------------------------------------------------
+# class HttpError
+# -----------------------------------------------------------------------------
+
+
+class HttpError(Exception):
+    pass
+
+# -----------------------------------------------------------------------------
+# class StaleConnection (reused connection failed before any response byte)
+# -----------------------------------------------------------------------------
+
+
+class StaleConnection(ConnectionError):
+    pass
+
+# -----------------------------------------------------------------------------
+# parse_int
+# -----------------------------------------------------------------------------
+
+
+def parse_int(text, base, name):
+    # malformed numbers in responses fail the request like other protocol errors
+
+    try:
+        value = int(text, base)
+    except ValueError:
+        value = -1
+
+    if value < 0:
+        raise HttpError("malformed {}".format(name))
+
+    return value
+
+# -----------------------------------------------------------------------------
+# class Response
+# -----------------------------------------------------------------------------
+
+
+class Response:
+    __slots__ = ("status", "reason", "headers", "body")
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    @property
+    def ok(self):
+        return 200 <= self.status < 300
+
+    def text(self):
+        content_type = self.headers.get("content-type", "")
+        charset = "utf-8"
+
+        for param in content_type.split(";")[1:]:
+            name, _, value = param.strip().partition("=")
+
+            if name.lower() == "charset" and value:
+                charset = value.strip('"')
+
+        return self.body.decode(charset, errors = "replace")
+
+    def json(self):
+        return json.loads(self.text())
+
+# -----------------------------------------------------------------------------
+# class Connection
+# -----------------------------------------------------------------------------
+
+
+class Connection:
+    __slots__ = ("reader", "writer", "last_used")
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+# -----------------------------------------------------------------------------
+# class HostPool (idle connections and concurrency limit of one host)
+# -----------------------------------------------------------------------------
+
+
+class HostPool:
+    __slots__ = ("idle", "slots")
+
+    def __init__(self, max_connections):
+        self.idle = collections.deque()
+        self.slots = asyncio.Semaphore(max_connections)
+
+# -----------------------------------------------------------------------------
+# class HttpClient
+# -----------------------------------------------------------------------------
+
+
+class HttpClient:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, timeout = 10.0, connect_timeout = 5.0, max_per_host = 4, idle_timeout = 30.0,
+                 retries = 2, dns_ttl = 300.0, headers = None, stats = None):
+        self.log = logging.getLogger(__name__)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_per_host = max(1, max_per_host)
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.dns_ttl = dns_ttl
+        self.headers = headers or {}
+        self.stats = stats
+        self.pools = {}
+        self.dns = {}
+        self.ssl_context = None
+        self.closed = False
+
+    # --------------------------------------------------------------------------
+    # get / post / put / delete (async)
+    # --------------------------------------------------------------------------
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+    async def put(self, url, **kwargs):
+        return await self.request("PUT", url, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
+
+    # --------------------------------------------------------------------------
+    # request (async)
+    # --------------------------------------------------------------------------
+
+    async def request(self, method, url, params = None, data = None, json_body = None, headers = None,
+                      timeout = None, retries = None):
+        # returns the Response (of any status), or None if the request failed
+
+        method = method.upper()
+        parts = urlsplit(url)
+
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            self.log.error("Invalid URL '%s'", url)
+            return None
+
+        tls = parts.scheme == "https"
+        host = parts.hostname
+        port = parts.port or (443 if tls else 80)
+        target = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+
+        if params:
+            target += ("&" if parts.query else "?") + urlencode(params, doseq = True)
+
+        all_headers = { "Host": host if parts.port is None else "{}:{}".format(host, port),
+                        "User-Agent": USER_AGENT, "Accept-Encoding": "identity" }
+        all_headers.update(self.headers)
+
+        if json_body is not None:
+            data = json.dumps(json_body).encode("utf-8")
+            all_headers["Content-Type"] = "application/json"
+        elif isinstance(data, dict):
+            data = urlencode(data, doseq = True).encode("utf-8")
+            all_headers["Content-Type"] = "application/x-www-form-urlencoded"
+        elif isinstance(data, str):
+            data = data.encode("utf-8")
+
+        if headers:
+            all_headers.update(headers)
+
+        if data is not None or method in ("POST", "PUT", "PATCH"):
+            all_headers["Content-Length"] = str(len(data or b""))
+
+        head = "{} {} HTTP/1.1\r\n{}\r\n".format(method, target,
+            "".join("{}: {}\r\n".format(name, value) for name, value in all_headers.items())).encode("latin-1")
+
+        timeout = self.timeout if timeout is None else timeout
+        retries = (self.retries if retries is None else retries) if method in IDEMPOTENT_METHODS else 0
+        key = (tls, host, port)
+        started = time.perf_counter()
+        attempt = 0
+
+        while True:
+            try:
+                coro = self.attempt(key, method, head, data)
+                response = await (asyncio.wait_for(coro, timeout) if timeout else coro)
+
+                if response.status not in RETRY_STATUSES or attempt >= retries:
+                    self.record(host, started, False)
+                    return response
+
+                error = "status {}".format(response.status)
+            except asyncio.CancelledError:
+                raise
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError, HttpError) as e:
+                error = str(e) or type(e).__name__
+
+                if attempt >= retries:
+                    self.log.error("%s %s failed (%s)", method, url, error)
+                    self.record(host, started, True)
+                    return None
+
+            attempt += 1
+            self.log.debug("%s %s failed (%s), retrying (%s/%s)", method, url, error, attempt, retries)
+
+            await asyncio.sleep(min(2.0, 0.1 * 2 ** (attempt - 1)) * (0.5 + random.random()))
+
+    # --------------------------------------------------------------------------
+    # record
+    # --------------------------------------------------------------------------
+
+    def record(self, host, started, error):
+        if self.stats:
+            self.stats.record_outbound("http:" + host, time.perf_counter() - started, error)
+
+    # --------------------------------------------------------------------------
+    # attempt (async)
+    # --------------------------------------------------------------------------
+
+    async def attempt(self, key, method, head, data):
+        pool = self.pools.get(key)
+
+        if pool is None:
+            pool = self.pools[key] = HostPool(self.max_per_host)
+
+        async with pool.slots:
+            connection = self.take_idle(pool)
+
+            if connection is not None:
+                try:
+                    return await self.exchange(connection, pool, method, head, data)
+                except StaleConnection:
+                    # the server closed the idle connection meanwhile. no byte
+                    # of a response was received, so try once on a fresh one.
+                    # failures later on are not retried here (the request was
+                    # processed, e.g. a POST must not be sent twice)
+
+                    pass
+
+            return await self.exchange(await self.connect(key), pool, method, head, data)
+
+    # --------------------------------------------------------------------------
+    # exchange (async)
+    # --------------------------------------------------------------------------
+
+    async def exchange(self, connection, pool, method, head, data):
+        try:
+            try:
+                connection.writer.write(head + data if data else head)
+                await connection.writer.drain()
+
+                line = await connection.reader.readline()
+            except ConnectionError as e:
+                raise StaleConnection(str(e) or "connection reset")
+
+            if not line:
+                raise StaleConnection("connection closed")
+
+            response, keep_alive = await self.read_response(connection.reader, method, line)
+        except BaseException:
+            connection.close()
+            raise
+
+        if keep_alive and not self.closed:
+            connection.last_used = time.monotonic()
+            pool.idle.append(connection)
+        else:
+            connection.close()
+
+        return response
+
+    # --------------------------------------------------------------------------
+    # take_idle
+    # --------------------------------------------------------------------------
+
+    def take_idle(self, pool):
+        # most recently used first, connections idle for too long are dropped
+
+        now = time.monotonic()
+
+        while pool.idle:
+            connection = pool.idle.pop()
+
+            if now - connection.last_used < self.idle_timeout and not connection.reader.at_eof():
+                return connection
+
+            connection.close()
+
+        return None
+
+    # --------------------------------------------------------------------------
+    # resolve (async)
+    # --------------------------------------------------------------------------
+
+    async def resolve(self, host, port):
+        entry = self.dns.get((host, port))
+        now = time.monotonic()
+
+        if entry and entry[0] > now:
+            return entry[1]
+
+        infos = await asyncio.get_event_loop().getaddrinfo(host, port, type = socket.SOCK_STREAM)
+        addresses = [info[4][0] for info in infos]
+
+        self.dns[(host, port)] = (now + self.dns_ttl, addresses)
+
+        return addresses
+
+    # --------------------------------------------------------------------------
+    # connect (async)
+    # --------------------------------------------------------------------------
+
+    async def connect(self, key):
+        tls, host, port = key
+        context = None
+
+        if tls:
+            if self.ssl_context is None:
+                self.ssl_context = ssl.create_default_context()
+
+            context = self.ssl_context
+
+        addresses = await self.resolve(host, port)
+        error = None
+
+        for address in addresses:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(address, port, ssl = context, server_hostname = host if tls else None),
+                    self.connect_timeout)
+
+                return Connection(reader, writer)
+            except (OSError, asyncio.TimeoutError) as e:
+                error = e
+
+        # addresses may have changed
+
+        self.dns.pop((host, port), None)
+
+        raise error or OSError("no address for '{}'".format(host))
+
+    # --------------------------------------------------------------------------
+    # read_response (async)
+    # --------------------------------------------------------------------------
+
+    async def read_response(self, reader, method, line = None):
+        # returns (response, keep_alive). line: status line read already
+
+        while True:
+            if line is None:
+                line = await reader.readline()
+
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+
+            parts = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+
+            if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+                raise HttpError("malformed status line")
+
+            status = parse_int(parts[1], 10, "status")
+            headers = await self.read_headers(reader)
+            line = None
+
+            # skip informational responses (e.g. 100 continue)
+
+            if status >= 200 or status == 101:
+                break
+
+        version = parts[0]
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            body = b""
+        elif "chunked" in headers.get("transfer-encoding", "").lower():
+            body = await self.read_chunked(reader)
+        elif "content-length" in headers:
+            body = await reader.readexactly(parse_int(headers["content-length"], 10, "content-length"))
+        else:
+            body = await reader.read()
+            keep_alive = False
+
+        return Response(status, parts[2] if len(parts) > 2 else "", headers, body), keep_alive
+
+    # --------------------------------------------------------------------------
+    # read_headers (async)
+    # --------------------------------------------------------------------------
+
+    async def read_headers(self, reader):
+        headers = {}
+
+        for i in range(MAX_HEADERS):
+            line = await reader.readline()
+
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+
+            if line in (b"\r\n", b"\n"):
+                return headers
+
+            name, _, value = line.decode("latin-1").partition(":")
+            name = name.strip().lower()
+            value = value.strip()
+
+            headers[name] = headers[name] + ", " + value if name in headers else value
+
+        raise HttpError("too many headers")
+
+    # --------------------------------------------------------------------------
+    # read_chunked (async)
+    # --------------------------------------------------------------------------
+
+    async def read_chunked(self, reader):
+        chunks = []
+
+        while True:
+            line = await reader.readline()
+
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+
+            size = parse_int(line.split(b";", 1)[0].strip(), 16, "chunk size")
+
+            if not size:
+                break
+
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+        await self.read_headers(reader)
+
+        return b"".join(chunks)
+
+    # --------------------------------------------------------------------------
+    # close (async)
+    # --------------------------------------------------------------------------
+
+    async def close(self):
+        self.closed = True
+
+        for pool in self.pools.values():
+            while pool.idle:
+                pool.idle.pop().close()
+
+        self.pools = {}
@@ -8,7 +8,60 @@
 # Imports
 # -----------------------------------------------------------------------------
 
+import atexit
+import contextvars
+import json
 import logging
+import logging.handlers
+import os
+import queue
+
+# -----------------------------------------------------------------------------
+# correlation ids of the request being handled (set by rpc/hss)
+# -----------------------------------------------------------------------------
+
+request_seq = contextvars.ContextVar("hss_request_seq", default = None)
+request_session = contextvars.ContextVar("hss_request_session", default = None)
+
+# -----------------------------------------------------------------------------
+# class ContextFilter (adds the correlation ids to log records)
+# -----------------------------------------------------------------------------
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record):
+        record.seq = request_seq.get()
+        record.session_id = request_session.get()
+
+        return True
+
+# -----------------------------------------------------------------------------
+# class JsonFormatter (one JSON object per line)
+# -----------------------------------------------------------------------------
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+
+        seq = getattr(record, "seq", None)
+        session_id = getattr(record, "session_id", None)
+
+        if seq is not None:
+            entry["seq"] = seq
+
+        if session_id is not None:
+            entry["sessionId"] = session_id
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False)
 
 # -----------------------------------------------------------------------------
 # class Logger
@@ -16,17 +69,87 @@ import logging
 
 class Logger:
     initialized = False
+    listener = None
+    queue_handler = None
+    handler = None
 
-    def static_init(file_name, level=logging.INFO):
+    def static_init(file_name, level=logging.INFO, queued=False, max_bytes=0, backup_count=3, json_lines=False):
         if Logger.initialized:
             return None
 
+        # with 'queued', records are only put into a queue by the caller, and
+        # formatted and written by a background thread (no disk I/O on the loop)
+
         if file_name == None:
-            logging.basicConfig(level=level,
-                                format='%(levelname)s:%(name)s: %(message)s')
+            handler = logging.StreamHandler()
+            fmt = '%(levelname)s:%(name)s: %(message)s'
+        elif max_bytes:
+            handler = logging.handlers.RotatingFileHandler(file_name, maxBytes=max_bytes, backupCount=backup_count)
+            fmt = '%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+        else:
+            handler = logging.FileHandler(file_name)
+            fmt = '%(asctime)s:%(levelname)s:%(name)s: %(message)s'
+
+        handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter(fmt))
+        Logger.handler = handler
+
+        if queued:
+            records = queue.SimpleQueue()
+            root_handler = logging.handlers.QueueHandler(records)
+            root_handler.setFormatter(logging.Formatter('%(message)s'))
+
+            Logger.queue_handler = root_handler
+            Logger.listener = logging.handlers.QueueListener(records, handler)
+            Logger.listener.start()
+            atexit.register(Logger.static_stop)
         else:
-            logging.basicConfig(filename=file_name,
-                                level=level,
-                                format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
+            root_handler = handler
+
+        # context variables must be read by the calling thread
+
+        root_handler.addFilter(ContextFilter())
+
+        logging.basicConfig(level=level, handlers=[root_handler])
 
         Logger.initialized = True
+
+    def static_stop():
+        # writes records still queued
+
+        if Logger.listener:
+            Logger.listener.stop()
+            Logger.listener = None
+
+    def after_fork(worker):
+        # processes must not share a log file, rotating it in one process would
+        # lose or mix up the lines of the others. so a worker logs to its own
+        # file (e.g. skill.worker0.log, not skill.log.0 which is a rotated file)
+
+        handler = Logger.handler
+
+        if isinstance(handler, logging.FileHandler):
+            base, ext = os.path.splitext(handler.baseFilename)
+            file_name = "{}.worker{}{}".format(base, worker, ext)
+
+            if isinstance(handler, logging.handlers.RotatingFileHandler):
+                Logger.handler = logging.handlers.RotatingFileHandler(file_name, maxBytes=handler.maxBytes,
+                                                                      backupCount=handler.backupCount)
+            else:
+                Logger.handler = logging.FileHandler(file_name)
+
+            Logger.handler.setFormatter(handler.formatter)
+            handler.close()
+
+            if not Logger.listener:
+                Logger.handler.addFilter(ContextFilter())
+                logging.getLogger().removeHandler(handler)
+                logging.getLogger().addHandler(Logger.handler)
+
+        # the listener thread does not survive fork(), a forked worker process
+        # needs its own queue and thread
+
+        if Logger.listener:
+            records = queue.SimpleQueue()
+            Logger.queue_handler.queue = records
+            Logger.listener = logging.handlers.QueueListener(records, Logger.handler)
+            Logger.listener.start()
@@ -0,0 +1,177 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# offload.py
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# -----------------------------------------------------------------------------
+# class Offloader (thread pool for blocking code, process pool for CPU-heavy code)
+# -----------------------------------------------------------------------------
+
+
+class Offloader:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, threads = 0, processes = 0):
+        # pools are created on first use, 0 selects the size by cpu count
+
+        self.log = logging.getLogger(__name__)
+        self.threads = threads or min(32, (os.cpu_count() or 1) + 4)
+        self.processes = processes or os.cpu_count() or 1
+        self.thread_pool = None
+        self.process_pool = None
+
+    # --------------------------------------------------------------------------
+    # get_thread_pool
+    # --------------------------------------------------------------------------
+
+    def get_thread_pool(self):
+        if self.thread_pool is None:
+            self.thread_pool = ThreadPoolExecutor(max_workers = self.threads, thread_name_prefix = "hss")
+            self.log.debug("Started thread pool with %s threads", self.threads)
+
+        return self.thread_pool
+
+    # --------------------------------------------------------------------------
+    # run_in_thread
+    # --------------------------------------------------------------------------
+
+    def run_in_thread(self, fn, *args, **kwargs):
+        # returns an awaitable future. fn sees the caller's context variables
+        # (e.g. the language of the request being handled)
+
+        loop = asyncio.get_event_loop()
+        context = contextvars.copy_context()
+
+        return loop.run_in_executor(self.get_thread_pool(), functools.partial(context.run, fn, *args, **kwargs))
+
+    # --------------------------------------------------------------------------
+    # run_in_process
+    # --------------------------------------------------------------------------
+
+    def run_in_process(self, fn, *args, **kwargs):
+        # fn and its arguments must be picklable (e.g. a module level function)
+
+        if self.process_pool is None:
+            self.process_pool = ProcessPoolExecutor(max_workers = self.processes)
+            self.log.debug("Started process pool with %s processes", self.processes)
+
+        loop = asyncio.get_event_loop()
+
+        return loop.run_in_executor(self.process_pool, functools.partial(fn, *args, **kwargs))
+
+    # --------------------------------------------------------------------------
+    # close
+    # --------------------------------------------------------------------------
+
+    def close(self):
+        if self.thread_pool:
+            self.thread_pool.shutdown(wait = False)
+            self.thread_pool = None
+
+        if self.process_pool:
+            self.process_pool.shutdown(wait = False)
+            self.process_pool = None
+
+# -----------------------------------------------------------------------------
+# class Watchdog (reports code blocking the event loop)
+# -----------------------------------------------------------------------------
+
+
+class Watchdog:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, threshold_ms, active = None):
+        # the loop updates a heartbeat, a thread checks it and logs the stack of
+        # the loop's thread when the heartbeat is older than the threshold.
+        # active() may return a description of the requests being handled
+
+        self.log = logging.getLogger(__name__)
+        self.threshold = threshold_ms / 1000.0
+        self.active = active
+        self.loop = None
+        self.loop_thread_id = None
+        self.heartbeat = 0.0
+        self.handle = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    # --------------------------------------------------------------------------
+    # start
+    # --------------------------------------------------------------------------
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.loop_thread_id = threading.get_ident()
+        self.stopped.clear()
+        self.beat()
+
+        self.thread = threading.Thread(target = self.watch, name = "hss-watchdog", daemon = True)
+        self.thread.start()
+
+    # --------------------------------------------------------------------------
+    # stop
+    # --------------------------------------------------------------------------
+
+    def stop(self):
+        self.stopped.set()
+
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+
+    # --------------------------------------------------------------------------
+    # beat (runs on the loop)
+    # --------------------------------------------------------------------------
+
+    def beat(self):
+        self.heartbeat = time.monotonic()
+        self.handle = self.loop.call_later(self.threshold / 2, self.beat)
+
+    # --------------------------------------------------------------------------
+    # watch (runs in the watchdog thread)
+    # --------------------------------------------------------------------------
+
+    def watch(self):
+        reported = None
+
+        while not self.stopped.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat
+
+            # the heartbeat is due every threshold/2, so anything beyond that is lag
+
+            if blocked - self.threshold / 2 < self.threshold or reported == heartbeat:
+                continue
+
+            reported = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = "".join(traceback.format_stack(frame, limit = 10)) if frame else "(unknown)\n"
+            active = self.active() if self.active else None
+
+            self.log.warning("Event loop blocked for %.0fms%s, currently in:\n%s",
+                             (blocked - self.threshold / 2) * 1000,
+                             " (handling {})".format(active) if active else "",
+                             stack.rstrip())
@@ -0,0 +1,479 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# profiler.py
+# -----------------------------------------------------------------------------
+# On-demand profiling of intent handling, toggled over RPC (profile_start,
+# profile_stop, profile_slow).
+#
+# 'sample' mode: a background thread samples the stacks of the requests being
+# handled every few milliseconds. Requests running on the event loop are
+# sampled from the loop's stack, waiting requests from their chain of awaited
+# coroutines, and sync handlers from their pool thread. Results are written
+# per intent in collapsed stack format (flamegraph.pl, speedscope, ...).
+#
+# 'cprofile' mode: requests are profiled one at a time using cProfile, and
+# written per intent as pstats files. cProfile records the whole thread, so
+# other coroutines running on the loop meanwhile are counted as well.
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import asyncio
+import collections
+import contextvars
+import cProfile
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# request being profiled
+# -----------------------------------------------------------------------------
+
+current_request = contextvars.ContextVar("hss_profile_request", default = None)
+
+MODE_SAMPLE = "sample"
+MODE_CPROFILE = "cprofile"
+
+MAX_DEPTH = 128
+
+# frames of the runtime (event loop, thread pool) are cut off
+
+RUNTIME_PATHS = (os.path.dirname(asyncio.__file__) + os.sep, os.path.dirname(threading.__file__) + os.sep + "concurrent",
+                 threading.__file__, __file__)
+
+# -----------------------------------------------------------------------------
+# frame_name
+# -----------------------------------------------------------------------------
+
+
+def frame_name(frame):
+    code = frame.f_code
+
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+# -----------------------------------------------------------------------------
+# stack_until
+# -----------------------------------------------------------------------------
+
+
+def stack_until(frame, anchor):
+    # names of the frames from 'anchor' (inclusive, if given) to 'frame'. without
+    # anchor, frames are collected up to the first runtime frame
+
+    names = []
+
+    while frame is not None and len(names) < MAX_DEPTH:
+        if anchor is None and frame.f_code.co_filename.startswith(RUNTIME_PATHS):
+            break
+
+        names.append(frame_name(frame))
+
+        if frame is anchor:
+            break
+
+        frame = frame.f_back
+
+    names.reverse()
+
+    return names
+
+# -----------------------------------------------------------------------------
+# await_chain
+# -----------------------------------------------------------------------------
+
+
+def await_chain(coro):
+    # names of a suspended coroutine and the coroutines it awaits
+
+    names = []
+
+    while coro is not None and len(names) < MAX_DEPTH:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+
+        if frame is None:
+            break
+
+        names.append(frame_name(frame))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+
+    return names
+
+# -----------------------------------------------------------------------------
+# safe_name
+# -----------------------------------------------------------------------------
+
+
+def safe_name(text):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", text)
+
+# -----------------------------------------------------------------------------
+# class RequestProfile
+# -----------------------------------------------------------------------------
+
+
+class RequestProfile:
+    __slots__ = ("intent_name", "coro", "samples", "threads", "cprofile", "profiles")
+
+    def __init__(self, intent_name, coro):
+        self.intent_name = intent_name
+        self.coro = coro
+        self.samples = collections.Counter()
+        self.threads = 0
+        self.cprofile = False
+        self.profiles = []
+
+# -----------------------------------------------------------------------------
+# class Session (one profile_start ... profile_stop)
+# -----------------------------------------------------------------------------
+
+
+class Session:
+    __slots__ = ("mode", "max_requests", "started", "requests", "skipped", "samples", "profiles", "stop_handle")
+
+    def __init__(self, mode, max_requests):
+        self.mode = mode
+        self.max_requests = max_requests
+        self.started = time.time()
+        self.requests = 0
+        self.skipped = 0
+        self.samples = {}
+        self.profiles = {}
+        self.stop_handle = None
+
+# -----------------------------------------------------------------------------
+# class Profiler
+# -----------------------------------------------------------------------------
+
+
+class Profiler:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, directory, interval = 0.005, slow_ms = 0, slow_every = 60.0):
+        # 'slow_ms': requests taking longer are written as a profile of their
+        # own, at most one per intent every 'slow_every' seconds
+
+        self.log = logging.getLogger(__name__)
+        self.directory = directory
+        self.interval = interval
+        self.slow_ms = slow_ms
+        self.slow_every = slow_every
+        self.slow_written = {}
+        self.session = None
+        self.requests = set()
+        self.threads = {}
+        self.cprofile_busy = False
+        self.loop_thread = None
+        self.sampler = None
+        self.stopping = threading.Event()
+
+    @property
+    def active(self):
+        return self.session is not None or self.slow_ms > 0
+
+    # --------------------------------------------------------------------------
+    # start (profile_start)
+    # --------------------------------------------------------------------------
+
+    def start(self, mode = MODE_SAMPLE, requests = 0, seconds = 0.0):
+        # profiles the next 'requests' requests or 'seconds' seconds, until
+        # stop() if neither is given
+
+        if self.session is not None:
+            return { "error": "profiling already active" }
+
+        if mode not in (MODE_SAMPLE, MODE_CPROFILE):
+            return { "error": "unknown mode '{}'".format(mode) }
+
+        self.session = Session(mode, requests)
+
+        if seconds:
+            self.session.stop_handle = asyncio.get_event_loop().call_later(seconds, self.finish)
+
+        self.log.info("Profiling started (mode %s, %s requests, %s seconds)", mode, requests or "all", seconds or "unlimited")
+
+        return { "profiling": True, "mode": mode, "requests": requests, "seconds": seconds }
+
+    # --------------------------------------------------------------------------
+    # stop (profile_stop)
+    # --------------------------------------------------------------------------
+
+    def stop(self):
+        # ends the session, returns it (to be written by write()), or None
+
+        session = self.session
+
+        if session is None:
+            return None
+
+        self.session = None
+
+        if session.stop_handle:
+            session.stop_handle.cancel()
+
+        self.log.info("Profiling stopped after %s requests", session.requests)
+
+        return session
+
+    # --------------------------------------------------------------------------
+    # finish
+    # --------------------------------------------------------------------------
+
+    def finish(self):
+        # session ended by its limits, files are written by the thread pool
+
+        session = self.stop()
+
+        if session is not None:
+            asyncio.get_event_loop().run_in_executor(None, self.write, session)
+
+    # --------------------------------------------------------------------------
+    # close
+    # --------------------------------------------------------------------------
+
+    def close(self):
+        session = self.stop()
+
+        if session is not None:
+            self.write(session)
+
+        if self.sampler is not None:
+            self.stopping.set()
+            self.sampler.join(1.0)
+            self.sampler = None
+
+    # --------------------------------------------------------------------------
+    # run (async)
+    # --------------------------------------------------------------------------
+
+    async def run(self, intent_name, fn, *args):
+        # awaits fn(*args) while profiling it
+
+        session = self.session
+        use_cprofile = session is not None and session.mode == MODE_CPROFILE
+
+        if use_cprofile and self.cprofile_busy:
+            # cProfile sees everything running meanwhile, so requests overlapping
+            # a profiled one are not profiled themselves
+
+            session.skipped += 1
+            use_cprofile = False
+
+            if not self.slow_ms:
+                return await fn(*args)
+
+        coro = fn(*args)
+        request = RequestProfile(intent_name, coro)
+        token = current_request.set(request)
+        profile = None
+
+        if use_cprofile:
+            profile = cProfile.Profile()
+            request.cprofile = self.cprofile_busy = True
+            profile.enable()
+        else:
+            self.ensure_sampler()
+
+        self.requests.add(request)
+        started = time.perf_counter()
+
+        try:
+            return await coro
+        finally:
+            elapsed = time.perf_counter() - started
+            self.requests.discard(request)
+            current_request.reset(token)
+
+            if profile is not None:
+                profile.disable()
+                self.cprofile_busy = False
+                request.profiles.append(profile)
+
+            self.collect(request, session, elapsed)
+
+    # --------------------------------------------------------------------------
+    # collect
+    # --------------------------------------------------------------------------
+
+    def collect(self, request, session, elapsed):
+        if session is not None and session is self.session:
+            session.requests += 1
+
+            samples = session.samples.setdefault(request.intent_name, collections.Counter())
+            samples.update(request.samples)
+
+            if request.profiles:
+                session.profiles.setdefault(request.intent_name, []).extend(request.profiles)
+
+            if session.max_requests and session.requests >= session.max_requests:
+                self.finish()
+
+        elapsed_ms = int(elapsed * 1000)
+
+        if self.slow_ms and elapsed_ms >= self.slow_ms and request.samples:
+            now = time.monotonic()
+
+            if now - self.slow_written.get(request.intent_name, -self.slow_every) >= self.slow_every:
+                self.slow_written[request.intent_name] = now
+
+                name = "slow-{}-{}-{}-{}ms.collapsed".format(time.strftime("%Y%m%d-%H%M%S"), os.getpid(),
+                                                             safe_name(request.intent_name), elapsed_ms)
+
+                self.log.warning("Intent '%s' took %sms, writing profile '%s'", request.intent_name, elapsed_ms, name)
+                asyncio.get_event_loop().run_in_executor(None, self.write_collapsed, name, request.samples)
+
+    # --------------------------------------------------------------------------
+    # wrap_thread
+    # --------------------------------------------------------------------------
+
+    def wrap_thread(self, fn):
+        # fn is run in a pool thread on behalf of the current request
+
+        request = current_request.get()
+
+        if request is None:
+            return fn
+
+        def profiled(*args, **kwargs):
+            ident = threading.get_ident()
+            profile = None
+
+            if request.cprofile:
+                profile = cProfile.Profile()
+
+                try:
+                    profile.enable()
+                except ValueError:
+                    # another profiler is active (python 3.12+ profiles process wide)
+
+                    profile = None
+
+            self.threads[ident] = (request, sys._getframe())
+            request.threads += 1
+
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                request.threads -= 1
+                del self.threads[ident]
+
+                if profile is not None:
+                    profile.disable()
+                    request.profiles.append(profile)
+
+        return profiled
+
+    # --------------------------------------------------------------------------
+    # ensure_sampler
+    # --------------------------------------------------------------------------
+
+    def ensure_sampler(self):
+        if self.sampler is not None:
+            return
+
+        self.loop_thread = threading.get_ident()
+        self.stopping.clear()
+        self.sampler = threading.Thread(target = self.sample_loop, name = "hss-profiler", daemon = True)
+        self.sampler.start()
+
+    # --------------------------------------------------------------------------
+    # sample_loop (sampler thread)
+    # --------------------------------------------------------------------------
+
+    def sample_loop(self):
+        while not self.stopping.wait(self.interval):
+            if self.requests:
+                try:
+                    self.sample()
+                except Exception as e:
+                    self.log.debug("Sampling failed (%s)", e)
+
+    # --------------------------------------------------------------------------
+    # sample (sampler thread)
+    # --------------------------------------------------------------------------
+
+    def sample(self):
+        frames = sys._current_frames()
+        loop_frame = frames.get(self.loop_thread)
+
+        # sync code running in pool threads, below the awaiting coroutines
+
+        for ident, (request, anchor) in list(self.threads.items()):
+            frame = frames.get(ident)
+
+            if frame is not None and frame is not anchor:
+                stack = await_chain(request.coro) + ["[thread]"] + stack_until(frame, None)
+                request.samples[";".join(stack)] += 1
+
+        for request in list(self.requests):
+            coro = request.coro
+
+            if request.threads or coro.cr_frame is None:
+                continue
+
+            if coro.cr_running:
+                stack = stack_until(loop_frame, coro.cr_frame)
+            else:
+                stack = await_chain(coro) + ["[await]"]
+
+            if stack:
+                request.samples[";".join(stack)] += 1
+
+    # --------------------------------------------------------------------------
+    # write
+    # --------------------------------------------------------------------------
+
+    def write(self, session):
+        # writes the results of a session, returns the file names
+
+        stamp = "{}-{}".format(time.strftime("%Y%m%d-%H%M%S", time.localtime(session.started)), os.getpid())
+        files = []
+
+        for intent_name, samples in session.samples.items():
+            if samples:
+                files.append(self.write_collapsed("profile-{}-{}.collapsed".format(stamp, safe_name(intent_name)), samples))
+
+        for intent_name, profiles in session.profiles.items():
+            name = "profile-{}-{}.pstats".format(stamp, safe_name(intent_name))
+
+            try:
+                os.makedirs(self.directory, exist_ok = True)
+
+                stats = pstats.Stats(profiles[0])
+
+                for profile in profiles[1:]:
+                    stats.add(profile)
+
+                stats.dump_stats(os.path.join(self.directory, name))
+                files.append(name)
+            except Exception as e:
+                self.log.error("Failed to write profile '%s' (%s)", name, e)
+
+        return [name for name in files if name]
+
+    # --------------------------------------------------------------------------
+    # write_collapsed
+    # --------------------------------------------------------------------------
+
+    def write_collapsed(self, name, samples):
+        try:
+            os.makedirs(self.directory, exist_ok = True)
+
+            with open(os.path.join(self.directory, name), "w") as collapsed_file:
+                for stack, count in samples.most_common():
+                    collapsed_file.write("{} {}\n".format(stack, count))
+        except Exception as e:
+            self.log.error("Failed to write profile '%s' (%s)", name, e)
+            return None
+
+        return name
@@ -0,0 +1,101 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# request.py
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# collect_slots
+# -----------------------------------------------------------------------------
+
+
+def collect_slots(entries, value):
+    # slot name -> value(entry), or list of values for slots occurring more than
+    # once. built in a single pass
+
+    res = {}
+    multi = None
+
+    for entry in entries:
+        name = entry["slotName"]
+
+        if name not in res:
+            res[name] = value(entry)
+        elif multi and name in multi:
+            res[name].append(value(entry))
+        else:
+            res[name] = [res[name], value(entry)]
+            multi = multi or set()
+            multi.add(name)
+
+    return res
+
+# -----------------------------------------------------------------------------
+# class Request (view on an intent request, slots are built on first access)
+# -----------------------------------------------------------------------------
+
+
+class Request:
+    __slots__ = ("raw", "language", "slot_index", "_slots", "_mapped_slots")
+
+    def __init__(self, raw, language = None, slot_index = None):
+        self.raw = raw
+        self.language = language
+        self.slot_index = slot_index
+        self._slots = None
+        self._mapped_slots = None
+
+    @property
+    def intent_name(self):
+        return self.raw["intent"]["intentName"]
+
+    @property
+    def session_id(self):
+        return self.raw.get("sessionId")
+
+    @property
+    def site_id(self):
+        return self.raw.get("siteId")
+
+    @property
+    def raw_slots(self):
+        # slot entries as received (entity, value, confidence, range, ...)
+
+        return self.raw.get("slots") or []
+
+    # --------------------------------------------------------------------------
+    # slot_entries
+    # --------------------------------------------------------------------------
+
+    def slot_entries(self, name):
+        return [entry for entry in self.raw_slots if entry["slotName"] == name]
+
+    # --------------------------------------------------------------------------
+    # slots (slot name -> raw value)
+    # --------------------------------------------------------------------------
+
+    @property
+    def slots(self):
+        if self._slots is None:
+            self._slots = collect_slots(self.raw_slots, lambda entry: entry["value"]["value"])
+
+        return self._slots
+
+    # --------------------------------------------------------------------------
+    # mapped_slots (slot name -> slot identifier of the request's language)
+    # --------------------------------------------------------------------------
+
+    @property
+    def mapped_slots(self):
+        if self._mapped_slots is None:
+            slot_index = self.slot_index
+
+            if not slot_index or not self.language:
+                self._mapped_slots = collect_slots(self.raw_slots, lambda entry: entry["value"]["value"])
+            else:
+                index = slot_index.get(self.language)
+
+                self._mapped_slots = collect_slots(self.raw_slots, lambda entry:
+                    slot_index.lookup(index, entry["entity"], entry["value"]["value"]))
+
+        return self._mapped_slots
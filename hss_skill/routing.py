@@ -0,0 +1,137 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# routing.py
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import asyncio
+import logging
+
+# -----------------------------------------------------------------------------
+# class Route (one @intent registration)
+# -----------------------------------------------------------------------------
+
+
+class Route:
+    __slots__ = ("intent_name", "fn", "is_async", "slots", "timeout", "concurrency", "semaphore")
+
+    def __init__(self, intent_name, fn, slots = None, timeout = None, concurrency = None):
+        self.intent_name = intent_name
+        self.fn = fn
+        self.is_async = asyncio.iscoroutinefunction(fn)
+        self.slots = tuple(slots) if slots else ()
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.semaphore = None
+
+    # --------------------------------------------------------------------------
+    # matches
+    # --------------------------------------------------------------------------
+
+    def matches(self, slots):
+        for name in self.slots:
+            if name not in slots:
+                return False
+
+        return True
+
+    # --------------------------------------------------------------------------
+    # call (async)
+    # --------------------------------------------------------------------------
+
+    async def call(self, skill, request, session_id, site_id, intent_name, slots, mapped_slots):
+        # plain functions are run on the skill's thread pool
+
+        if self.is_async:
+            coro = self.fn(skill, request, session_id, site_id, intent_name, slots, mapped_slots)
+        else:
+            coro = skill.run_in_thread(self.fn, skill, request, session_id, site_id, intent_name, slots, mapped_slots)
+
+        if self.timeout:
+            coro = asyncio.wait_for(coro, self.timeout)
+
+        if not self.concurrency:
+            return await coro
+
+        # created on first use, so the semaphore belongs to the running loop
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        async with self.semaphore:
+            return await coro
+
+# -----------------------------------------------------------------------------
+# intent (decorator)
+# -----------------------------------------------------------------------------
+
+
+def intent(intent_name, slots = None, timeout = None, concurrency = None):
+    # registers the decorated coroutine or plain function (same signature as
+    # BaseSkill.handle) for the given intent. may be stacked to register a method
+    # for several intents. with slots given, the route is only taken if all of
+    # the slots are present
+
+    def decorator(fn):
+        routes = list(getattr(fn, "hss_routes", ()))
+        routes.append(Route(intent_name, fn, slots, timeout, concurrency))
+        fn.hss_routes = routes
+
+        return fn
+
+    return decorator
+
+# -----------------------------------------------------------------------------
+# build_routes
+# -----------------------------------------------------------------------------
+
+
+def build_routes(cls):
+    # intent name -> list of routes, routes with more required slots first.
+    # routes of subclasses override routes of base classes
+
+    routes = {}
+    seen = set()
+
+    for klass in cls.__mro__:
+        for attr, value in vars(klass).items():
+            if attr in seen:
+                continue
+
+            seen.add(attr)
+
+            for route in getattr(value, "hss_routes", ()):
+                routes.setdefault(route.intent_name, []).append(route)
+
+    for intent_routes in routes.values():
+        intent_routes.sort(key = lambda route: len(route.slots), reverse = True)
+
+    return routes
+
+# -----------------------------------------------------------------------------
+# check_routes
+# -----------------------------------------------------------------------------
+
+
+def check_routes(routes, intents, has_handle, log = None):
+    # compares the routing table against the intents of skill.json
+
+    log = log or logging.getLogger(__name__)
+    ok = True
+
+    for name in routes:
+        if name not in intents:
+            log.warning("Route for intent '%s' which is not listed in skill.json", name)
+            ok = False
+
+    if not has_handle:
+        for name in intents:
+            if name not in routes:
+                log.warning("No route for intent '%s' of skill.json and no handle() implemented", name)
+                ok = False
+
+    return ok
@@ -11,7 +11,313 @@
 import logging
 
 import asyncio
+import collections
+import contextlib
+import contextvars
+import functools
 import json
+import os
+import random
+import socket
+import stat
+import struct
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from hss_skill import logger
+
+# -----------------------------------------------------------------------------
+# framing / codecs
+# -----------------------------------------------------------------------------
+
+# 'line':   newline delimited JSON (default, understood by every server)
+# 'length': 4 byte big endian length prefix followed by the encoded frame
+
+FRAMING_LINE = "line"
+FRAMING_LENGTH = "length"
+FRAMINGS = [FRAMING_LENGTH, FRAMING_LINE]
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# what to do when the outbound queue is full while reconnecting
+
+QUEUE_DROP_OLDEST = "drop-oldest"
+QUEUE_DROP_NEWEST = "drop-newest"
+
+# optional protocol features, offered by the skill when negotiating:
+# 'batch':     several commands sent in one 'batch' frame (payload: list of
+#              commands), each answered by its own response
+# 'multiSite': 'say' with a list of sites ('siteIds') instead of 'siteId'
+
+FEATURE_BATCH = "batch"
+FEATURE_MULTI_SITE = "multiSite"
+FEATURES = [FEATURE_BATCH, FEATURE_MULTI_SITE]
+
+# calls made within a batch() context are sent together
+
+batching = contextvars.ContextVar("hss_rpc_batching", default = False)
+
+# directions of captured frames (see capture.py)
+
+CAPTURE_SERVER_IN = 0           # server -> skill request (RpcServer)
+CAPTURE_SERVER_OUT = 1          # skill -> server response (RpcServer)
+CAPTURE_CLIENT_OUT = 2          # skill -> server call (RpcClient)
+CAPTURE_CLIENT_IN = 3           # server -> skill response (RpcClient)
+
+# -----------------------------------------------------------------------------
+# class JsonCodec
+# -----------------------------------------------------------------------------
+
+
+class JsonCodec:
+    name = "json"
+
+    def encode(self, obj):
+        return json.dumps(obj, ensure_ascii=False).encode('utf8')
+
+    def decode(self, data):
+        return json.loads(data.decode("utf-8"))
+
+# -----------------------------------------------------------------------------
+# class MsgpackCodec
+# -----------------------------------------------------------------------------
+
+
+class MsgpackCodec:
+    name = "msgpack"
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+# -----------------------------------------------------------------------------
+# available codecs (preferred first)
+# -----------------------------------------------------------------------------
+
+CODECS = {}
+
+if msgpack:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+CODECS[JsonCodec.name] = JsonCodec()
+
+# -----------------------------------------------------------------------------
+# select_protocol
+# -----------------------------------------------------------------------------
+
+
+def select_protocol(offer):
+    # first offered framing/codec which is supported, newline JSON otherwise
+
+    offer = offer or {}
+    framing = next((f for f in offer.get("framing", []) if f in FRAMINGS), FRAMING_LINE)
+    codec = next((c for c in offer.get("codecs", []) if c in CODECS), JsonCodec.name)
+
+    return framing, codec
+
+# -----------------------------------------------------------------------------
+# select_features
+# -----------------------------------------------------------------------------
+
+
+def select_features(offer):
+    # offered features which are supported
+
+    return [f for f in (offer or {}).get("features", []) if f in FEATURES]
+
+# -----------------------------------------------------------------------------
+# unix_sockets_supported
+# -----------------------------------------------------------------------------
+
+
+def unix_sockets_supported():
+    return hasattr(asyncio, "start_unix_server")
+
+# -----------------------------------------------------------------------------
+# remove_stale_socket
+# -----------------------------------------------------------------------------
+
+
+def remove_stale_socket(path):
+    # a socket file left over from a previous run would make binding fail,
+    # but never remove anything which is not a socket
+
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+# -----------------------------------------------------------------------------
+# class Channel
+# -----------------------------------------------------------------------------
+
+
+class Channel:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, reader, writer, stats = None, capture = None, incoming = CAPTURE_SERVER_IN,
+                 outgoing = CAPTURE_SERVER_OUT):
+        self.reader = reader
+        self.writer = writer
+        self.stats = stats
+        self.framing = FRAMING_LINE
+        self.codec = CODECS[JsonCodec.name]
+        self.write_lock = asyncio.Lock()
+        self.capture = capture
+        self.incoming = incoming
+        self.outgoing = outgoing
+        self.connection = capture.next_connection() if capture else 0
+        self.features = ()
+        self.frame_started = 0.0
+
+    # --------------------------------------------------------------------------
+    # switch
+    # --------------------------------------------------------------------------
+
+    def switch(self, framing, codec):
+        self.framing = framing
+        self.codec = CODECS[codec] if framing == FRAMING_LENGTH else CODECS[JsonCodec.name]
+
+    # --------------------------------------------------------------------------
+    # read_frame (async)
+    # --------------------------------------------------------------------------
+
+    async def read_frame(self, timed = False):
+        # returns the raw frame, or None when the connection was closed. with
+        # 'timed', the time the first byte of the frame arrived is kept in
+        # 'frame_started', so waiting for the next frame is not counted
+
+        first = b""
+
+        if timed:
+            try:
+                first = await self.reader.readexactly(1)
+            except asyncio.IncompleteReadError:
+                return None
+
+            self.frame_started = time.perf_counter()
+
+        if self.framing == FRAMING_LINE:
+            data = first + await self.reader.readline() if first else await self.reader.readline()
+
+            if self.stats:
+                self.stats.bytes_in += len(data)
+
+            return data if data else None
+
+        try:
+            header = first + await self.reader.readexactly(4 - len(first))
+        except asyncio.IncompleteReadError as e:
+            if not e.partial and not first:
+                return None
+            raise
+
+        size = struct.unpack(">I", header)[0]
+
+        if size > MAX_FRAME_SIZE:
+            raise ValueError("frame of {} bytes exceeds maximum frame size".format(size))
+
+        if self.stats:
+            self.stats.bytes_in += 4 + size
+
+        return await self.reader.readexactly(size)
+
+    # --------------------------------------------------------------------------
+    # decode
+    # --------------------------------------------------------------------------
+
+    def decode(self, frame):
+        try:
+            if self.framing == FRAMING_LINE:
+                obj = json.loads(frame.decode("utf-8").replace('\\n', '\n'))
+            else:
+                obj = self.codec.decode(frame)
+        except Exception:
+            if self.capture:
+                self.record(self.incoming, None, frame)
+            raise
+
+        if self.capture:
+            self.record(self.incoming, obj, frame)
+
+        return obj
+
+    # --------------------------------------------------------------------------
+    # encode
+    # --------------------------------------------------------------------------
+
+    def encode(self, obj):
+        if self.framing == FRAMING_LINE:
+            data = (json.dumps(obj, ensure_ascii=False).replace('\n', '\\n') + '\n').encode('utf8')
+
+            if self.capture:
+                self.record(self.outgoing, obj, data)
+
+            return data
+
+        data = self.codec.encode(obj)
+
+        if self.capture:
+            self.record(self.outgoing, obj, data)
+
+        return struct.pack(">I", len(data)) + data
+
+    # --------------------------------------------------------------------------
+    # record
+    # --------------------------------------------------------------------------
+
+    def record(self, direction, obj, frame):
+        seq = obj.get("seq") if isinstance(obj, dict) else None
+
+        self.capture.record(direction, self.connection, seq, self.framing, self.codec.name, frame)
+
+    # --------------------------------------------------------------------------
+    # write (async)
+    # --------------------------------------------------------------------------
+
+    async def write(self, obj):
+        data = self.encode(obj)
+
+        if self.stats:
+            self.stats.bytes_out += len(data)
+
+        async with self.write_lock:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    # --------------------------------------------------------------------------
+    # write_many (async)
+    # --------------------------------------------------------------------------
+
+    async def write_many(self, objs):
+        # several frames with a single write and drain
+
+        data = b"".join(self.encode(obj) for obj in objs)
+
+        if self.stats:
+            self.stats.bytes_out += len(data)
+
+        async with self.write_lock:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    # --------------------------------------------------------------------------
+    # close (async)
+    # --------------------------------------------------------------------------
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
 
 # -----------------------------------------------------------------------------
 # class RpcClient
@@ -24,13 +330,40 @@ class RpcClient:
     # ctor
     # --------------------------------------------------------------------------
 
-    def __init__(self, port):
+    def __init__(self, port, timeout = None, path = None, framing = FRAMING_LINE, codec = JsonCodec.name,
+                 reconnect = False, reconnect_delay = 0.5, reconnect_max_delay = 30.0,
+                 queue_size = 100, queue_policy = QUEUE_DROP_OLDEST, queue_max_age = 30.0,
+                 state_callback = None, features = False, batch_window = 0.0, batch_max = 64,
+                 negotiate_timeout = 1.0):
         self.log = logging.getLogger(__name__)
         self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.framing = framing
+        self.codec = codec
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.queue = collections.deque()
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
+        self.queue_max_age = queue_max_age
+        self.state_callback = state_callback
+        self.features = features
+        self.batch_window = batch_window
+        self.batch_max = batch_max
+        self.negotiate_timeout = negotiate_timeout
+        self.negotiate_unanswered = False
+        self.batched = []
+        self.batch_handle = None
+        self.stats = None
+        self.capture = None
         self.channel = None
-        self.rpc_client = None
-        self.reader = None
-        self.writer = None
+        self.connected = False
+        self.closing = False
+        self.read_task = None
+        self.reconnect_task = None
+        self.pending = {}
         self.seq = 0
 
     # --------------------------------------------------------------------------
@@ -38,47 +371,528 @@ class RpcClient:
     # --------------------------------------------------------------------------
 
     async def connect(self):
-        self.log.debug("Connecting to servers RPC port ...")
+        self.closing = False
 
-        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', self.port)
+        await self.open()
+        self.set_state(True)
+
+    # --------------------------------------------------------------------------
+    # open (async)
+    # --------------------------------------------------------------------------
+
+    async def open(self):
+        if self.path and unix_sockets_supported():
+            self.log.debug("Connecting to servers RPC socket '%s' ...", self.path)
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        else:
+            self.log.debug("Connecting to servers RPC port ...")
+            reader, writer = await asyncio.open_connection('127.0.0.1', self.port)
+
+        self.channel = Channel(reader, writer, self.stats, self.capture, CAPTURE_CLIENT_IN, CAPTURE_CLIENT_OUT)
+
+        if (self.framing != FRAMING_LINE or self.features) and not self.negotiate_unanswered:
+            if not await self.negotiate():
+                # a late acceptance would switch the server's framing while the
+                # skill stays with newline JSON, so start over without offering
+
+                self.log.info("No answer to the RPC negotiation, reconnecting without it")
+                self.negotiate_unanswered = True
+
+                try:
+                    await self.channel.close()
+                except Exception:
+                    pass
+
+                return await self.open()
+
+        self.read_task = asyncio.ensure_future(self.read_loop(self.channel))
+
+    # --------------------------------------------------------------------------
+    # negotiate (async)
+    # --------------------------------------------------------------------------
+
+    async def negotiate(self):
+        # offer framing/codec in newline JSON. servers which don't know the
+        # 'negotiate' command answer with an error or not at all, in this case
+        # stay with newline JSON. the answer is waited for only briefly (not
+        # rpc_timeout), the connection is not usable before. returns False if
+        # there was no answer
+
+        codecs = [self.codec] if self.codec in CODECS else []
+
+        if self.codec not in CODECS:
+            self.log.warning("Codec '%s' not available, offering JSON only", self.codec)
+
+        if JsonCodec.name not in codecs:
+            codecs.append(JsonCodec.name)
+
+        seq = self.seq
+        self.seq = self.seq + 1
+        offer = { "framing": [self.framing], "codecs": codecs }
+
+        if self.features:
+            offer["features"] = FEATURES
+
+        await self.channel.write({ "seq": seq, "command": "negotiate", "payload": offer })
+
+        try:
+            frame = await asyncio.wait_for(self.channel.read_frame(), self.negotiate_timeout)
+            response_obj = self.channel.decode(frame) if frame else None
+            accepted = response_obj["payload"] if response_obj and response_obj.get("seq") == seq else None
+        except asyncio.TimeoutError:
+            return False
+        except Exception as e:
+            self.log.error("Received malformed RPC negotiation response (%s)", e)
+            accepted = None
+
+        if not isinstance(accepted, dict) or "error" in accepted:
+            accepted = None
+
+        if accepted and self.features:
+            self.channel.features = select_features(accepted)
+            self.log.debug("Negotiated features %s", self.channel.features)
+
+        if not accepted or accepted.get("framing") not in FRAMINGS or accepted.get("codec") not in codecs:
+            self.log.info("Server did not accept framing '%s', using newline JSON", self.framing)
+            return True
+
+        self.log.debug("Negotiated framing '%s' with codec '%s'", accepted["framing"], accepted["codec"])
+        self.channel.switch(accepted["framing"], accepted["codec"])
+
+        return True
 
     # --------------------------------------------------------------------------
     # disconnect (async)
     # --------------------------------------------------------------------------
 
     async def disconnect(self):
-        if self.writer:
+        self.closing = True
+
+        for task in (self.reconnect_task, self.read_task):
+            if not task:
+                continue
+
+            task.cancel()
+
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+        self.reconnect_task = None
+        self.read_task = None
+
+        if self.channel:
             self.log.info("Disconnecting")
-            self.writer.close()
-            await self.writer.wait_closed()
+
+            try:
+                await self.channel.close()
+            except Exception:
+                pass
+
+            self.channel = None
+
+        self.connected = False
+        self.fail_pending("Disconnected")
+        self.fail_queued("Disconnected")
+
+    # --------------------------------------------------------------------------
+    # set_state
+    # --------------------------------------------------------------------------
+
+    def set_state(self, connected):
+        self.connected = connected
+
+        if not self.state_callback:
+            return
+
+        try:
+            res = self.state_callback(connected)
+
+            if asyncio.iscoroutine(res):
+                asyncio.ensure_future(res)
+        except Exception as e:
+            self.log.error("Connection state callback failed (%s)", e)
+
+    # --------------------------------------------------------------------------
+    # fail_pending
+    # --------------------------------------------------------------------------
+
+    def fail_pending(self, reason):
+        pending = self.pending
+        self.pending = {}
+
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(reason))
+
+    # --------------------------------------------------------------------------
+    # fail_queued
+    # --------------------------------------------------------------------------
+
+    def fail_queued(self, reason):
+        while self.queue:
+            future = self.queue.popleft()[2]
+
+            if not future.done():
+                future.set_exception(ConnectionError(reason))
+
+    # --------------------------------------------------------------------------
+    # enqueue
+    # --------------------------------------------------------------------------
+
+    def enqueue(self, package, future):
+        # buffer commands while the connection is down. a full queue either
+        # drops the oldest entry or rejects the new one
+
+        if not self.reconnect or self.closing:
+            raise ConnectionError("not connected")
+
+        if len(self.queue) >= self.queue_size:
+            if self.queue_policy == QUEUE_DROP_NEWEST:
+                raise ConnectionError("outbound queue full")
+
+            dropped = self.queue.popleft()[2]
+
+            if not dropped.done():
+                dropped.set_exception(ConnectionError("dropped from full outbound queue"))
+
+            if self.stats:
+                self.stats.count("outboundDropped")
+
+        self.queue.append((time.monotonic(), package, future))
+
+    # --------------------------------------------------------------------------
+    # flush (async)
+    # --------------------------------------------------------------------------
+
+    async def flush(self):
+        # send queued commands after reconnecting, skipping those which timed
+        # out meanwhile and expiring those which are too old to be useful
+
+        while self.queue:
+            queued, package, future = self.queue.popleft()
+
+            if future.done():
+                continue
+
+            if self.queue_max_age and time.monotonic() - queued > self.queue_max_age:
+                future.set_exception(ConnectionError("expired in outbound queue"))
+
+                if self.stats:
+                    self.stats.count("outboundExpired")
+
+                continue
+
+            self.pending[package["seq"]] = future
+            await self.channel.write(package)
+
+    # --------------------------------------------------------------------------
+    # reconnect_loop (async)
+    # --------------------------------------------------------------------------
+
+    async def reconnect_loop(self):
+        # exponential backoff with jitter, so restarted servers are not hit by
+        # all skills at the same time
+
+        attempt = 0
+
+        while not self.closing:
+            delay = min(self.reconnect_max_delay, self.reconnect_delay * (2 ** attempt))
+            delay = delay * random.uniform(0.5, 1.0)
+            attempt += 1
+
+            await asyncio.sleep(delay)
+
+            try:
+                await self.open()
+                await self.flush()
+            except Exception as e:
+                self.log.warning("Reconnect attempt %s failed (%s)", attempt, e)
+                continue
+
+            self.log.info("Reconnected to server after %s attempt(s)", attempt)
+
+            if self.stats:
+                self.stats.count("reconnects")
+
+            self.reconnect_task = None
+            self.set_state(True)
+            return
+
+    # --------------------------------------------------------------------------
+    # read_loop (async)
+    # --------------------------------------------------------------------------
+
+    async def read_loop(self, channel):
+        # single reader for the connection. every response is routed to the
+        # future of the request with the same 'seq'
+
+        while True:
+            try:
+                response = await channel.read_frame()
+            except Exception as e:
+                self.log.error("Failed to read RPC connection (%s)", e)
+                break
+
+            if not response:
+                self.log.warning("RPC connection closed by server")
+                break
+
+            try:
+                response_obj = channel.decode(response)
+            except Exception as e:
+                self.log.error("Received malformed RPC response (%s)", e)
+                continue
+
+            future = self.pending.pop(response_obj.get("seq"), None) if isinstance(response_obj, dict) else None
+
+            if not future:
+                self.log.debug("Received RPC response for unknown or timed out request (seq %s)",
+                               response_obj.get("seq") if isinstance(response_obj, dict) else None)
+                continue
+
+            if future.done():
+                continue
+
+            if "payload" not in response_obj:
+                self.log.error("Missing mandatory property 'payload' in RPC response")
+                future.set_result(None)
+                continue
+
+            future.set_result(response_obj["payload"])
+
+        try:
+            await channel.close()
+        except Exception:
+            pass
+
+        # a reader of an earlier (failed) connection attempt must not touch the current one
+
+        if self.closing or channel is not self.channel:
+            return
+
+        self.fail_pending("RPC connection lost")
+
+        if self.connected:
+            self.set_state(False)
+
+        if self.reconnect and not self.reconnect_task:
+            self.reconnect_task = asyncio.ensure_future(self.reconnect_loop())
 
     # --------------------------------------------------------------------------
     # execute (async)
     # --------------------------------------------------------------------------
 
-    async def execute(self, command, payload = None):
-        package = { "seq": self.seq, "command": command, "payload": payload }
+    async def execute(self, command, payload = None, timeout = None):
+        seq = self.seq
+        package = { "seq": seq, "command": command, "payload": payload }
 
         self.seq = self.seq + 1
 
-        json_string = json.dumps(package, ensure_ascii=False).replace('\n', '\\n') + '\n'
-
-        self.writer.write(json_string.encode('utf8'))
-        await self.writer.drain()
+        future = asyncio.get_event_loop().create_future()
+        timeout = timeout if timeout is not None else self.timeout
+        stats = self.stats
+        error = True
 
-        response = await self.reader.readline()
+        if stats:
+            started = time.perf_counter()
+            stats.outbound_inflight += 1
 
         try:
-            response_obj = json.loads(response.decode("utf-8").replace('\\n', '\n')) if response else None
+            if not self.connected:
+                self.enqueue(package, future)
+            elif self.batch_window or batching.get():
+                self.pending[seq] = future
+                self.add_to_batch(package, future)
+            else:
+                self.pending[seq] = future
+                await self.channel.write(package)
+
+            if timeout:
+                res = await asyncio.wait_for(future, timeout)
+            else:
+                res = await future
+
+            error = False
+            return res
+        except asyncio.TimeoutError:
+            self.log.error("RPC command '%s' timed out after %s seconds", command, timeout)
         except Exception as e:
-            self.log.error("Received malformed RPC response ({})".format(e))
+            self.log.error("RPC command '%s' failed (%s)", command, e)
+        finally:
+            self.pending.pop(seq, None)
+
+            if stats:
+                stats.outbound_inflight -= 1
+                stats.record_outbound(command, time.perf_counter() - started, error)
+
+        return None
+
+    # --------------------------------------------------------------------------
+    # batch (context manager)
+    # --------------------------------------------------------------------------
+
+    @contextlib.contextmanager
+    def batch(self):
+        # calls made in the same loop iteration within the context (e.g. by
+        # asyncio.gather) are sent together
+
+        token = batching.set(True)
+
+        try:
+            yield
+        finally:
+            batching.reset(token)
+
+    # --------------------------------------------------------------------------
+    # add_to_batch
+    # --------------------------------------------------------------------------
+
+    def add_to_batch(self, package, future):
+        self.batched.append((package, future))
+
+        if len(self.batched) >= self.batch_max:
+            self.send_batch()
+        elif self.batch_handle is None:
+            loop = asyncio.get_event_loop()
+
+            if self.batch_window:
+                self.batch_handle = loop.call_later(self.batch_window, self.send_batch)
+            else:
+                self.batch_handle = loop.call_soon(self.send_batch)
+
+    # --------------------------------------------------------------------------
+    # send_batch
+    # --------------------------------------------------------------------------
+
+    def send_batch(self):
+        items = self.batched
+        self.batched = []
+
+        if self.batch_handle is not None:
+            self.batch_handle.cancel()
+            self.batch_handle = None
+
+        items = [(package, future) for package, future in items if not future.done()]
+
+        if not items:
             return
 
-        if "payload" not in response_obj:
-            self.log.error("Missing mandatory property 'payload' in RPC response")
-            return None
+        if not self.connected:
+            # lost meanwhile, buffer like any other call
+
+            for package, future in items:
+                self.pending.pop(package["seq"], None)
+
+                try:
+                    self.enqueue(package, future)
+                except ConnectionError as e:
+                    future.set_exception(e)
+
+            return
+
+        channel = self.channel
+
+        if FEATURE_MULTI_SITE in channel.features:
+            packages = self.collapse(items)
+        else:
+            packages = [package for package, future in items]
+
+        if self.stats:
+            self.stats.count("outboundBatched", len(items))
+
+        asyncio.ensure_future(self.write_batch(channel, packages, items))
+
+    # --------------------------------------------------------------------------
+    # collapse
+    # --------------------------------------------------------------------------
+
+    def collapse(self, items):
+        # 'say' calls with the same text to several sites become one call with
+        # a list of sites. its response is the result of each of the calls
+
+        groups = collections.OrderedDict()
+
+        for package, future in items:
+            payload = package["payload"]
+
+            if package["command"] == "say" and isinstance(payload, dict) and payload.get("siteId"):
+                key = (payload.get("text"), payload.get("lang"))
+            else:
+                key = package["seq"]
+
+            groups.setdefault(key, []).append((package, future))
+
+        packages = []
 
-        return response_obj["payload"]
+        for group in groups.values():
+            if len(group) == 1:
+                packages.append(group[0][0])
+                continue
+
+            seq = self.seq
+            self.seq = self.seq + 1
+
+            payload = dict(group[0][0]["payload"])
+            payload.pop("siteId")
+            payload["siteIds"] = [package["payload"]["siteId"] for package, future in group]
+
+            packages.append({ "seq": seq, "command": "say", "payload": payload })
+
+            combined = asyncio.get_event_loop().create_future()
+            self.pending[seq] = combined
+
+            futures = [future for package, future in group]
+            combined.add_done_callback(functools.partial(self.resolve_collapsed, futures))
+
+            for future in futures:
+                future.add_done_callback(functools.partial(self.abandon_collapsed, seq, combined, futures))
+
+        return packages
+
+    # --------------------------------------------------------------------------
+    # resolve_collapsed / abandon_collapsed
+    # --------------------------------------------------------------------------
+
+    def resolve_collapsed(self, futures, combined):
+        for future in futures:
+            if future.done():
+                continue
+
+            if combined.cancelled():
+                future.cancel()
+            elif combined.exception():
+                future.set_exception(combined.exception())
+            else:
+                future.set_result(combined.result())
+
+    def abandon_collapsed(self, seq, combined, futures, future):
+        # all callers gave up (e.g. timed out)
+
+        if not combined.done() and all(f.done() for f in futures):
+            self.pending.pop(seq, None)
+            combined.cancel()
+
+    # --------------------------------------------------------------------------
+    # write_batch (async)
+    # --------------------------------------------------------------------------
+
+    async def write_batch(self, channel, packages, items):
+        # one 'batch' frame if supported, otherwise the frames are written at once
+
+        try:
+            if FEATURE_BATCH in channel.features and len(packages) > 1:
+                seq = self.seq
+                self.seq = self.seq + 1
+
+                await channel.write({ "seq": seq, "command": "batch", "payload": packages })
+            else:
+                await channel.write_many(packages)
+        except Exception as e:
+            for package, future in items:
+                if not future.done():
+                    future.set_exception(ConnectionError(str(e) or type(e).__name__))
 
 # -----------------------------------------------------------------------------
 # class RpcServer
@@ -91,20 +905,106 @@ class RpcServer:
     # ctor
     # --------------------------------------------------------------------------
 
-    def __init__(self, port, base_skill):
+    def __init__(self, port, base_skill, concurrency = 1, path = None, stop_on_disconnect = True,
+                 queue_size = 100, max_age = 0.0, sock = None, reuse_port = False):
         self.log = logging.getLogger(__name__)
 
         self.port = port
+        self.path = path
         self.base_skill = base_skill
+        self.concurrency = max(1, concurrency)
+        self.stop_on_disconnect = stop_on_disconnect
+        self.queue_size = max(1, queue_size)
+        self.max_age = max_age
+        self.sock = sock
+        self.reuse_port = reuse_port
         self.server = None
+        self.stopped = None
+        self.draining = False
+        self.inflight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
 
     # --------------------------------------------------------------------------
     # start (async)
     # --------------------------------------------------------------------------
 
     async def start(self):
-        self.server = await asyncio.start_server(self.on_connected, '127.0.0.1', self.port)
-        await self.server.serve_forever()
+        # returns when the server is stopped or closed
+
+        if self.draining:
+            return
+
+        self.stopped = asyncio.get_event_loop().create_future()
+
+        if self.sock is not None:
+            # listening socket shared with other worker processes
+
+            if self.sock.family == getattr(socket, "AF_UNIX", None):
+                self.server = await asyncio.start_unix_server(self.on_connected, sock = self.sock)
+            else:
+                self.server = await asyncio.start_server(self.on_connected, sock = self.sock)
+        elif self.path and unix_sockets_supported():
+            remove_stale_socket(self.path)
+
+            self.log.debug("Listening on RPC socket '%s'", self.path)
+            self.server = await asyncio.start_unix_server(self.on_connected, self.path)
+        else:
+            if self.path:
+                self.log.warning("Unix domain sockets not supported on this platform, falling back to TCP")
+
+            self.server = await asyncio.start_server(self.on_connected, '127.0.0.1', self.port,
+                                                     reuse_port = self.reuse_port or None)
+
+        await self.stopped
+
+    # --------------------------------------------------------------------------
+    # close
+    # --------------------------------------------------------------------------
+
+    def close(self):
+        # stops accepting connections and lets start() return. requests still
+        # arriving on open connections are shed until the process exits
+
+        self.draining = True
+
+        if self.server:
+            self.server.close()
+
+        if self.stopped and not self.stopped.done():
+            self.stopped.set_result(None)
+
+    # --------------------------------------------------------------------------
+    # drain (async)
+    # --------------------------------------------------------------------------
+
+    async def drain(self, timeout):
+        # waits for requests in progress, True if all of them finished in time
+
+        if self.inflight:
+            self.log.info("Draining %s request(s) ...", self.inflight)
+
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.log.warning("Drain timeout, abandoning %s request(s)", self.inflight)
+            return False
+
+        return True
+
+    # --------------------------------------------------------------------------
+    # request_started / request_finished
+    # --------------------------------------------------------------------------
+
+    def request_started(self):
+        self.inflight += 1
+        self.idle.clear()
+
+    def request_finished(self, *args):
+        self.inflight -= 1
+
+        if not self.inflight:
+            self.idle.set()
 
     # --------------------------------------------------------------------------
     # stop (async)
@@ -118,69 +1018,269 @@ class RpcServer:
 
         try:
             self.server.close()
+
+            if self.stopped and not self.stopped.done():
+                self.stopped.set_result(None)
+
             await self.server.wait_closed()
         except Exception as e:
-            self.log.error("Error while shutting down server: {}".format(e))
+            self.log.error("Error while shutting down server: %s", e)
+
+        # a shared socket belongs to the supervising process
+
+        if self.path and self.sock is None and unix_sockets_supported():
+            remove_stale_socket(self.path)
+
+    # --------------------------------------------------------------------------
+    # negotiate (async)
+    # --------------------------------------------------------------------------
+
+    async def negotiate(self, channel, request_obj):
+        # pick the first offered framing/codec we support, answer in the current
+        # protocol and switch afterwards. unknown offers keep newline JSON
+
+        framing, codec = select_protocol(request_obj["payload"])
+
+        await channel.write({"seq": request_obj["seq"], "command": "response",
+                             "payload": { "framing": framing, "codec": codec }})
+
+        self.log.debug("Negotiated framing '%s' with codec '%s'", framing, codec)
+        channel.switch(framing, codec)
+
+    # --------------------------------------------------------------------------
+    # deadline
+    # --------------------------------------------------------------------------
+
+    def deadline(self, request_obj, received):
+        # monotonic deadline of a request: the server's (wall clock) 'deadline'
+        # if given, limited by the local 'max_age' policy. None if neither is set
+
+        deadline = None
+
+        if self.max_age:
+            deadline = received + self.max_age
+
+        remote = request_obj.get("deadline")
+
+        if isinstance(remote, (int, float)):
+            remote = received + (remote - time.time())
+            deadline = remote if deadline is None else min(deadline, remote)
+
+        return deadline
+
+    # --------------------------------------------------------------------------
+    # shed (async)
+    # --------------------------------------------------------------------------
+
+    async def shed(self, channel, request_obj, reason):
+        # answer with the skill's busy response instead of handling the request
+
+        stats = self.base_skill.stats
+
+        if stats:
+            stats.count(reason)
+
+        self.log.debug("Shedding request %s (%s)", request_obj["seq"], reason)
+
+        try:
+            res = self.base_skill.busy_response(request_obj["payload"])
+
+            if res:
+                await channel.write({"seq": request_obj["seq"], "command": "response", "payload": res})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.log.error("Sending busy response failed (%s)", e)
 
     # --------------------------------------------------------------------------
     # on_connected (async)
     # --------------------------------------------------------------------------
 
     async def on_connected(self, reader, writer):
+        channel = Channel(reader, writer, self.base_skill.stats, self.base_skill.capture)
+        queue = collections.deque()
+        queued = asyncio.Event()
+        tasks = set()
+        workers = []
+        overloaded = False
+
         async def abort():
+            for i in range(len(queue)):
+                self.request_finished()
+
+            queue.clear()
+
+            for task in list(tasks) + workers:
+                task.cancel()
+
             try:
-                writer.close()
-                await writer.wait_closed()
+                await channel.close()
             except Exception as e:
                 pass
 
-            await self.stop()
+            # keep listening for the server to come back, unless told otherwise
+
+            if self.stop_on_disconnect:
+                await self.stop()
+
+        # process a single request and write the response as soon as it is ready.
+        # responses may go out in any order, the server matches them by 'seq'.
+
+        async def process(request_obj, tracer):
+            stats = self.base_skill.stats
+            seq_token = logger.request_seq.set(request_obj["seq"])
+
+            if stats:
+                stats.request_started()
+
+            try:
+                res = await self.base_skill.dispatch_rpc_request(request_obj["command"], request_obj["payload"])
+
+                if not res:
+                    return
+
+                if tracer:
+                    started = time.perf_counter()
+
+                await channel.write({"seq": request_obj["seq"], "command": "response", "payload": res})
+
+                if tracer:
+                    tracer("encode", time.perf_counter() - started)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.log.error("Handling RPC request failed (%s)", e)
+            finally:
+                logger.request_seq.reset(seq_token)
+
+                if stats:
+                    stats.request_finished()
+
+        # 'concurrency' workers handle the queued intents. requests whose deadline
+        # passed while queued are answered busy instead, nobody waits for them
+
+        async def work():
+            while True:
+                while not queue:
+                    queued.clear()
+                    await queued.wait()
+
+                request_obj, deadline, tracer, received = queue.popleft()
+                now = time.monotonic()
 
-        # stream reader loop
+                try:
+                    if tracer:
+                        tracer("queue", now - received)
+
+                    if deadline is not None and now > deadline:
+                        await self.shed(channel, request_obj, "shedExpired")
+                        continue
+
+                    await process(request_obj, tracer)
+                finally:
+                    self.request_finished()
+
+        for i in range(self.concurrency):
+            workers.append(asyncio.ensure_future(work()))
+
+        # stream reader loop. intents are queued for the workers, other commands
+        # (cheap, e.g. get_stats) are processed right away
 
         while True:
-            res = None
+            request_obj = None
+
+            # stage timings (only when a tracer is installed, e.g. by hss_skill.bench)
+
+            tracer = self.base_skill.tracer
 
             try:
-                data = await reader.readline()
+                data = await channel.read_frame(timed = tracer is not None)
             except Exception as e:
-                self.log.error("Failed to read RPC connection ({})".format(e))
-                break;
+                self.log.error("Failed to read RPC connection (%s)", e)
+                break
+
+            if not data:
+                self.log.info("RPC connection closed by server")
+                return await abort()
+
+            if tracer:
+                read = time.perf_counter()
+                tracer("read", read - channel.frame_started)
 
             # bail out and abort if anything on RPC level is weird
 
             try:
-                json_string = data.decode("utf-8").replace('\\n', '\n')
-                request_obj = json.loads(json_string) if data else None
+                request_obj = channel.decode(data)
             except Exception as e:
-                self.log.error("Failed to parse RPC request ({})".format(e))
+                self.log.error("Failed to parse RPC request (%s)", e)
                 return await abort()
 
+            if tracer:
+                tracer("decode", time.perf_counter() - read)
+
             if not request_obj:
                 self.log.error("Malformed RPC request from server received, shutting down")
                 return await abort()
 
             # otherwise process RPC request
 
-            try:
-                self.log.debug("Got new RPC request with command '{}'".format(
-                    request_obj["command"] if "command" in request_obj else ""))
+            self.log.debug("Got new RPC request with command '%s'",
+                           request_obj["command"] if "command" in request_obj else "")
 
-                if not request_obj or "command" not in request_obj or "payload" not in request_obj or "seq" not in request_obj:
-                    self.log.error("Received malformed RPC request (missing mandatory json propertis 'seq/command'/'payload'")
-                    return
+            if "command" not in request_obj or "payload" not in request_obj or "seq" not in request_obj:
+                self.log.error("Received malformed RPC request (missing mandatory json propertis 'seq/command'/'payload'")
+                continue
 
-                res = await self.base_skill.dispatch_rpc_request(request_obj["command"], request_obj["payload"])
+            if request_obj["command"] == "negotiate":
+                try:
+                    await self.negotiate(channel, request_obj)
+                except Exception as e:
+                    self.log.error("RPC negotiation failed (%s)", e)
+                    return await abort()
 
-                if not res:
-                    return
+                continue
 
-                json_string = json.dumps({"seq": request_obj["seq"], "command": "response", "payload": res}, ensure_ascii=False).replace('\n', '\\n') + '\n'
+            if request_obj["command"] == "handle":
+                received = time.monotonic()
 
-                writer.write(json_string.encode('utf8'))
-                await writer.drain()
-            except Exception as e:
-                self.log.error("Handling RPC request failed ({})".format(e))
+                if self.draining:
+                    await self.shed(channel, request_obj, "shedDraining")
+                    continue
+
+                # above the high-water mark, shed right away instead of queueing
+
+                if len(queue) >= self.queue_size:
+                    if not overloaded:
+                        overloaded = True
+                        self.log.warning("Inbound queue full (%s requests), shedding load", len(queue))
+
+                    await self.shed(channel, request_obj, "shedFull")
+                    continue
+
+                if overloaded and len(queue) < self.queue_size // 2:
+                    overloaded = False
+                    self.log.info("Inbound queue drained, no longer shedding load")
+
+                deadline = self.deadline(request_obj, received)
+
+                if deadline is not None and deadline <= received:
+                    await self.shed(channel, request_obj, "shedExpired")
+                    continue
+
+                self.request_started()
+                queue.append((request_obj, deadline, tracer, received))
+                queued.set()
+
+                # let idle workers take it before reading further buffered
+                # requests, a burst would fill the queue otherwise
+
+                await asyncio.sleep(0)
+                continue
+
+            self.request_started()
+            task = asyncio.ensure_future(process(request_obj, tracer))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(self.request_finished)
 
-        if do_close:
-            await self.stop()
\ No newline at end of file
+        await abort()
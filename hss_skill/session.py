@@ -0,0 +1,510 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# session.py
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import asyncio
+import json
+import logging
+import time
+
+from collections import Counter, OrderedDict
+
+from hss_skill import database
+
+# -----------------------------------------------------------------------------
+# name of the timer evicting idle sessions
+# -----------------------------------------------------------------------------
+
+SWEEP_TIMER = "hss:sessions"
+
+# -----------------------------------------------------------------------------
+# table of the sqlite backend
+# -----------------------------------------------------------------------------
+
+SCHEMA = "CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, data TEXT, last_access REAL)"
+
+# -----------------------------------------------------------------------------
+# class Session
+# -----------------------------------------------------------------------------
+
+
+class Session:
+    __slots__ = ("session_id", "data", "last_access", "base", "touched")
+
+    def __init__(self, session_id, data, last_access, base = None):
+        # 'base': copy of the data as loaded/saved, to merge changes in shared mode
+
+        self.session_id = session_id
+        self.data = data
+        self.last_access = last_access
+        self.base = base
+        self.touched = True
+
+# -----------------------------------------------------------------------------
+# copy_data
+# -----------------------------------------------------------------------------
+
+
+def copy_data(data):
+    return json.loads(json.dumps(data))
+
+# -----------------------------------------------------------------------------
+# merge_data
+# -----------------------------------------------------------------------------
+
+
+def merge_data(stored, base, data):
+    # applies the changes made to 'base' (top level keys) onto 'stored'
+
+    for key, value in data.items():
+        if key not in base or base[key] != value:
+            stored[key] = value
+
+    for key in base:
+        if key not in data:
+            stored.pop(key, None)
+
+    return stored
+
+# -----------------------------------------------------------------------------
+# class MemoryBackend (no persistence)
+# -----------------------------------------------------------------------------
+
+
+class MemoryBackend:
+
+    def load(self, session_id):
+        return None
+
+    async def fetch(self, session_id):
+        return None
+
+    def save(self, session_id, data, last_access):
+        pass
+
+    def merge(self, session_id, base, data, last_access):
+        pass
+
+    def delete(self, session_id):
+        pass
+
+    def purge(self, cutoff):
+        pass
+
+    def close(self):
+        pass
+
+# -----------------------------------------------------------------------------
+# class SqliteBackend
+# -----------------------------------------------------------------------------
+
+
+class SqliteBackend:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, path):
+        # statements run on the database thread, writes are not waited for
+
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.db = database.Database(path, [SCHEMA])
+
+    # --------------------------------------------------------------------------
+    # load / fetch (async)
+    # --------------------------------------------------------------------------
+
+    def load(self, session_id):
+        # sync callers only wait briefly, the session then starts empty
+
+        return self.db.query(self.load_row, session_id)
+
+    async def fetch(self, session_id):
+        return await self.db.run(self.load_row, session_id)
+
+    def load_row(self, db, session_id):
+        row = db.execute("SELECT data, last_access FROM sessions WHERE id = ?", (session_id,)).fetchone()
+
+        if not row:
+            return None
+
+        try:
+            return json.loads(row[0]), row[1]
+        except Exception as e:
+            self.log.error("Failed to load session '%s' (%s)", session_id, e)
+            return None
+
+    # --------------------------------------------------------------------------
+    # save
+    # --------------------------------------------------------------------------
+
+    def save(self, session_id, data, last_access):
+        # serialized right away, the data may change before it is written
+
+        try:
+            text = json.dumps(data)
+        except Exception as e:
+            self.log.error("Failed to save session '%s' (%s)", session_id, e)
+            return
+
+        return self.db.post(self.save_row, session_id, text, last_access)
+
+    def save_row(self, db, session_id, text, last_access):
+        try:
+            db.execute("INSERT OR REPLACE INTO sessions (id, data, last_access) VALUES (?, ?, ?)",
+                       (session_id, text, last_access))
+        except Exception as e:
+            self.log.error("Failed to save session '%s' (%s)", session_id, e)
+
+    # --------------------------------------------------------------------------
+    # merge
+    # --------------------------------------------------------------------------
+
+    def merge(self, session_id, base, data, last_access):
+        # saves the changes made since 'base' onto the stored data, which other
+        # workers may have changed meanwhile. 'base' and 'data' must not be
+        # changed afterwards (the caller passes copies). returns a future
+
+        return self.db.post(self.merge_row, session_id, base, data, last_access)
+
+    def merge_row(self, db, session_id, base, data, last_access):
+        try:
+            db.execute("BEGIN IMMEDIATE")
+
+            try:
+                row = db.execute("SELECT data FROM sessions WHERE id = ?", (session_id,)).fetchone()
+                merged = merge_data(json.loads(row[0]) if row else {}, base, data)
+
+                db.execute("INSERT OR REPLACE INTO sessions (id, data, last_access) VALUES (?, ?, ?)",
+                           (session_id, json.dumps(merged), last_access))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        except Exception as e:
+            self.log.error("Failed to save session '%s' (%s)", session_id, e)
+
+    # --------------------------------------------------------------------------
+    # delete
+    # --------------------------------------------------------------------------
+
+    def delete(self, session_id):
+        self.db.post(lambda db: db.execute("DELETE FROM sessions WHERE id = ?", (session_id,)))
+
+    # --------------------------------------------------------------------------
+    # purge
+    # --------------------------------------------------------------------------
+
+    def purge(self, cutoff):
+        self.db.post(lambda db: db.execute("DELETE FROM sessions WHERE last_access < ?", (cutoff,)))
+
+    # --------------------------------------------------------------------------
+    # close
+    # --------------------------------------------------------------------------
+
+    def close(self):
+        self.db.close()
+
+# -----------------------------------------------------------------------------
+# class SessionStore
+# -----------------------------------------------------------------------------
+
+
+class SessionStore:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, ttl = 300.0, max_entries = 1000, backend = None, scheduler = None, sweep_interval = 60.0,
+                 shared = False):
+        # with 'shared', the backend is used by several worker processes. it is
+        # then the only source of truth: sessions are loaded when a request first
+        # uses them, and their changes are merged into the stored data when done
+
+        self.log = logging.getLogger(__name__)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend or MemoryBackend()
+        self.scheduler = scheduler
+        self.sweep_interval = sweep_interval
+        self.shared = shared
+        self.entries = OrderedDict()
+        self.active = Counter()
+        self.loose = set()
+        self.fetched = {}
+        self.flush_handle = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, session_id):
+        return session_id in self.entries
+
+    # --------------------------------------------------------------------------
+    # get
+    # --------------------------------------------------------------------------
+
+    def get(self, session_id, create = True):
+        # returns the session's data dict. entries are kept in order of last
+        # access, so the front of the dict always holds the idlest session
+
+        now = time.time()
+        entry = self.entries.get(session_id)
+
+        if entry and now - entry.last_access > self.ttl:
+            self.end(session_id)
+            entry = None
+
+        if not entry:
+            # loaded by acquire() off the event loop, if used by a request
+
+            stored = self.fetched.pop(session_id) if session_id in self.fetched else self.backend.load(session_id)
+
+            if stored and now - stored[1] <= self.ttl:
+                data = stored[0]
+            elif create:
+                data = {}
+            else:
+                return None
+
+            entry = self.entries[session_id] = Session(session_id, data, now, copy_data(data) if self.shared else None)
+
+            if len(self.entries) > self.max_entries:
+                self.evict(session_id)
+
+        entry.last_access = now
+        entry.touched = True
+        self.entries.move_to_end(session_id)
+
+        # used outside of a request (e.g. by a timer), written back soon
+
+        if not self.active[session_id]:
+            self.loose.add(session_id)
+            self.schedule_flush()
+
+        return entry.data
+
+    # --------------------------------------------------------------------------
+    # evict
+    # --------------------------------------------------------------------------
+
+    def evict(self, keep):
+        # drops the idlest sessions beyond max_entries. sessions used by requests
+        # in progress stay until released, their changes would be lost otherwise
+
+        excess = len(self.entries) - self.max_entries
+        victims = []
+
+        for session_id in self.entries:
+            if len(victims) >= excess:
+                break
+
+            if session_id != keep and not self.active[session_id]:
+                victims.append(session_id)
+
+        for session_id in victims:
+            self.loose.discard(session_id)
+            self.write(self.entries.pop(session_id))
+
+    # --------------------------------------------------------------------------
+    # write
+    # --------------------------------------------------------------------------
+
+    def write(self, entry):
+        # returns a future of the database write, if any
+
+        if not entry.touched:
+            return None
+
+        entry.touched = False
+
+        if not self.shared:
+            return self.backend.save(entry.session_id, entry.data, entry.last_access)
+
+        # changes of other workers are seen once the session is loaded again
+
+        data = copy_data(entry.data)
+        future = self.backend.merge(entry.session_id, entry.base, data, entry.last_access)
+        entry.base = data
+
+        return future
+
+    # --------------------------------------------------------------------------
+    # acquire
+    # --------------------------------------------------------------------------
+
+    async def acquire(self, session_id):
+        # a request uses the session, concurrent requests share the same data.
+        # stored sessions are loaded here, so get() doesn't wait for the database
+
+        if not session_id:
+            return
+
+        self.active[session_id] += 1
+
+        if session_id not in self.entries and session_id not in self.fetched:
+            stored = await self.backend.fetch(session_id)
+
+            if session_id not in self.entries and self.active[session_id]:
+                self.fetched[session_id] = stored
+
+    # --------------------------------------------------------------------------
+    # save
+    # --------------------------------------------------------------------------
+
+    def save(self, session_id):
+        entry = self.entries.get(session_id)
+
+        if entry:
+            entry.touched = True
+            self.write(entry)
+
+    # --------------------------------------------------------------------------
+    # release
+    # --------------------------------------------------------------------------
+
+    async def release(self, session_id):
+        # written back once the last request using the session is done (before
+        # the response is sent, so the next request sees the changes). shared
+        # sessions are forgotten then, other workers may change them
+
+        if not session_id or not self.active[session_id]:
+            return
+
+        self.active[session_id] -= 1
+
+        if self.active[session_id]:
+            return
+
+        del self.active[session_id]
+        self.loose.discard(session_id)
+        self.fetched.pop(session_id, None)
+
+        entry = self.entries.get(session_id)
+
+        if not entry:
+            return
+
+        future = self.write(entry)
+
+        if self.shared:
+            del self.entries[session_id]
+        elif len(self.entries) > self.max_entries:
+            # kept beyond max_entries while in use
+
+            self.evict(None)
+
+        if future is not None:
+            await asyncio.wrap_future(future)
+
+    # --------------------------------------------------------------------------
+    # schedule_flush / flush
+    # --------------------------------------------------------------------------
+
+    def schedule_flush(self):
+        if self.flush_handle is not None:
+            return
+
+        try:
+            self.flush_handle = asyncio.get_running_loop().call_soon(self.flush)
+        except RuntimeError:
+            # not on the event loop, flushed by the next sweep
+
+            pass
+
+    def flush(self):
+        # writes sessions used outside of requests
+
+        self.flush_handle = None
+        loose = self.loose
+        self.loose = set()
+
+        for session_id in loose:
+            entry = self.entries.get(session_id)
+
+            if entry and not self.active[session_id]:
+                self.write(entry)
+
+                if self.shared:
+                    del self.entries[session_id]
+
+    # --------------------------------------------------------------------------
+    # end
+    # --------------------------------------------------------------------------
+
+    def end(self, session_id):
+        self.loose.discard(session_id)
+        self.fetched.pop(session_id, None)
+        entry = self.entries.pop(session_id, None)
+        self.backend.delete(session_id)
+
+        return entry is not None
+
+    # --------------------------------------------------------------------------
+    # sweep
+    # --------------------------------------------------------------------------
+
+    def sweep(self):
+        self.flush()
+
+        cutoff = time.time() - self.ttl
+        evicted = 0
+
+        expired = []
+
+        for entry in self.entries.values():
+            if entry.last_access >= cutoff:
+                break
+
+            if not self.active[entry.session_id]:
+                expired.append(entry.session_id)
+
+        for session_id in expired:
+            del self.entries[session_id]
+            evicted += 1
+
+        self.backend.purge(cutoff)
+
+        if evicted:
+            self.log.debug("Evicted %s idle session(s)", evicted)
+
+        return evicted
+
+    # --------------------------------------------------------------------------
+    # start
+    # --------------------------------------------------------------------------
+
+    def start(self):
+        if self.scheduler is None or not self.sweep_interval:
+            return
+
+        def sweep():
+            self.sweep()
+            self.start()
+
+        self.scheduler.schedule(SWEEP_TIMER, self.sweep_interval, sweep, replace = True, persist = False)
+
+    # --------------------------------------------------------------------------
+    # close
+    # --------------------------------------------------------------------------
+
+    def close(self):
+        # writes everything not written yet, shared sessions are merged
+
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        for entry in list(self.entries.values()):
+            self.write(entry)
+
+        self.backend.close()
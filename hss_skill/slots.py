@@ -0,0 +1,219 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# slots.py
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import io
+import json
+import logging
+import os
+import pickle
+import sys
+import time
+
+# -----------------------------------------------------------------------------
+# cache file format (bump when the layout of the index changes)
+# -----------------------------------------------------------------------------
+
+CACHE_VERSION = 2
+CACHE_SUFFIX = ".cache"
+
+log = logging.getLogger(__name__)
+
+# -----------------------------------------------------------------------------
+# normalize
+# -----------------------------------------------------------------------------
+
+
+def normalize(text):
+    # case-insensitive, whitespace collapsed ("  New   York" -> "new york")
+
+    return " ".join(text.split()).casefold() if isinstance(text, str) else text
+
+# -----------------------------------------------------------------------------
+# invert
+# -----------------------------------------------------------------------------
+
+
+def invert(slotdict_json, normalized = False):
+    # { entity: { ident: [text, ...] } } -> { entity: { text: ident } }
+
+    if normalized:
+        return { k: {normalize(v): key for key, values in sub_dict.items() for v in values}
+                    for k, sub_dict in slotdict_json.items() }
+
+    return { k: {v: key for key, values in sub_dict.items() for v in values}
+                for k, sub_dict in slotdict_json.items() }
+
+# -----------------------------------------------------------------------------
+# read_cache
+# -----------------------------------------------------------------------------
+
+
+def read_cache(cache_path, signature):
+    # the file holds two pickles, header and index. the header is checked
+    # before the (large) index is unpickled
+
+    try:
+        with open(cache_path, "rb") as cache_file:
+            data = cache_file.read()
+    except OSError:
+        return None
+
+    try:
+        stream = io.BytesIO(data)
+
+        if pickle.load(stream) != signature:
+            return None
+
+        return pickle.load(stream)
+    except Exception as e:
+        log.warning("Ignoring broken slot dictionary cache '%s' (%s)", cache_path, e)
+        return None
+
+# -----------------------------------------------------------------------------
+# write_cache
+# -----------------------------------------------------------------------------
+
+
+def write_cache(cache_path, signature, index):
+    tmp_path = cache_path + ".tmp"
+
+    try:
+        with open(tmp_path, "wb") as cache_file:
+            pickle.dump(signature, cache_file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(index, cache_file, pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        # e.g. read-only skill directory, the cache is optional
+
+        log.debug("Failed to write slot dictionary cache '%s' (%s)", cache_path, e)
+
+# -----------------------------------------------------------------------------
+# load
+# -----------------------------------------------------------------------------
+
+
+def load(json_path, use_cache = True, normalized = False):
+    # inverted slot dictionary of the given slotsdict.<lang>.json, or None. the
+    # index is cached next to the JSON file, invalidated by its mtime and size
+
+    try:
+        st = os.stat(json_path)
+    except OSError:
+        return None
+
+    signature = (CACHE_VERSION, st.st_mtime_ns, st.st_size, normalized)
+    cache_path = json_path + CACHE_SUFFIX
+
+    if use_cache:
+        index = read_cache(cache_path, signature)
+
+        if index is not None:
+            return index
+
+    try:
+        with open(json_path) as json_file:
+            index = invert(json.load(json_file), normalized)
+    except Exception as e:
+        log.warning("Failed to open '%s' (%s)", json_path, e)
+        return None
+
+    if use_cache:
+        write_cache(cache_path, signature, index)
+
+    return index
+
+# -----------------------------------------------------------------------------
+# class SlotIndex (slot dictionaries of all languages, loaded on first use)
+# -----------------------------------------------------------------------------
+
+
+class SlotIndex:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, root_path, use_cache = True, normalized = False):
+        self.root_path = root_path
+        self.use_cache = use_cache
+        self.normalized = normalized
+        self.languages = {}
+        self.idents = {}
+
+    # --------------------------------------------------------------------------
+    # path
+    # --------------------------------------------------------------------------
+
+    def path(self, language):
+        return os.path.join(self.root_path, "slotsdict.{}.json".format(language).lower())
+
+    # --------------------------------------------------------------------------
+    # build
+    # --------------------------------------------------------------------------
+
+    def build(self, language):
+        # loads the index of a language without installing it. slot identifiers
+        # are shared by all languages, so each of them is only kept once
+
+        started = time.perf_counter()
+        index = load(self.path(language), self.use_cache, self.normalized)
+
+        if index:
+            idents = self.idents
+
+            for mapping in index.values():
+                for text, ident in mapping.items():
+                    shared = idents.get(ident)
+
+                    if shared is None:
+                        shared = idents[ident] = sys.intern(ident) if isinstance(ident, str) else ident
+
+                    mapping[text] = shared
+
+            log.debug("Loaded slot dictionary '%s' in %.1fms", language, (time.perf_counter() - started) * 1000)
+
+        return index
+
+    # --------------------------------------------------------------------------
+    # get
+    # --------------------------------------------------------------------------
+
+    def get(self, language):
+        # inverted dictionary of the language, None if the skill has none
+
+        key = language.lower()
+
+        try:
+            return self.languages[key]
+        except KeyError:
+            index = self.languages[key] = self.build(language)
+            return index
+
+    # --------------------------------------------------------------------------
+    # set
+    # --------------------------------------------------------------------------
+
+    def set(self, language, index):
+        self.languages[language.lower()] = index
+
+    # --------------------------------------------------------------------------
+    # lookup
+    # --------------------------------------------------------------------------
+
+    def lookup(self, index, entity, text):
+        # slot identifier of text, or text itself if it is not in the dictionary
+
+        mapping = index.get(entity) if index else None
+
+        if not mapping:
+            return text
+
+        return mapping.get(normalize(text) if self.normalized else text, text)
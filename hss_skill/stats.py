@@ -0,0 +1,209 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# stats.py
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import bisect
+import json
+import logging
+import os
+import time
+
+# -----------------------------------------------------------------------------
+# histogram bucket upper bounds (seconds)
+# -----------------------------------------------------------------------------
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# -----------------------------------------------------------------------------
+# class Histogram
+# -----------------------------------------------------------------------------
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    # --------------------------------------------------------------------------
+    # observe
+    # --------------------------------------------------------------------------
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+        if seconds > self.max:
+            self.max = seconds
+
+    # --------------------------------------------------------------------------
+    # percentile
+    # --------------------------------------------------------------------------
+
+    def percentile(self, p):
+        # upper bound of the bucket containing the percentile (max for the last one)
+
+        if not self.count:
+            return None
+
+        rank = p / 100.0 * self.count
+        seen = 0
+
+        for i, n in enumerate(self.counts):
+            seen += n
+
+            if seen >= rank:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+
+        return self.max
+
+    # --------------------------------------------------------------------------
+    # snapshot
+    # --------------------------------------------------------------------------
+
+    def snapshot(self):
+        buckets = { "le_{}".format(bound): n for bound, n in zip(BUCKETS, self.counts) }
+        buckets["inf"] = self.counts[-1]
+
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "buckets": buckets
+        }
+
+# -----------------------------------------------------------------------------
+# class CallStats (calls, errors, latency of one intent/command)
+# -----------------------------------------------------------------------------
+
+
+class CallStats:
+    __slots__ = ("calls", "errors", "latency")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        return { "calls": self.calls, "errors": self.errors, "latency": self.latency.snapshot() }
+
+# -----------------------------------------------------------------------------
+# class Stats
+# -----------------------------------------------------------------------------
+
+
+class Stats:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.started = time.time()
+        self.intents = {}
+        self.outbound = {}
+        self.counters = {}
+        self.inflight = 0
+        self.inflight_max = 0
+        self.outbound_inflight = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    # --------------------------------------------------------------------------
+    # record_intent
+    # --------------------------------------------------------------------------
+
+    def record_intent(self, name, seconds, error = False):
+        entry = self.intents.get(name)
+
+        if not entry:
+            entry = self.intents[name] = CallStats()
+
+        entry.calls += 1
+        entry.latency.observe(seconds)
+
+        if error:
+            entry.errors += 1
+
+    # --------------------------------------------------------------------------
+    # record_outbound
+    # --------------------------------------------------------------------------
+
+    def record_outbound(self, command, seconds, error = False):
+        entry = self.outbound.get(command)
+
+        if not entry:
+            entry = self.outbound[command] = CallStats()
+
+        entry.calls += 1
+        entry.latency.observe(seconds)
+
+        if error:
+            entry.errors += 1
+
+    # --------------------------------------------------------------------------
+    # request_started / request_finished
+    # --------------------------------------------------------------------------
+
+    def request_started(self):
+        self.inflight += 1
+
+        if self.inflight > self.inflight_max:
+            self.inflight_max = self.inflight
+
+    def request_finished(self):
+        self.inflight -= 1
+
+    # --------------------------------------------------------------------------
+    # count
+    # --------------------------------------------------------------------------
+
+    def count(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    # --------------------------------------------------------------------------
+    # snapshot
+    # --------------------------------------------------------------------------
+
+    def snapshot(self):
+        return {
+            "uptime": time.time() - self.started,
+            "intents": { name: entry.snapshot() for name, entry in self.intents.items() },
+            "outbound": { name: entry.snapshot() for name, entry in self.outbound.items() },
+            "inflight": self.inflight,
+            "inflightMax": self.inflight_max,
+            "outboundInflight": self.outbound_inflight,
+            "bytesIn": self.bytes_in,
+            "bytesOut": self.bytes_out,
+            "counters": dict(self.counters)
+        }
+
+    # --------------------------------------------------------------------------
+    # dump
+    # --------------------------------------------------------------------------
+
+    def dump(self, path):
+        tmp_path = path + ".tmp"
+
+        try:
+            with open(tmp_path, "w") as json_file:
+                json.dump(self.snapshot(), json_file, indent = 2)
+
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self.log.error("Failed to write stats to '%s' (%s)", path, e)
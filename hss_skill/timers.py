@@ -0,0 +1,630 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# timers.py
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import logging
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import time
+
+from hss_skill import database
+
+# -----------------------------------------------------------------------------
+# table of the shared timer store
+# -----------------------------------------------------------------------------
+
+SCHEMA = "CREATE TABLE IF NOT EXISTS timers (name TEXT PRIMARY KEY, deadline REAL, " \
+         "callback TEXT, user TEXT, tags TEXT, owner INTEGER)"
+
+# -----------------------------------------------------------------------------
+# class Timer
+# -----------------------------------------------------------------------------
+
+
+class Timer:
+    __slots__ = ("name", "deadline", "callback", "user", "tags", "cancelled", "stored", "stored_deadline")
+
+    def __init__(self, name, deadline, callback, user, tags):
+        # deadline: time.monotonic(), so changes of the wall clock (e.g. NTP
+        # sync after boot) don't fire timers early or hold them back.
+        # stored_deadline: wall clock time as persisted
+
+        self.name = name
+        self.deadline = deadline
+        self.callback = callback
+        self.user = user
+        self.tags = tags
+        self.cancelled = False
+        self.stored = False
+        self.stored_deadline = None
+
+    # --------------------------------------------------------------------------
+    # remaining
+    # --------------------------------------------------------------------------
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+# -----------------------------------------------------------------------------
+# class JsonTimerStore
+# -----------------------------------------------------------------------------
+
+
+class JsonTimerStore:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, path, delay = 1.0):
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.delay = delay
+        self.entries = None
+        self.flush_handle = None
+
+    # --------------------------------------------------------------------------
+    # load
+    # --------------------------------------------------------------------------
+
+    def load(self):
+        self.entries = {}
+
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path) as json_file:
+                    self.entries = { e["name"]: e for e in json.load(json_file) }
+            except Exception as e:
+                self.log.error("Failed to load timers from '%s' (%s)", self.path, e)
+
+        return list(self.entries.values())
+
+    # --------------------------------------------------------------------------
+    # save
+    # --------------------------------------------------------------------------
+
+    def save(self, entry):
+        if self.entries is None:
+            self.load()
+
+        self.entries[entry["name"]] = entry
+        self.schedule_flush()
+
+    # --------------------------------------------------------------------------
+    # remove
+    # --------------------------------------------------------------------------
+
+    def remove(self, names):
+        if self.entries is None:
+            self.load()
+
+        removed = [self.entries.pop(name, None) for name in names]
+
+        if any(removed):
+            self.schedule_flush()
+
+    # --------------------------------------------------------------------------
+    # schedule_flush
+    # --------------------------------------------------------------------------
+
+    def schedule_flush(self):
+        # changes are written in one go after a short delay, so scheduling
+        # many timers at once doesn't rewrite the file for every single timer
+
+        if self.flush_handle:
+            return
+
+        try:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.delay, self.flush)
+        except RuntimeError:
+            self.flush()
+
+    # --------------------------------------------------------------------------
+    # close
+    # --------------------------------------------------------------------------
+
+    def close(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush()
+
+    # --------------------------------------------------------------------------
+    # flush
+    # --------------------------------------------------------------------------
+
+    def flush(self):
+        self.flush_handle = None
+        tmp_path = self.path + ".tmp"
+
+        try:
+            with open(tmp_path, "w") as json_file:
+                json.dump(list(self.entries.values()), json_file)
+
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            self.log.error("Failed to store timers in '%s' (%s)", self.path, e)
+
+# -----------------------------------------------------------------------------
+# process_alive
+# -----------------------------------------------------------------------------
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+# -----------------------------------------------------------------------------
+# class SqliteTimerStore (shared by the worker processes of a skill)
+# -----------------------------------------------------------------------------
+
+
+class SqliteTimerStore:
+    # every worker schedules the timers it created, but a timer is only fired
+    # by the worker which is able to claim (delete) its row. so timers cancelled
+    # or replaced by another worker are skipped, and timers of dead workers are
+    # adopted by the next worker restoring timers
+
+    shared = True
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, path):
+        # statements run on the database thread. sync callers on the event loop
+        # wait only briefly for their result (see database.Database.query)
+
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.db = database.Database(path, [SCHEMA])
+
+    # --------------------------------------------------------------------------
+    # load
+    # --------------------------------------------------------------------------
+
+    def load(self):
+        # adopts the timers of workers which are no longer running (on startup)
+
+        return self.db.call(self.load_rows, os.getpid())
+
+    def load_rows(self, db, pid):
+        res = []
+
+        for name, deadline, callback, user, tags, owner in db.execute("SELECT * FROM timers").fetchall():
+            if owner == pid or process_alive(owner):
+                continue
+
+            if not db.execute("UPDATE timers SET owner = ? WHERE name = ? AND owner = ?", (pid, name, owner)).rowcount:
+                continue
+
+            try:
+                res.append({ "name": name, "deadline": deadline, "callback": callback,
+                             "user": json.loads(user), "tags": json.loads(tags) })
+            except Exception as e:
+                self.log.error("Failed to load timer '%s' (%s)", name, e)
+
+        return res
+
+    # --------------------------------------------------------------------------
+    # save
+    # --------------------------------------------------------------------------
+
+    def save(self, entry):
+        self.db.post(self.save_row, entry["name"], entry["deadline"], entry["callback"], json.dumps(entry["user"]),
+                     json.dumps(entry["tags"]), os.getpid())
+
+    def save_row(self, db, name, *values):
+        try:
+            db.execute("INSERT OR REPLACE INTO timers VALUES (?, ?, ?, ?, ?, ?)", (name,) + values)
+        except Exception as e:
+            self.log.error("Failed to store timer '%s' (%s)", name, e)
+
+    # --------------------------------------------------------------------------
+    # remove / remove_tag / remove_all
+    # --------------------------------------------------------------------------
+
+    def remove(self, names, default = 0):
+        return self.db.query(self.remove_rows, list(names), default = default)
+
+    def remove_tag(self, tag):
+        return self.db.query(self.remove_tag_rows, tag, default = 0)
+
+    def remove_all(self):
+        return self.db.query(lambda db: db.execute("DELETE FROM timers").rowcount, default = 0)
+
+    def remove_rows(self, db, names):
+        return sum(db.execute("DELETE FROM timers WHERE name = ?", (name,)).rowcount for name in names)
+
+    def remove_tag_rows(self, db, tag):
+        rows = db.execute("SELECT name, tags FROM timers").fetchall()
+
+        return self.remove_rows(db, [name for name, tags in rows if tag in json.loads(tags)])
+
+    # --------------------------------------------------------------------------
+    # contains
+    # --------------------------------------------------------------------------
+
+    def contains(self, name, default = False):
+        return self.db.query(lambda db: db.execute("SELECT 1 FROM timers WHERE name = ?", (name,)).fetchone() is not None,
+                             default = default)
+
+    # --------------------------------------------------------------------------
+    # claim (async)
+    # --------------------------------------------------------------------------
+
+    async def claim(self, timer):
+        # True if the timer is still due to be fired by this worker
+
+        return await self.db.run(lambda db: db.execute("DELETE FROM timers WHERE name = ? AND deadline = ? AND owner = ?",
+                                                       (timer.name, timer.stored_deadline, os.getpid())).rowcount == 1)
+
+    # --------------------------------------------------------------------------
+    # close
+    # --------------------------------------------------------------------------
+
+    def close(self):
+        self.db.close()
+
+# -----------------------------------------------------------------------------
+# class Scheduler
+# -----------------------------------------------------------------------------
+
+
+class Scheduler:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, owner = None, store = None):
+        self.log = logging.getLogger(__name__)
+        self.owner = owner
+        self.store = store
+        self.heap = []
+        self.timers = {}
+        self.tags = {}
+        self.cancelled = 0
+        self.counter = itertools.count()
+        self.task = None
+        self.tasks = set()
+        self.wakeup = None
+        self.shared = getattr(store, "shared", False)
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, name):
+        # with a shared store, the stored timers of all workers count
+
+        timer = self.timers.get(name)
+
+        if not self.shared or (timer is not None and not timer.stored):
+            return timer is not None
+
+        return self.store.contains(name, default = timer is not None)
+
+    # --------------------------------------------------------------------------
+    # get
+    # --------------------------------------------------------------------------
+
+    def get(self, name):
+        return self.timers.get(name)
+
+    # --------------------------------------------------------------------------
+    # schedule
+    # --------------------------------------------------------------------------
+
+    def schedule(self, name, timeout, callback, user = None, tags = None, replace = False, persist = True):
+        if name is None:
+            name = "timer-{}".format(next(self.counter))
+
+        # stored timers of other workers only matter for timers being stored
+        # (restored timers already own their stored entry)
+
+        exists = name in self if persist and self.shared else name in self.timers
+
+        if exists:
+            if not replace:
+                self.log.error("Cannot schedule timer '%s', timer already active!", name)
+                return None
+
+            self.cancel(name)
+        elif name in self.timers:
+            # cancelled by another worker
+
+            self.discard(self.timers.pop(name))
+
+        timer = Timer(name, time.monotonic() + timeout, callback, user, tuple(tags) if tags else ())
+
+        self.timers[name] = timer
+
+        for tag in timer.tags:
+            self.tags.setdefault(tag, set()).add(name)
+
+        earliest = not self.heap or timer.deadline < self.heap[0][0]
+
+        heapq.heappush(self.heap, (timer.deadline, next(self.counter), timer))
+
+        if persist:
+            self.persist(timer)
+
+        self.ensure_running()
+
+        if earliest:
+            self.wakeup.set()
+
+        self.log.debug("Timer '%s' scheduled with delay of %s seconds", name, timeout)
+
+        return timer
+
+    # --------------------------------------------------------------------------
+    # cancel
+    # --------------------------------------------------------------------------
+
+    def cancel(self, name):
+        timer = self.timers.pop(name, None)
+
+        if timer:
+            self.discard(timer)
+
+        if self.shared:
+            # the stored timer decides, the local one may be outdated
+
+            found = self.store.remove([name], default = int(timer is not None)) > 0 or \
+                (timer is not None and not timer.stored)
+        else:
+            found = timer is not None
+
+            if found and self.store:
+                self.store.remove([name])
+
+        if found:
+            self.log.debug("Timer '%s' cancelled", name)
+
+        return found
+
+    # --------------------------------------------------------------------------
+    # cancel_tag
+    # --------------------------------------------------------------------------
+
+    def cancel_tag(self, tag):
+        names = list(self.tags.get(tag, ()))
+
+        for name in names:
+            self.discard(self.timers.pop(name))
+
+        if self.shared:
+            count = max(len(names), self.store.remove_tag(tag))
+        else:
+            count = len(names)
+
+            if names and self.store:
+                self.store.remove(names)
+
+        self.log.debug("Cancelled %s timer(s) with tag '%s'", count, tag)
+
+        return count
+
+    # --------------------------------------------------------------------------
+    # cancel_all
+    # --------------------------------------------------------------------------
+
+    def cancel_all(self):
+        names = list(self.timers)
+
+        for name in names:
+            self.discard(self.timers.pop(name))
+
+        if self.shared:
+            return max(len(names), self.store.remove_all())
+
+        if names and self.store:
+            self.store.remove(names)
+
+        return len(names)
+
+    # --------------------------------------------------------------------------
+    # discard
+    # --------------------------------------------------------------------------
+
+    def discard(self, timer):
+        # cancelled timers stay in the heap and are skipped when they come up.
+        # the heap is compacted once cancelled entries make up half of it
+
+        timer.cancelled = True
+        self.cancelled += 1
+        self.untag(timer)
+
+        if self.cancelled > 64 and self.cancelled * 2 > len(self.heap):
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    # --------------------------------------------------------------------------
+    # untag
+    # --------------------------------------------------------------------------
+
+    def untag(self, timer):
+        for tag in timer.tags:
+            names = self.tags.get(tag)
+
+            if names is not None:
+                names.discard(timer.name)
+
+                if not names:
+                    del self.tags[tag]
+
+    # --------------------------------------------------------------------------
+    # persist
+    # --------------------------------------------------------------------------
+
+    def persist(self, timer):
+        # only timers which call a method of the owner can be restored later
+
+        if not self.store:
+            return
+
+        callback = getattr(timer.callback, "__self__", None) is self.owner and getattr(timer.callback, "__name__", None)
+
+        if not callback:
+            self.log.debug("Timer '%s' not persisted, callback is not a method of the skill", timer.name)
+            return
+
+        # stored as wall clock time, monotonic time does not survive a reboot
+
+        entry = { "name": timer.name, "deadline": time.time() + timer.remaining(), "callback": callback,
+                  "user": timer.user, "tags": list(timer.tags) }
+
+        try:
+            json.dumps(entry)
+        except Exception as e:
+            self.log.debug("Timer '%s' not persisted (%s)", timer.name, e)
+            return
+
+        self.store.save(entry)
+        timer.stored = True
+        timer.stored_deadline = entry["deadline"]
+
+    # --------------------------------------------------------------------------
+    # restore
+    # --------------------------------------------------------------------------
+
+    def restore(self):
+        if not self.store:
+            return 0
+
+        restored = 0
+
+        for entry in self.store.load():
+            callback = getattr(self.owner, entry["callback"], None)
+
+            if not callback:
+                self.log.warning("Cannot restore timer '%s', unknown callback '%s'", entry["name"], entry["callback"])
+                self.store.remove([entry["name"]])
+                continue
+
+            timer = self.schedule(entry["name"], max(0.0, entry["deadline"] - time.time()), callback,
+                                  user = entry.get("user"), tags = entry.get("tags"), replace = True, persist = False)
+
+            # keep the stored deadline, a shared store only fires the exact entry
+
+            timer.stored_deadline = entry["deadline"]
+            timer.stored = True
+            restored += 1
+
+        if restored:
+            self.log.info("Restored %s timer(s)", restored)
+
+        return restored
+
+    # --------------------------------------------------------------------------
+    # ensure_running
+    # --------------------------------------------------------------------------
+
+    def ensure_running(self):
+        if self.task and not self.task.done():
+            return
+
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    # --------------------------------------------------------------------------
+    # close (async)
+    # --------------------------------------------------------------------------
+
+    async def close(self):
+        # stops the scheduler and the callbacks still running (except the
+        # calling one, e.g. a timer callback shutting down the skill)
+
+        tasks = [task for task in self.tasks if task is not asyncio.current_task()]
+
+        if self.task:
+            tasks.append(self.task)
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions = True)
+
+        self.task = None
+        self.tasks.clear()
+
+        if self.store:
+            self.store.close()
+
+    # --------------------------------------------------------------------------
+    # run (async)
+    # --------------------------------------------------------------------------
+
+    async def run(self):
+        # single task sleeping until the earliest deadline. it is woken up early
+        # whenever a timer with an earlier deadline is scheduled
+
+        while True:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+                self.cancelled -= 1
+
+            if not self.heap:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            delay = self.heap[0][0] - time.monotonic()
+
+            if delay > 0:
+                self.wakeup.clear()
+
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+                continue
+
+            timer = heapq.heappop(self.heap)[2]
+
+            del self.timers[timer.name]
+            self.untag(timer)
+
+            if self.shared:
+                if timer.stored and not await self.store.claim(timer):
+                    self.log.debug("Timer '%s' was cancelled or replaced by another worker", timer.name)
+                    continue
+            elif self.store:
+                self.store.remove([timer.name])
+
+            # running callbacks are referenced until done, the event loop only
+            # keeps weak references to tasks
+
+            task = asyncio.ensure_future(self.fire(timer))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    # --------------------------------------------------------------------------
+    # fire (async)
+    # --------------------------------------------------------------------------
+
+    async def fire(self, timer):
+        try:
+            res = timer.callback(timer.user) if timer.user else timer.callback()
+
+            if asyncio.iscoroutine(res):
+                await res
+        except Exception as e:
+            self.log.error("Timer '%s' callback failed (%s)", timer.name, e)
@@ -0,0 +1,207 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# watcher.py
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+
+# -----------------------------------------------------------------------------
+# inotify (linux only, used through libc when available)
+# -----------------------------------------------------------------------------
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+IN_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# -----------------------------------------------------------------------------
+# load_inotify
+# -----------------------------------------------------------------------------
+
+
+def load_inotify():
+    # libc with inotify functions, or None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+
+        if hasattr(libc, "inotify_init1") and hasattr(libc, "inotify_add_watch"):
+            return libc
+    except (OSError, AttributeError):
+        pass
+
+    return None
+
+# -----------------------------------------------------------------------------
+# class Watcher (changes of files within one directory)
+# -----------------------------------------------------------------------------
+
+
+class Watcher:
+
+    # --------------------------------------------------------------------------
+    # ctor
+    # --------------------------------------------------------------------------
+
+    def __init__(self, directory, matches, callback, interval = 2.0, delay = 0.2):
+        # callback(names) is a coroutine receiving the set of changed file names
+        # which satisfy matches(name). changes are collected for 'delay' seconds,
+        # as editors often write a file in several steps. 'interval' is the
+        # polling interval without inotify
+
+        self.log = logging.getLogger(__name__)
+        self.directory = directory
+        self.matches = matches
+        self.callback = callback
+        self.interval = interval
+        self.delay = delay
+        self.loop = None
+        self.fd = None
+        self.poll_task = None
+        self.flush_handle = None
+        self.changed = set()
+        self.tasks = set()
+
+    # --------------------------------------------------------------------------
+    # start
+    # --------------------------------------------------------------------------
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        libc = load_inotify()
+
+        if libc:
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+            if fd >= 0 and libc.inotify_add_watch(fd, os.fsencode(self.directory), IN_MASK) >= 0:
+                self.fd = fd
+                self.loop.add_reader(fd, self.on_readable)
+                self.log.debug("Watching '%s' using inotify", self.directory)
+                return
+
+            if fd >= 0:
+                os.close(fd)
+
+        self.log.debug("Watching '%s' every %ss", self.directory, self.interval)
+        self.poll_task = asyncio.ensure_future(self.poll())
+
+    # --------------------------------------------------------------------------
+    # stop
+    # --------------------------------------------------------------------------
+
+    def stop(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+        if self.poll_task:
+            self.poll_task.cancel()
+            self.poll_task = None
+
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+    # --------------------------------------------------------------------------
+    # on_readable (inotify)
+    # --------------------------------------------------------------------------
+
+    def on_readable(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.log.error("Failed to read inotify events (%s)", e)
+            return
+
+        offset = 0
+
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+
+            if name and self.matches(name):
+                self.notify(name)
+
+    # --------------------------------------------------------------------------
+    # snapshot (polling)
+    # --------------------------------------------------------------------------
+
+    def snapshot(self):
+        res = {}
+
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return res
+
+        for name in names:
+            if not self.matches(name):
+                continue
+
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+                res[name] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                pass
+
+        return res
+
+    # --------------------------------------------------------------------------
+    # poll (async)
+    # --------------------------------------------------------------------------
+
+    async def poll(self):
+        previous = self.snapshot()
+
+        while True:
+            await asyncio.sleep(self.interval)
+
+            current = self.snapshot()
+
+            for name in set(previous) | set(current):
+                if previous.get(name) != current.get(name):
+                    self.notify(name)
+
+            previous = current
+
+    # --------------------------------------------------------------------------
+    # notify
+    # --------------------------------------------------------------------------
+
+    def notify(self, name):
+        self.changed.add(name)
+
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(self.delay, self.flush)
+
+    # --------------------------------------------------------------------------
+    # flush
+    # --------------------------------------------------------------------------
+
+    def flush(self):
+        changed = self.changed
+        self.changed = set()
+        self.flush_handle = None
+
+        task = asyncio.ensure_future(self.callback(changed))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
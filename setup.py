@@ -19,4 +19,11 @@ setuptools.setup(
         "Operating System :: OS Independent",
     ],
     python_requires='>=3.7',
+    entry_points={
+        "console_scripts": ["hss-skill-bench=hss_skill.bench:main",
+                            "hss-skill-capture=hss_skill.capture:main"],
+    },
+    extras_require={
+        "msgpack": ["msgpack>=1.0.0"],
+    },
 )
@@ -0,0 +1,250 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# test_httpclient.py
+# -----------------------------------------------------------------------------
+# Tests of the HTTP client against a local stand-in HTTP server
+#
+#   python -m unittest discover tests
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import asyncio
+import json
+import unittest
+
+from hss_skill.httpclient import HttpClient
+
+# -----------------------------------------------------------------------------
+# class StandIn (minimal HTTP/1.1 server, responses scripted per path)
+# -----------------------------------------------------------------------------
+
+
+class StandIn:
+
+    def __init__(self):
+        self.server = None
+        self.port = None
+        self.connections = 0
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.busy = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.on_connected, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def url(self, path):
+        return "http://127.0.0.1:{}{}".format(self.port, path)
+
+    async def on_connected(self, reader, writer):
+        self.connections += 1
+
+        while True:
+            line = await reader.readline()
+
+            if not line:
+                break
+
+            method, path, _ = line.decode("latin-1").split(" ", 2)
+            headers = {}
+
+            while True:
+                header = await reader.readline()
+
+                if header in (b"\r\n", b""):
+                    break
+
+                name, _, value = header.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            self.requests.append((method, path, body))
+
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+
+            try:
+                await asyncio.sleep(0.5 if path == "/slow" else 0.01)
+            finally:
+                self.active -= 1
+
+            writer.write(self.respond(method, path, body))
+            await writer.drain()
+
+            if path in ("/close", "/drop", "/idle-close"):
+                break
+
+        writer.close()
+
+    def respond(self, method, path, body):
+        if path == "/chunked":
+            return b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n6\r\n world\r\n0\r\n\r\n"
+
+        if path == "/busy" and self.busy < 2:
+            self.busy += 1
+            return b"HTTP/1.1 503 Busy\r\nContent-Length: 0\r\n\r\n"
+
+        if path == "/close":
+            return b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\nbye"
+
+        if path == "/drop":
+            # headers only, the connection is closed before the body
+
+            return b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n"
+
+        if path == "/bad-status":
+            return b"HTTP/1.1 abc OK\r\nContent-Length: 0\r\n\r\n"
+
+        if path == "/bad-length":
+            return b"HTTP/1.1 200 OK\r\nContent-Length: many\r\n\r\n"
+
+        if path == "/bad-chunk":
+            return b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\nxyz\r\n"
+
+        data = json.dumps({ "method": method, "path": path, "body": body.decode("utf-8") }).encode("utf-8")
+
+        return b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: " + \
+            str(len(data)).encode("latin-1") + b"\r\n\r\n" + data
+
+# -----------------------------------------------------------------------------
+# class HttpClientTest
+# -----------------------------------------------------------------------------
+
+
+class HttpClientTest(unittest.TestCase):
+
+    def run_test(self, test, **kwargs):
+        async def run():
+            server = StandIn()
+            await server.start()
+
+            client = HttpClient(**kwargs)
+
+            try:
+                await test(server, client)
+            finally:
+                await client.close()
+                await server.stop()
+
+        asyncio.run(run())
+
+    def test_get_json_and_keep_alive(self):
+        async def test(server, client):
+            for i in range(3):
+                response = await client.get(server.url("/a"), params = { "q": "x y" })
+
+                self.assertEqual(response.status, 200)
+                self.assertEqual(response.json()["path"], "/a?q=x+y")
+
+            self.assertEqual(server.connections, 1)
+
+        self.run_test(test)
+
+    def test_post_json(self):
+        async def test(server, client):
+            response = await client.post(server.url("/p"), json_body = { "k": 1 })
+
+            self.assertEqual(response.json(), { "method": "POST", "path": "/p", "body": '{"k": 1}' })
+
+        self.run_test(test)
+
+    def test_chunked(self):
+        async def test(server, client):
+            response = await client.get(server.url("/chunked"))
+
+            self.assertEqual(response.text(), "hello world")
+
+        self.run_test(test)
+
+    def test_limit_per_host(self):
+        async def test(server, client):
+            responses = await asyncio.gather(*[client.get(server.url("/x{}".format(i))) for i in range(10)])
+
+            self.assertTrue(all(response.status == 200 for response in responses))
+            self.assertEqual(server.max_active, 2)
+            self.assertEqual(server.connections, 2)
+
+        self.run_test(test, max_per_host = 2)
+
+    def test_retry_idempotent(self):
+        async def test(server, client):
+            response = await client.get(server.url("/busy"))
+
+            self.assertEqual(response.status, 200)
+            self.assertEqual(len(server.requests), 3)
+
+        self.run_test(test, retries = 2)
+
+    def test_no_retry_post(self):
+        async def test(server, client):
+            response = await client.post(server.url("/busy"), data = "x")
+
+            self.assertEqual(response.status, 503)
+            self.assertEqual(len(server.requests), 1)
+
+        self.run_test(test, retries = 2)
+
+    def test_connection_close(self):
+        async def test(server, client):
+            response = await client.get(server.url("/close"))
+
+            self.assertEqual(response.body, b"bye")
+
+            response = await client.get(server.url("/a"))
+
+            self.assertEqual(response.status, 200)
+            self.assertEqual(server.connections, 2)
+
+        self.run_test(test)
+
+    def test_idle_connection_closed(self):
+        async def test(server, client):
+            await client.get(server.url("/idle-close"))
+
+            response = await client.get(server.url("/a"))
+
+            self.assertEqual(response.status, 200)
+            self.assertEqual(server.connections, 2)
+
+        self.run_test(test, retries = 0)
+
+    def test_no_resend_after_response_started(self):
+        async def test(server, client):
+            await client.get(server.url("/a"))
+
+            self.assertIsNone(await client.post(server.url("/drop"), data = "x"))
+            self.assertEqual([path for method, path, body in server.requests], ["/a", "/drop"])
+
+        self.run_test(test, retries = 2)
+
+    def test_timeout(self):
+        async def test(server, client):
+            self.assertIsNone(await client.get(server.url("/slow")))
+
+        self.run_test(test, timeout = 0.1, retries = 0)
+
+    def test_malformed_responses(self):
+        async def test(server, client):
+            for path in ("/bad-status", "/bad-length", "/bad-chunk"):
+                self.assertIsNone(await client.get(server.url(path)), path)
+
+        self.run_test(test, retries = 0)
+
+    def test_connection_refused(self):
+        async def test(server, client):
+            self.assertIsNone(await client.get("http://127.0.0.1:1/"))
+
+        self.run_test(test, retries = 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
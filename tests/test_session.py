@@ -0,0 +1,227 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# test_session.py
+# -----------------------------------------------------------------------------
+# Tests of the session store, its sqlite backend and shared mode merges
+#
+#   python -m unittest discover tests
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+from hss_skill import session
+
+# -----------------------------------------------------------------------------
+# class MergeDataTest
+# -----------------------------------------------------------------------------
+
+
+class MergeDataTest(unittest.TestCase):
+
+    def test_changes_applied(self):
+        stored = { "a": 1, "b": 2, "other": "x" }
+        base = { "a": 1, "b": 2 }
+        data = { "a": 10, "b": 2, "c": 3 }
+
+        self.assertEqual(session.merge_data(stored, base, data), { "a": 10, "b": 2, "c": 3, "other": "x" })
+
+    def test_removed_keys(self):
+        stored = { "a": 1, "b": 2 }
+
+        self.assertEqual(session.merge_data(stored, { "a": 1, "b": 2 }, { "b": 2 }), { "b": 2 })
+
+    def test_unchanged_keys_keep_stored_value(self):
+        # 'a' was changed by another worker meanwhile, this one didn't touch it
+
+        stored = { "a": 5 }
+
+        self.assertEqual(session.merge_data(stored, { "a": 1 }, { "a": 1 }), { "a": 5 })
+
+    def test_nested_values_replaced(self):
+        stored = { "list": [1, 2], "dict": { "x": 1, "y": 2 } }
+        base = { "list": [1], "dict": { "x": 1 } }
+        data = { "list": [1, 3], "dict": { "x": 1 } }
+
+        self.assertEqual(session.merge_data(stored, base, data), { "list": [1, 3], "dict": { "x": 1, "y": 2 } })
+
+# -----------------------------------------------------------------------------
+# class SessionStoreTest
+# -----------------------------------------------------------------------------
+
+
+class SessionStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "sessions.sqlite")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_test(self, test):
+        asyncio.run(test())
+
+    def stored(self, session_id):
+        backend = session.SqliteBackend(self.path)
+
+        try:
+            res = backend.db.call(backend.load_row, session_id)
+        finally:
+            backend.close()
+
+        return res[0] if res else None
+
+    def test_saved_on_release(self):
+        async def test():
+            store = session.SessionStore(backend = session.SqliteBackend(self.path))
+
+            await store.acquire("s")
+            store.get("s")["n"] = 1
+            await store.release("s")
+
+            self.assertEqual(self.stored("s"), { "n": 1 })
+
+            store.close()
+
+            store = session.SessionStore(backend = session.SqliteBackend(self.path))
+
+            await store.acquire("s")
+            self.assertEqual(store.get("s"), { "n": 1 })
+            await store.release("s")
+
+            store.close()
+
+        self.run_test(test)
+
+    def test_eviction_keeps_active_sessions(self):
+        async def test():
+            store = session.SessionStore(max_entries = 1, backend = session.SqliteBackend(self.path))
+
+            await store.acquire("a")
+            store.get("a")["n"] = 1
+
+            await store.acquire("b")
+            store.get("b")["n"] = 2
+
+            self.assertIn("a", store)
+
+            store.get("a")["m"] = 3
+
+            await store.release("a")
+            await store.release("b")
+
+            self.assertEqual(len(store), 1)
+            self.assertEqual(self.stored("a"), { "n": 1, "m": 3 })
+            self.assertEqual(self.stored("b"), { "n": 2 })
+
+            store.close()
+
+        self.run_test(test)
+
+    def test_used_outside_request(self):
+        async def test():
+            store = session.SessionStore(backend = session.SqliteBackend(self.path))
+
+            store.get("s")["n"] = 1
+
+            await asyncio.sleep(0.05)
+
+            self.assertEqual(self.stored("s"), { "n": 1 })
+
+            store.close()
+
+        self.run_test(test)
+
+    def test_shared_merge(self):
+        async def test():
+            # two workers, each with its own store on the same database
+
+            first = session.SessionStore(backend = session.SqliteBackend(self.path), shared = True)
+            second = session.SessionStore(backend = session.SqliteBackend(self.path), shared = True)
+
+            await first.acquire("s")
+            first.get("s")["a"] = 1
+            await first.release("s")
+
+            await first.acquire("s")
+            await second.acquire("s")
+
+            first.get("s")["b"] = 2
+            second.get("s")["c"] = 3
+            second.get("s").pop("a")
+
+            await first.release("s")
+            await second.release("s")
+
+            self.assertEqual(self.stored("s"), { "b": 2, "c": 3 })
+
+            # forgotten when released, the next request sees the merged data
+
+            self.assertNotIn("s", first)
+
+            await first.acquire("s")
+            self.assertEqual(first.get("s"), { "b": 2, "c": 3 })
+            await first.release("s")
+
+            first.close()
+            second.close()
+
+        self.run_test(test)
+
+    def test_shared_concurrent_requests_of_worker(self):
+        async def test():
+            store = session.SessionStore(backend = session.SqliteBackend(self.path), shared = True)
+
+            await store.acquire("s")
+            await store.acquire("s")
+
+            store.get("s")["a"] = 1
+            self.assertEqual(store.get("s"), { "a": 1 })
+
+            await store.release("s")
+            self.assertIsNone(self.stored("s"))
+
+            await store.release("s")
+            self.assertEqual(self.stored("s"), { "a": 1 })
+
+            store.close()
+
+        self.run_test(test)
+
+    def test_shared_explicit_save(self):
+        async def test():
+            first = session.SessionStore(backend = session.SqliteBackend(self.path), shared = True)
+            second = session.SessionStore(backend = session.SqliteBackend(self.path), shared = True)
+
+            await first.acquire("s")
+            await second.acquire("s")
+
+            first.get("s")["a"] = 1
+            first.save("s")
+
+            second.get("s")["b"] = 2
+            await second.release("s")
+
+            # only the changes made since the explicit save are merged again
+
+            first.get("s")["c"] = 3
+            await first.release("s")
+
+            self.assertEqual(self.stored("s"), { "a": 1, "b": 2, "c": 3 })
+
+            first.close()
+            second.close()
+
+        self.run_test(test)
+
+
+if __name__ == "__main__":
+    unittest.main()
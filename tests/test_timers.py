@@ -0,0 +1,281 @@
+# -----------------------------------------------------------------------------
+# HSS - Hermes Skill Server - Skill module
+# Copyright (c) 2020 - Patrick Fial
+# -----------------------------------------------------------------------------
+# test_timers.py
+# -----------------------------------------------------------------------------
+# Tests of the timer scheduler and its stores
+#
+#   python -m unittest discover tests
+# -----------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from unittest import mock
+
+from hss_skill import timers
+
+# -----------------------------------------------------------------------------
+# class Owner (stands in for the skill, whose methods are persisted callbacks)
+# -----------------------------------------------------------------------------
+
+
+class Owner:
+
+    def __init__(self):
+        self.fired = []
+
+    def on_timer(self, user):
+        self.fired.append(user)
+
+    async def on_timer_async(self, user):
+        await asyncio.sleep(0)
+        self.fired.append(user)
+
+# -----------------------------------------------------------------------------
+# class SchedulerTest
+# -----------------------------------------------------------------------------
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def run_test(self, test):
+        asyncio.run(test())
+
+    def test_order(self):
+        async def test():
+            scheduler = timers.Scheduler()
+            fired = []
+
+            for name, timeout in (("c", 0.06), ("a", 0.02), ("b", 0.04)):
+                scheduler.schedule(name, timeout, fired.append, user = name)
+
+            self.assertEqual(len(scheduler), 3)
+
+            await asyncio.sleep(0.15)
+
+            self.assertEqual(fired, ["a", "b", "c"])
+            self.assertEqual(len(scheduler), 0)
+
+            await scheduler.close()
+
+        self.run_test(test)
+
+    def test_cancel_and_replace(self):
+        async def test():
+            scheduler = timers.Scheduler()
+            fired = []
+
+            scheduler.schedule("a", 0.02, fired.append, user = "a")
+            self.assertIsNone(scheduler.schedule("a", 0.02, fired.append, user = "b"))
+
+            scheduler.schedule("a", 0.03, fired.append, user = "c", replace = True)
+            scheduler.schedule("d", 0.02, fired.append, user = "d")
+
+            self.assertTrue(scheduler.cancel("d"))
+            self.assertFalse(scheduler.cancel("d"))
+
+            await asyncio.sleep(0.08)
+
+            self.assertEqual(fired, ["c"])
+
+            await scheduler.close()
+
+        self.run_test(test)
+
+    def test_cancel_tag(self):
+        async def test():
+            scheduler = timers.Scheduler()
+            fired = []
+
+            scheduler.schedule("a", 0.02, fired.append, user = "a", tags = ["x"])
+            scheduler.schedule("b", 0.02, fired.append, user = "b", tags = ["x", "y"])
+            scheduler.schedule("c", 0.02, fired.append, user = "c", tags = ["y"])
+
+            self.assertEqual(scheduler.cancel_tag("x"), 2)
+            self.assertEqual(scheduler.cancel_tag("x"), 0)
+            self.assertNotIn("a", scheduler)
+            self.assertIn("c", scheduler)
+
+            await asyncio.sleep(0.06)
+
+            self.assertEqual(fired, ["c"])
+
+            await scheduler.close()
+
+        self.run_test(test)
+
+    def test_reschedule_from_callback(self):
+        async def test():
+            scheduler = timers.Scheduler()
+            fired = []
+
+            def tick(n):
+                fired.append(n)
+
+                if n < 3:
+                    scheduler.schedule("tick", 0.01, tick, user = n + 1)
+
+            scheduler.schedule("tick", 0.01, tick, user = 1)
+
+            await asyncio.sleep(0.1)
+
+            self.assertEqual(fired, [1, 2, 3])
+            self.assertNotIn("tick", scheduler)
+
+            await scheduler.close()
+
+        self.run_test(test)
+
+    def test_wall_clock_change(self):
+        async def test():
+            scheduler = timers.Scheduler()
+            fired = []
+
+            scheduler.schedule("a", 0.1, fired.append, user = "a")
+
+            # the wall clock jumping ahead doesn't fire the timer early
+
+            with mock.patch("time.time", return_value = time.time() + 3600):
+                await asyncio.sleep(0.03)
+
+                self.assertEqual(fired, [])
+                self.assertGreater(scheduler.get("a").remaining(), 0.0)
+
+            await asyncio.sleep(0.12)
+
+            self.assertEqual(fired, ["a"])
+
+            await scheduler.close()
+
+        self.run_test(test)
+
+    def test_close_cancels_callbacks(self):
+        async def test():
+            scheduler = timers.Scheduler()
+            states = []
+
+            async def slow():
+                try:
+                    await asyncio.sleep(10)
+                except asyncio.CancelledError:
+                    states.append("cancelled")
+                    raise
+
+            scheduler.schedule("slow", 0.01, slow)
+
+            await asyncio.sleep(0.03)
+            self.assertEqual(len(scheduler.tasks), 1)
+
+            await scheduler.close()
+
+            self.assertEqual(states, ["cancelled"])
+            self.assertEqual(len(scheduler.tasks), 0)
+
+        self.run_test(test)
+
+    def test_restore(self):
+        async def test():
+            path = self.path("timers.json")
+            owner = Owner()
+            scheduler = timers.Scheduler(owner, timers.JsonTimerStore(path))
+
+            scheduler.schedule("soon", 0.05, owner.on_timer, user = "soon")
+            scheduler.schedule("later", 0.2, owner.on_timer_async, user = { "n": 1 }, tags = ["t"])
+            scheduler.schedule("local", 0.05, lambda: None)
+
+            await scheduler.close()
+
+            # 'soon' expires while no scheduler is running, 'local' can't be stored
+
+            await asyncio.sleep(0.1)
+
+            owner = Owner()
+            scheduler = timers.Scheduler(owner, timers.JsonTimerStore(path))
+
+            self.assertEqual(scheduler.restore(), 2)
+            self.assertNotIn("local", scheduler)
+            self.assertGreater(scheduler.get("later").remaining(), 0.0)
+
+            await asyncio.sleep(0.01)
+            self.assertEqual(owner.fired, ["soon"])
+
+            await asyncio.sleep(0.15)
+            self.assertEqual(owner.fired, ["soon", { "n": 1 }])
+
+            await scheduler.close()
+
+        self.run_test(test)
+
+    def test_shared_cancel_by_other_worker(self):
+        async def test():
+            path = self.path("shared.sqlite")
+            owner = Owner()
+            first = timers.Scheduler(owner, timers.SqliteTimerStore(path))
+            second = timers.Scheduler(owner, timers.SqliteTimerStore(path))
+
+            first.schedule("a", 0.05, owner.on_timer, user = "a")
+            first.schedule("b", 0.05, owner.on_timer, user = "b")
+
+            self.assertIn("a", second)
+            self.assertTrue(second.cancel("a"))
+
+            await asyncio.sleep(0.1)
+
+            self.assertEqual(owner.fired, ["b"])
+
+            await first.close()
+            await second.close()
+
+        self.run_test(test)
+
+    def test_shared_adopt_timers_of_dead_worker(self):
+        async def test():
+            path = self.path("shared.sqlite")
+            owner = Owner()
+            scheduler = timers.Scheduler(owner, timers.SqliteTimerStore(path))
+
+            scheduler.schedule("a", 0.05, owner.on_timer, user = "a")
+            await scheduler.close()
+
+            # pretend the timer was scheduled by a worker which exited since
+
+            dead = subprocess.Popen([sys.executable, "-c", "pass"])
+            dead.wait()
+
+            store = timers.SqliteTimerStore(path)
+            store.db.call(lambda db: db.execute("UPDATE timers SET owner = ?", (dead.pid,)))
+
+            scheduler = timers.Scheduler(owner, store)
+
+            self.assertEqual(scheduler.restore(), 1)
+
+            await asyncio.sleep(0.1)
+
+            self.assertEqual(owner.fired, ["a"])
+
+            await scheduler.close()
+
+        self.run_test(test)
+
+
+if __name__ == "__main__":
+    unittest.main()